@@ -0,0 +1,68 @@
+"""Backup size and throughput, with and without compaction, and the write
+rate of another thread while a backup runs.
+
+Run from the repository root::
+
+    python -m benchmarks.backup [num_docs]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+import threading
+from handbag import database
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+BACKUP_PATH = "/tmp/handbag-bench-backup.db"
+
+
+class NullFile(object):
+    
+    def write(self, data):
+        pass
+        
+        
+def writer(db, stop, counts):
+    foos = db.foos
+    while not stop.is_set():
+        with db.write():
+            foos.save({'name': u"late"})
+        counts[0] += 1
+        
+        
+def main(num_docs=200000):
+    for path in (BENCH_PATH, BACKUP_PATH):
+        if os.path.exists(path):
+            shutil.rmtree(path)
+    db = database.open(BENCH_URL)
+    foos = db.foos
+    with db.write():
+        ids = [foos.save({'name': u"Foo #%d" % i, 'body': u"x" * 200})['id'] for i in xrange(num_docs)]
+    with db.write():
+        for id in ids[:num_docs / 2]:
+            foos.remove(id)
+    print "data file: %.1f MB" % (os.path.getsize(os.path.join(BENCH_PATH, 'data.mdb')) / 1048576.0)
+    
+    for compact in (False, True):
+        stop = threading.Event()
+        counts = [0]
+        thread = threading.Thread(target=writer, args=(db, stop, counts))
+        thread.start()
+        stats = db.backup(BACKUP_PATH, compact=compact)
+        stop.set()
+        thread.join()
+        print "backup compact=%-5s %6.1f MB in %.2fs, %6.1f MB/s, %d commits by a writer meanwhile" % (
+            compact, stats['bytes'] / 1048576.0, stats['seconds'], stats['bytes_per_second'] / 1048576.0, counts[0])
+        shutil.rmtree(BACKUP_PATH)
+        
+    stats = db.backup_to(NullFile())
+    print "stream compact=True  %6.1f MB in %.2fs, %6.1f MB/s" % (
+        stats['bytes'] / 1048576.0, stats['seconds'], stats['bytes_per_second'] / 1048576.0)
+    db.close()
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,52 @@
+"""Repeated lookups of hot documents with and without the read cache.
+
+Run from the repository root::
+
+    python -m benchmarks.cache [num_reads] [num_docs]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import database
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+
+
+def measure(url, ids):
+    db = database.open(url)
+    foos = db.foos
+    with db.read():
+        start = time.time()
+        for id in ids:
+            foos.get(id)
+        elapsed = time.time() - start
+    stats = db.dbm.stats() if hasattr(db.dbm, 'stats') else None
+    db.close()
+    return len(ids) / elapsed, stats
+    
+    
+def main(num_reads=200000, num_docs=100):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    db = database.open(BENCH_URL)
+    foos = db.foos
+    with db.write():
+        ids = [foos.save({'name': u"Foo #%d" % i, 'tags': [u"a", u"b"], 'n': i})['id'] for i in xrange(0, num_docs)]
+    db.close()
+    ids = (ids * (num_reads / len(ids) + 1))[:num_reads]
+    
+    for label, query in (("no cache", ""), ("raw values", "?cache=1000"), ("decoded docs", "?cache=1000&cache_docs=1")):
+        rate, stats = measure(BENCH_URL + query, ids)
+        print "%-14s %9.0f gets/s" % (label, rate),
+        if stats:
+            print " hit rate %.3f" % stats['hit_rate'],
+        print
+        
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
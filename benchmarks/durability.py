@@ -0,0 +1,73 @@
+"""Write and read throughput for common combinations of the LMDB URL options.
+
+Run from the repository root::
+
+    python -m benchmarks.durability [num_rows] [path]
+
+Pass a path on the disk you care about; /tmp is often a RAM disk, which hides
+the cost of syncing.
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import database
+
+CONFIGS = [
+    ("default", ""),
+    ("metasync=0", "metasync=0"),
+    ("sync=0", "sync=0"),
+    ("writemap=1", "writemap=1"),
+    ("writemap=1&map_async=1", "writemap=1&map_async=1"),
+    ("writemap=1&sync=0", "writemap=1&sync=0"),
+    ("sync=0&lock=0", "sync=0&lock=0"),
+    ("readahead=0", "readahead=0"),
+]
+
+
+def run(path, options, num_rows):
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    db = database.open("lmdb://%s?%s" % (path, options))
+    foos = db.foos
+    foos.indexes.add('n')
+    value = u"x" * 100
+    
+    start = time.time()
+    for n in xrange(0, num_rows / 10):
+        with db.write():
+            foos.save({'n': n, 'value': value})
+    small = (num_rows / 10) / (time.time() - start)
+    
+    start = time.time()
+    for batch in xrange(0, num_rows, 1000):
+        with db.write():
+            for n in xrange(batch, min(batch + 1000, num_rows)):
+                foos.save({'n': n, 'value': value})
+    bulk = num_rows / (time.time() - start)
+    
+    start = time.time()
+    with db.read():
+        count = sum(1 for doc in foos.cursor())
+    scan = count / (time.time() - start)
+    
+    start = time.time()
+    db.sync()
+    sync = time.time() - start
+    
+    db.close()
+    shutil.rmtree(path)
+    return small, bulk, scan, sync
+    
+    
+def main(num_rows=20000, path="/tmp/handbag-bench.db"):
+    num_rows = int(num_rows)
+    print "%-24s %14s %14s %14s %10s" % ("options", "1 row/txn", "1000 rows/txn", "scan", "sync()")
+    for name, options in CONFIGS:
+        small, bulk, scan, sync = run(path, options, num_rows)
+        print "%-24s %10.0f r/s %10.0f r/s %10.0f r/s %8.1fms" % (name, small, bulk, scan, sync * 1000)
+        
+        
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,65 @@
+"""Time to remove 1000 expired sessions from tables of growing size, with
+the expiry index and with a scan of the whole table.
+
+Run from the repository root::
+
+    python -m benchmarks.expiry [max_docs]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import environment
+from handbag.validators import Text
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+EXPIRED = 1000
+
+
+def setup(num_docs):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    env = environment.open(BENCH_URL)
+    
+    class Session(env.Model):
+        user = Text()
+        ttl = 3600
+        
+    for i in xrange(0, num_docs, 1000):
+        with env.write():
+            for j in xrange(i, min(i + 1000, num_docs)):
+                Session(user=u"user %d" % j)
+    return env, Session
+    
+    
+def scan_expired(Session, now):
+    return [doc['id'] for doc in Session.table.cursor() if doc['_expires'] < now]
+    
+    
+def main(max_docs=100000):
+    num_docs = EXPIRED * 10
+    while num_docs <= max_docs:
+        env, Session = setup(num_docs)
+        with env.read():
+            expiries = sorted(d['_expires'] for d in Session.table.cursor())
+        now = expiries[EXPIRED]
+        
+        with env.read():
+            start = time.time()
+            ids = scan_expired(Session, now)
+            scan = time.time() - start
+        start = time.time()
+        with env.write():
+            removed = Session.remove_expired(limit=num_docs, now=now)
+        sweep = time.time() - start
+        assert removed == len(ids) == EXPIRED
+        print "%7d docs: sweep %7.1f ms, scan to find them %7.1f ms" % (num_docs, sweep * 1000, scan * 1000)
+        env.db.close()
+        num_docs *= 10
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,47 @@
+"""Creating model instances in one write transaction under each flush policy.
+
+Run from the repository root::
+
+    python -m benchmarks.flush [num_rows]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import environment
+from handbag.validators import Text, TypeOf
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+
+
+def measure(num_rows, **kwargs):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    env = environment.open(BENCH_URL, **kwargs)
+    
+    class Foo(env.Model):
+        name = Text()
+        count = TypeOf(int)
+        indexes = ['count']
+        
+    start = time.time()
+    with env.write():
+        for i in xrange(0, num_rows):
+            Foo(name=u"Foo #%d" % i, count=i)
+    elapsed = time.time() - start
+    env.db.close()
+    return num_rows / elapsed
+    
+    
+def main(num_rows=20000):
+    print "count (20 instances):  %.0f rows/s" % measure(num_rows)
+    print "count (1000 instances): %.0f rows/s" % measure(num_rows, max_queue_size=1000)
+    print "bytes (1MB):           %.0f rows/s" % measure(num_rows, flush_policy='bytes')
+    print "end of transaction:    %.0f rows/s" % measure(num_rows, flush_policy='commit')
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
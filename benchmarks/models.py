@@ -0,0 +1,59 @@
+"""Memory per model instance and load throughput.
+
+Run from the repository root::
+
+    python -m benchmarks.models [num_rows]
+"""
+
+import sys
+import gc
+import time
+import shutil
+import os.path
+from handbag import environment
+from handbag.validators import Text, TypeOf, Enum
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+
+
+def instance_size(inst):
+    size = sys.getsizeof(inst)
+    if hasattr(inst, '__dict__'):
+        size += sys.getsizeof(inst.__dict__)
+    for name in ('_reference_fields', '_prefetched'):
+        value = getattr(inst, name, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    return size
+    
+    
+def main(num_rows=100000):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    env = environment.open(BENCH_URL, identity_map_size=num_rows)
+    
+    class Foo(env.Model):
+        name = Text()
+        flavor = Enum('spicy', 'artichoke', 'red')
+        count = TypeOf(int)
+        
+    with env.db.write():
+        for i in xrange(0, num_rows):
+            Foo.table.save({'name': u"Foo #%d" % i, 'flavor': 'spicy', 'count': i})
+                
+    with env.read():
+        gc.collect()
+        start = time.time()
+        foos = list(Foo.cursor())
+        elapsed = time.time() - start
+        print "rows:                 %d" % len(foos)
+        print "load throughput:      %.0f rows/s" % (len(foos) / elapsed)
+        print "bytes per instance:   %d" % instance_size(foos[0])
+        
+    env.db.close()
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
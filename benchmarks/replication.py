@@ -0,0 +1,61 @@
+"""Save rate with and without the change log, and how fast a replicator
+applies the log to a replica for a few batch sizes.
+
+Run from the repository root::
+
+    python -m benchmarks.replication [num_docs]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import database
+from handbag.changelog import Replicator
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+REPLICA_PATH = "/tmp/handbag-bench-replica.db"
+REPLICA_URL = "lmdb://%s" % REPLICA_PATH
+
+
+def reset(*paths):
+    for path in paths:
+        if os.path.exists(path):
+            shutil.rmtree(path)
+            
+            
+def fill(db, num_docs):
+    foos = db.foos
+    start = time.time()
+    for i in xrange(0, num_docs, 100):
+        with db.write():
+            for j in xrange(i, min(i + 100, num_docs)):
+                foos.save({'name': u"Foo #%d" % j, 'body': u"x" * 100})
+    return num_docs / (time.time() - start)
+    
+    
+def main(num_docs=50000):
+    for changelog in (False, True):
+        reset(BENCH_PATH)
+        db = database.open(BENCH_URL, changelog)
+        print "changelog=%-5s %8.0f saves/s" % (changelog, fill(db, num_docs))
+        db.close()
+        
+    for batch_size in (100, 1000, 10000):
+        reset(BENCH_PATH, REPLICA_PATH)
+        db = database.open(BENCH_URL, changelog=True)
+        fill(db, num_docs)
+        replica = database.open(REPLICA_URL)
+        replica.foos
+        replicator = Replicator(db, replica, batch_size=batch_size)
+        start = time.time()
+        replicator.catch_up()
+        print "batch_size=%-5d %8.0f entries/s applied" % (batch_size, num_docs / (time.time() - start))
+        replica.close()
+        db.close()
+    reset(BENCH_PATH, REPLICA_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
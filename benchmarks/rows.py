@@ -0,0 +1,53 @@
+"""Loading model instances versus read-only rows.
+
+Run from the repository root::
+
+    python -m benchmarks.rows [num_rows]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import environment
+from handbag.validators import Text, TypeOf, Enum
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+
+
+def timed(fn):
+    start = time.time()
+    result = fn()
+    return result, time.time() - start
+    
+    
+def main(num_rows=100000):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    env = environment.open(BENCH_URL)
+    
+    class Foo(env.Model):
+        name = Text()
+        flavor = Enum('spicy', 'artichoke', 'red')
+        count = TypeOf(int)
+        
+    with env.db.write():
+        for i in xrange(0, num_rows):
+            Foo.table.save({'name': u"Foo #%d" % i, 'flavor': 'spicy', 'count': i})
+            
+    with env.read():
+        instances, instances_time = timed(lambda: list(Foo.cursor()))
+    with env.read():
+        rows, rows_time = timed(lambda: list(Foo.rows()))
+        
+    print "rows:                 %d" % len(rows)
+    print "instances:            %.0f rows/s" % (len(instances) / instances_time)
+    print "read-only rows:       %.0f rows/s" % (len(rows) / rows_time)
+    
+    env.db.close()
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,80 @@
+"""Scanning a table with the dbm cursor and the table cursor.
+
+Run from the repository root::
+
+    python -m benchmarks.scan [num_entries]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+from handbag import database, dson
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+
+
+def timed(name, num_entries, fn):
+    start = time.time()
+    count = fn()
+    elapsed = time.time() - start
+    assert count == num_entries, (name, count)
+    print "%-32s %10.0f entries/s" % (name, num_entries / elapsed)
+    
+    
+def step(dbm):
+    cursor = dbm.cursor('foos')
+    count = 0
+    if cursor.first():
+        count += 1
+        while cursor.next():
+            cursor.key()
+            cursor.value()
+            count += 1
+    return count
+    
+    
+def iterate(dbm):
+    cursor = dbm.cursor('foos')
+    cursor.first()
+    count = 0
+    for k, v in cursor.iternext():
+        count += 1
+    return count
+    
+    
+def iterate_batches(dbm):
+    cursor = dbm.cursor('foos')
+    cursor.first()
+    count = 0
+    for batch in cursor.iternext_batch(1000):
+        count += len(batch)
+    return count
+    
+    
+def main(num_entries=1000000):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    db = database.open(BENCH_URL + "?map_size=4G")
+    foos = db.foos
+    dbm = db.dbm
+    with db.write():
+        for i in xrange(0, num_entries):
+            dbm.put('foos', dson.dumpone(i), dson.dumps({'id': i, 'name': u"Foo #%d" % i}))
+            
+    with db.read():
+        timed("dbm cursor first/next/key/value", num_entries, lambda: step(dbm))
+        timed("dbm cursor iternext", num_entries, lambda: iterate(dbm))
+        if hasattr(dbm.cursor('foos'), 'iternext_batch'):
+            timed("dbm cursor iternext_batch", num_entries, lambda: iterate_batches(dbm))
+        timed("table cursor (decoded)", num_entries, lambda: sum(1 for doc in foos.cursor()))
+        if hasattr(foos.cursor(), 'batches'):
+            timed("table cursor batches (decoded)", num_entries, lambda: sum(len(b) for b in foos.cursor().batches()))
+            
+    db.close()
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,56 @@
+"""Write throughput of independent tenants as the number of shards grows.
+
+Each thread writes its own table, committing every few documents. With one
+shard all the threads share a single writer; with more shards the tables are
+spread over several LMDB environments that commit in parallel.
+
+Run from the repository root::
+
+    python -m benchmarks.shards [num_threads] [num_commits] [docs_per_commit]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+import threading
+from handbag import database
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+
+
+def tenant(db, name, num_commits, docs_per_commit):
+    table = db[name]
+    for i in xrange(num_commits):
+        with db.write():
+            for j in xrange(docs_per_commit):
+                table.save({'name': u"Doc #%d" % j, 'n': i})
+                
+                
+def measure(num_shards, num_threads, num_commits, docs_per_commit):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    db = database.open("sharded://%s?shards=%d" % (BENCH_PATH, num_shards))
+    names = ["tenant%d" % i for i in range(num_threads)]
+    for name in names:
+        db[name]
+    threads = [threading.Thread(target=tenant, args=(db, name, num_commits, docs_per_commit)) for name in names]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    db.close()
+    shutil.rmtree(BENCH_PATH)
+    return num_threads * num_commits / elapsed
+    
+    
+def main(num_threads=8, num_commits=300, docs_per_commit=1):
+    for num_shards in (1, 2, 4, 8):
+        rate = measure(num_shards, num_threads, num_commits, docs_per_commit)
+        print "%d shard(s): %7.0f commits/s" % (num_shards, rate)
+        
+        
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
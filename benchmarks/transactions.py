@@ -0,0 +1,60 @@
+"""Latency of short read transactions with and without spare transactions.
+
+Run from the repository root::
+
+    python -m benchmarks.transactions [num_reads] [num_threads]
+"""
+
+import sys
+import time
+import shutil
+import os.path
+import threading
+from handbag import database
+
+BENCH_PATH = "/tmp/handbag-bench.db"
+BENCH_URL = "lmdb://%s" % BENCH_PATH
+
+
+def short_reads(db, ids):
+    foos = db.foos
+    for id in ids:
+        with db.read():
+            foos.get(id)
+            
+            
+def measure(url, ids, num_threads):
+    db = database.open(url)
+    db.foos
+    threads = [threading.Thread(target=short_reads, args=(db, ids)) for i in range(num_threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+    db.close()
+    return elapsed / (len(ids) * num_threads) * 1000000
+    
+    
+def main(num_reads=100000, num_threads=4):
+    if os.path.exists(BENCH_PATH):
+        shutil.rmtree(BENCH_PATH)
+    db = database.open(BENCH_URL)
+    foos = db.foos
+    with db.write():
+        ids = [foos.save({'name': u"Foo #%d" % i})['id'] for i in xrange(0, 1000)]
+    db.close()
+    ids = (ids * (num_reads / len(ids) + 1))[:num_reads]
+    
+    for threads in (1, num_threads):
+        unpooled = measure(BENCH_URL + "?max_spare_txns=0", ids, threads)
+        pooled = measure(BENCH_URL, ids, threads)
+        print "%d thread(s), no spare txns:  %.2f us/read" % (threads, unpooled)
+        print "%d thread(s), spare txns:     %.2f us/read" % (threads, pooled)
+        
+    shutil.rmtree(BENCH_PATH)
+    
+    
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:]])
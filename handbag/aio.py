@@ -0,0 +1,444 @@
+"""
+Asynchronous access to an environment for code running on a trollius event
+loop::
+
+    from trollius import coroutine, From, Return
+    from handbag import aio
+
+    env = aio.open('lmdb:///tmp/foos.db')
+
+    class Foo(env.Model):
+        name = Text()
+
+    @coroutine
+    def names(foo_id):
+        ctx = env.aread()
+        yield From(ctx.enter())
+        try:
+            foo = yield From(Foo.aget(foo_id))
+            names = [foo.name]
+            cursor = Foo.acursor()
+            while True:
+                batch = yield From(cursor.next_batch())
+                if not batch:
+                    break
+                names.extend(f.name for f in batch)
+        finally:
+            yield From(ctx.exit())
+        raise Return(names)
+
+Contexts and cursors also implement ``__aenter__``/``__aexit__`` and
+``__anext__`` for ``async with`` and ``async for``, but this package only runs
+on python 2, where that syntax isn't available.
+
+Transactions are bound to the thread that started them, so each context runs
+on a worker thread of its own from a fixed size pool. Everything done in the
+context (``Model.aget``, async cursors, :meth:`AsyncEnvironment.call`) is run on
+that worker. When every worker is busy, new contexts wait for one to be
+released. Async cursors fetch rows from the worker in batches so each await
+yields many rows.
+
+Instances returned to the event loop can be read, but following relationships
+or loading deferred fields needs a transaction, so do that in a function passed
+to :meth:`AsyncEnvironment.call`.
+"""
+
+import Queue
+import threading
+import __builtin__
+from collections import deque
+from itertools import islice
+import environment
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+    
+    
+__all__ = ['open', 'AsyncEnvironment', 'StopAsyncIteration']
+
+
+StopAsyncIteration = getattr(__builtin__, 'StopAsyncIteration', None)
+if StopAsyncIteration is None:
+    class StopAsyncIteration(Exception):
+        pass
+        
+        
+def open(path, max_workers=8, batch_size=100, **kwargs):
+    return AsyncEnvironment(environment.open(path, **kwargs), max_workers, batch_size)
+    
+    
+def current_task(loop):
+    if hasattr(asyncio, 'current_task'):
+        return asyncio.current_task(loop)
+    return asyncio.Task.current_task(loop)
+    
+    
+def set_result(future, result):
+    if not future.cancelled():
+        future.set_result(result)
+        
+        
+def set_exception(future, exception):
+    if not future.cancelled():
+        future.set_exception(exception)
+        
+        
+def raise_exception(future, exception):
+    """Set an exception that isn't an ``Exception``, such as
+    ``KeyboardInterrupt``, and raise it out of the event loop the way a task
+    raising it would."""
+    set_exception(future, exception)
+    raise exception
+    
+    
+def completed(loop, result):
+    future = asyncio.Future(loop=loop)
+    future.set_result(result)
+    return future
+    
+    
+def chain(future, fn, loop):
+    """Return a future for ``fn(future)``, called once ``future`` is done. If
+    ``fn`` returns a future the returned future follows it."""
+    result = asyncio.Future(loop=loop)
+    
+    def follow(f):
+        if f.cancelled():
+            result.cancel()
+        elif f.exception() is not None:
+            set_exception(result, f.exception())
+        else:
+            set_result(result, f.result())
+            
+    def done(f):
+        try:
+            value = fn(f)
+        except Exception, e:
+            set_exception(result, e)
+            return
+        if isinstance(value, asyncio.Future):
+            value.add_done_callback(follow)
+        else:
+            set_result(result, value)
+            
+    future.add_done_callback(done)
+    return result
+    
+    
+class Worker(object):
+    """A thread that runs functions one at a time and reports their results
+    back to the event loop."""
+    
+    def __init__(self, name):
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+        
+        
+    def submit(self, loop, fn, *args, **kwargs):
+        future = asyncio.Future(loop=loop)
+        self.queue.put((loop, future, fn, args, kwargs))
+        return future
+        
+        
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+        
+        
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            loop, future, fn, args, kwargs = item
+            try:
+                result = fn(*args, **kwargs)
+            except Exception, e:
+                loop.call_soon_threadsafe(set_exception, future, e)
+            except BaseException, e:
+                # The worker keeps running and the future is still resolved.
+                loop.call_soon_threadsafe(raise_exception, future, e)
+            else:
+                loop.call_soon_threadsafe(set_result, future, result)
+                
+                
+class WorkerPool(object):
+    """Hands out up to ``size`` workers. It is only used from the event loop
+    thread."""
+    
+    def __init__(self, size):
+        self.size = size
+        self.workers = []
+        self.idle = []
+        self.waiters = deque()
+        
+        
+    def acquire(self, loop):
+        future = asyncio.Future(loop=loop)
+        if self.idle:
+            future.set_result(self.idle.pop())
+        elif len(self.workers) < self.size:
+            worker = Worker("handbag-aio-%d" % len(self.workers))
+            self.workers.append(worker)
+            future.set_result(worker)
+        else:
+            self.waiters.append(future)
+        return future
+        
+        
+    def release(self, worker):
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.cancelled():
+                waiter.set_result(worker)
+                return
+        self.idle.append(worker)
+        
+        
+    def close(self):
+        for worker in self.workers:
+            worker.stop()
+        self.workers = []
+        self.idle = []
+        
+        
+class AsyncEnvironment(object):
+    
+    def __init__(self, env, max_workers=8, batch_size=100):
+        self.env = env
+        self.pool = WorkerPool(max_workers)
+        self.batch_size = batch_size
+        self.contexts = {}
+        env.aio = self
+        
+        
+    def __getattr__(self, name):
+        return getattr(self.env, name)
+        
+        
+    def aread(self):
+        return AsyncContext(self)
+        
+        
+    def awrite(self):
+        return AsyncContext(self, writable=True)
+        
+        
+    def run_read(self, fn, *args, **kwargs):
+        """Call ``fn`` in a read context on a worker. Returns a future."""
+        return self._run(self.env.read, fn, args, kwargs)
+        
+        
+    def run_write(self, fn, *args, **kwargs):
+        """Call ``fn`` in a write context on a worker. Returns a future."""
+        return self._run(self.env.write, fn, args, kwargs)
+        
+        
+    def call(self, fn, *args, **kwargs):
+        """Call ``fn`` on the worker of the current task's context. Returns a
+        future."""
+        return self.current_context().call(fn, *args, **kwargs)
+        
+        
+    def cursor(self, factory, *args, **kwargs):
+        """Return an async cursor over ``factory(*args, **kwargs)``, which is
+        called on the worker of the current task's context."""
+        batch_size = kwargs.pop('batch_size', None) or self.batch_size
+        return AsyncCursor(self.current_context(), factory, args, kwargs, batch_size)
+        
+        
+    def current_context(self, task=None):
+        if task is None:
+            task = current_task(asyncio.get_event_loop())
+        contexts = self.contexts.get(task)
+        assert contexts, "An active async transaction is required"
+        return contexts[-1]
+        
+        
+    def push_context(self, task, context):
+        self.contexts.setdefault(task, []).append(context)
+        
+        
+    def pop_context(self, task, context):
+        contexts = self.contexts.get(task)
+        assert contexts and contexts[-1] is context, "Contexts must be exited in the order they were entered"
+        contexts.pop()
+        if not contexts:
+            del self.contexts[task]
+            
+            
+    def close(self):
+        self.pool.close()
+        self.env.db.close()
+        
+        
+    def _run(self, make_context, fn, args, kwargs):
+        loop = asyncio.get_event_loop()
+        
+        def in_context():
+            with make_context():
+                return fn(*args, **kwargs)
+                
+        def run(acquired):
+            worker = acquired.result()
+            if running.cancelled():
+                self.pool.release(worker)
+                return None
+            done = worker.submit(loop, in_context)
+            done.add_done_callback(lambda f: self.pool.release(worker))
+            return done
+            
+        acquiring = self.pool.acquire(loop)
+        running = chain(acquiring, run, loop)
+        running.add_done_callback(lambda f: f.cancelled() and acquiring.cancel())
+        return running
+        
+        
+class AsyncContext(object):
+    """A read or write context run on a worker. Contexts nested in the same
+    task share the outer context's worker."""
+    
+    def __init__(self, aenv, writable=False):
+        self.aenv = aenv
+        self.writable = writable
+        self.loop = None
+        self.task = None
+        self.worker = None
+        self.owns_worker = False
+        self.context = None
+        
+        
+    def __aenter__(self):
+        self.loop = asyncio.get_event_loop()
+        self.task = current_task(self.loop)
+        contexts = self.aenv.contexts.get(self.task)
+        if contexts:
+            acquired = completed(self.loop, contexts[-1].worker)
+        else:
+            acquired = self.aenv.pool.acquire(self.loop)
+            self.owns_worker = True
+            
+        def enter(f):
+            self.worker = f.result()
+            if entering.cancelled():
+                self.release()
+                return None
+            return self.worker.submit(self.loop, self.enter_context)
+            
+        def entered(f):
+            if f.exception() is not None:
+                self.release()
+                raise f.exception()
+            if entering.cancelled():
+                if self.context is not None:
+                    self.abandon()
+                return None
+            self.aenv.push_context(self.task, self)
+            return self
+            
+        # A task cancelled while entering never calls __aexit__, so a worker
+        # it gets, and a transaction it starts, are given up here.
+        entering = chain(chain(acquired, enter, self.loop), entered, self.loop)
+        entering.add_done_callback(lambda f: f.cancelled() and acquired.cancel())
+        return entering
+        
+        
+    def __aexit__(self, type=None, value=None, traceback=None):
+        self.aenv.pop_context(self.task, self)
+        
+        def exited(f):
+            self.release()
+            f.result()
+            return False
+            
+        return chain(self.worker.submit(self.loop, self.context.__exit__, type, value, traceback), exited, self.loop)
+        
+        
+    enter = __aenter__
+    exit = __aexit__
+    
+    
+    def enter_context(self):
+        if self.writable:
+            self.context = self.aenv.env.write()
+        else:
+            self.context = self.aenv.env.read()
+        self.context.__enter__()
+        
+        
+    def release(self):
+        if self.owns_worker and self.worker is not None:
+            self.owns_worker = False
+            self.aenv.pool.release(self.worker)
+            
+            
+    def abandon(self):
+        """Abort the context on the worker and release the worker."""
+        error = asyncio.CancelledError()
+        done = self.worker.submit(self.loop, self.context.__exit__, type(error), error, None)
+        done.add_done_callback(lambda f: self.release())
+        
+        
+    def call(self, fn, *args, **kwargs):
+        return self.worker.submit(self.loop, fn, *args, **kwargs)
+        
+        
+class AsyncCursor(object):
+    """Iterates a cursor created and read on a context's worker, fetching
+    ``batch_size`` rows per round trip."""
+    
+    def __init__(self, context, factory, args, kwargs, batch_size):
+        self.context = context
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.batch_size = batch_size
+        self.iterator = None
+        self.buffer = deque()
+        self.exhausted = False
+        
+        
+    def next_batch(self):
+        """Return a future for the next batch of rows. The batch is empty once
+        the cursor is exhausted."""
+        return self.context.call(self.fetch)
+        
+        
+    def all(self):
+        return self.context.call(lambda: list(self.factory(*self.args, **self.kwargs)))
+        
+        
+    def fetch(self):
+        if self.iterator is None:
+            self.iterator = iter(self.factory(*self.args, **self.kwargs))
+        return list(islice(self.iterator, self.batch_size))
+        
+        
+    def __aiter__(self):
+        return self
+        
+        
+    def __anext__(self):
+        loop = self.context.loop
+        if self.buffer:
+            return completed(loop, self.buffer.popleft())
+        if self.exhausted:
+            future = asyncio.Future(loop=loop)
+            future.set_exception(StopAsyncIteration())
+            return future
+            
+        def fill(f):
+            batch = f.result()
+            if len(batch) < self.batch_size:
+                self.exhausted = True
+            if not batch:
+                raise StopAsyncIteration()
+            self.buffer.extend(batch)
+            return self.buffer.popleft()
+            
+        return chain(self.next_batch(), fill, loop)
+        
\ No newline at end of file
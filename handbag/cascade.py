@@ -0,0 +1,101 @@
+import itertools
+import functools
+
+
+class CascadeDelete(object):
+    """Removes model instances together with everything that cascades from
+    them. Rows are removed from each table, along with their index entries,
+    in sorted batches of at most ``batch_size`` ids. The cascade graph is 
+    walked depth-first: the instances that cascade from a batch are removed
+    before the next batch is, so only the pending work of the batches on the
+    current path is held in memory. Children of one-to-many and many-to-many
+    relationships are read a batch at a time, so the number of ids held 
+    doesn't grow with the number of children.
+    """
+    
+    def __init__(self, env, batch_size=1000):
+        self.env = env
+        self.batch_size = batch_size
+        self.frame = None
+        
+        
+    def remove(self, model, ids):
+        stack = [self.iter_batches(model, list(ids))]
+        while stack:
+            item = next(stack[-1], None)
+            if item is None:
+                stack.pop()
+                continue
+            model, ids, forget = item
+            missing, frame = self.remove_batch(model, ids)
+            if missing and forget:
+                forget(missing)
+            if frame.ids or frame.scans:
+                stack.append(self.iter_frame(frame))
+                
+                
+    def enqueue(self, model, ids):
+        self.frame.ids.setdefault(model, []).extend(ids)
+        
+        
+    def enqueue_scan(self, rel, owner_id):
+        self.frame.scans.append((rel, owner_id))
+        
+        
+    def iter_batches(self, model, ids):
+        for start in xrange(0, len(ids), self.batch_size):
+            yield model, ids[start:start + self.batch_size], None
+            
+            
+    def iter_frame(self, frame):
+        """Yield the batches that cascade from a removed batch. Scans read
+        the next batch of children once the previous one, and everything 
+        that cascades from it, has been removed."""
+        for model, ids in frame.ids.items():
+            for item in self.iter_batches(model, ids):
+                yield item
+        for rel, owner_id in frame.scans:
+            model = rel.get_target_model()
+            forget = functools.partial(rel.forget_cascade_ids, owner_id)
+            while True:
+                ids = list(itertools.islice(rel.iter_ids(owner_id), self.batch_size))
+                if not ids:
+                    break
+                yield model, ids, forget
+                
+                
+    def remove_batch(self, model, ids):
+        """Remove the instances of ``ids`` that exist. Returns the ids that
+        don't and a :class:`CascadeFrame` with what cascades from the rest."""
+        docs = model.table.get_many(ids)
+        missing = [id for id in ids if id not in docs]
+        docs = [docs[id] for id in sorted(docs, key=lambda id: model.table.dump_key(id))]
+        
+        frame = self.frame = CascadeFrame()
+        try:
+            for doc in docs:
+                doc_model = model.get_model_for(doc)
+                for name, rel in doc_model.relationships:
+                    rel.on_owner_remove(doc['id'], doc, self)
+        finally:
+            self.frame = None
+        
+        model.table.remove_many(docs)
+        
+        context = self.env.current_context()
+        for doc in docs:
+            context.discard(doc['id'])
+            for inst in self.env.instances[doc['id']]:
+                inst.mark_removed()
+        
+        return missing, frame
+        
+        
+class CascadeFrame(object):
+    """What cascades from one removed batch: ids to remove by model and 
+    (relationship, owner id) pairs whose children are to be removed."""
+    
+    def __init__(self):
+        self.ids = {}
+        self.scans = []
+        
@@ -0,0 +1,340 @@
+"""
+A change log of table and edge writes, and a replicator that applies it to a
+second database::
+    
+    env = environment.open('lmdb:///data/main', changelog=True)
+    replica = environment.open('lmdb:///data/replica')
+    # define the same models on both
+    replicator = env.replicate_to(replica)
+    replicator.start()
+    
+With ``changelog=True`` every ``Table.save``/``remove`` and every edge added
+or removed appends an entry to the ``_changelog`` namespace in the same
+transaction. The replicator reads the entries after its position in batches
+and applies them to the replica in one write transaction per batch, storing
+the new position in the same transaction. Long reports can then run on the
+replica without pinning old pages in the main database.
+
+Changes can also be consumed in process. ``Model.changes(since)`` and
+:meth:`ChangeLog.changes` read the changes after a sequence number, which
+callers keep as their token, and ``env.subscribe(callback)`` calls
+``callback`` with the new changes after each write transaction commits::
+    
+    def invalidate(changes):
+        for change in changes:
+            cache.pop(change['id'], None)
+    env.subscribe(invalidate, [Session])
+    
+:meth:`ChangeLog.retain` deletes old entries to bound the log's size.
+
+A replica can start from a backup: ``env.backup(path)`` copies the change
+log along with the data, and a replicator whose replica has no position yet
+starts after the last entry of the copied log. The replica's tables and
+indexes must be defined before the replicator is created, and the replicator
+must be created before the replica is first used.
+"""
+
+import time
+import struct
+import logging
+import threading
+from itertools import islice
+import dson
+
+
+NAMESPACE = '_changelog'
+POSITION_NAMESPACE = '_replication'
+POSITION_KEY = 'position'
+
+log = logging.getLogger(__name__)
+
+
+def dump_seq(seq):
+    return struct.pack('>Q', seq)
+    
+    
+def load_seq(key):
+    return struct.unpack('>Q', key)[0]
+    
+    
+def last_seq(dbm):
+    cur = dbm.cursor(NAMESPACE)
+    if cur.last():
+        return load_seq(cur.key())
+    return 0
+    
+    
+class ReplicaBehind(Exception):
+    pass
+    
+    
+class ChangeLog(object):
+    """Entries are dicts with an ``op``, the ``time`` they were written and
+    the arguments of the operation, keyed by an increasing sequence number.
+    Saves carry the encoded document rather than encoding it a second time."""
+    
+    def __init__(self, dbm):
+        self.dbm = dbm
+        self.dbm.add_namespace(NAMESPACE)
+        self.subscribers = []
+        self.notified = None
+        self._notify_lock = threading.RLock()
+        
+        
+    def append(self, op, **entry):
+        entry['op'] = op
+        entry['time'] = time.time()
+        self.dbm.put(NAMESPACE, dump_seq(self.last_seq() + 1), dson.dumps(entry))
+        
+        
+    def last_seq(self):
+        return last_seq(self.dbm)
+        
+        
+    def first_seq(self):
+        cur = self.dbm.cursor(NAMESPACE)
+        if cur.first():
+            return load_seq(cur.key())
+        return 0
+        
+        
+    def read(self, after=0, limit=None):
+        """Yield (seq, entry) for up to ``limit`` entries after ``after``."""
+        cur = self.dbm.cursor(NAMESPACE)
+        if not cur.jump(dump_seq(after + 1)):
+            return
+        for key, value in islice(cur.iternext(), limit):
+            yield load_seq(key), dson.loads(value)
+            
+            
+    def changes(self, after=0, tables=None, limit=None):
+        """Yield the changes after ``after`` as dicts with their ``seq``,
+        ``op``, ``time`` and either the ``table`` and ``id`` (None after
+        ``remove_all``) or, for edges, the ``store``, ``side``, ``owner`` and
+        ``target``. ``remove_many`` yields a ``remove`` for each id. With
+        ``tables`` only the changes to those tables are yielded. ``limit``
+        bounds the number of log entries read."""
+        for seq, entry in self.read(after, limit):
+            if tables is not None and entry.get('table') not in tables:
+                continue
+            entry.pop('value', None)
+            entry['seq'] = seq
+            if entry['op'] == 'remove_many':
+                for id in entry.pop('ids'):
+                    yield dict(entry, op='remove', id=id)
+            else:
+                if entry['op'] == 'remove_all':
+                    entry['id'] = None
+                yield entry
+                
+                
+    def retain(self, max_entries=None, max_age=None):
+        """Delete the entries beyond the newest ``max_entries`` or older than
+        ``max_age`` seconds. Returns the number deleted."""
+        last = self.last_seq()
+        upto = 0
+        if max_entries is not None:
+            upto = max(last - max_entries, 0)
+        if max_age is not None:
+            cutoff = time.time() - max_age
+            for seq, entry in self.read(upto):
+                if entry['time'] >= cutoff:
+                    break
+                upto = seq
+        if upto <= 0:
+            return 0
+        first = self.first_seq()
+        self.truncate(upto)
+        return max(min(upto, last - 1) - first + 1, 0)
+        
+        
+    def subscribe(self, callback, tables=None):
+        """Call ``callback`` with a list of :meth:`changes` after each write
+        transaction that changed ``tables`` (all by default) commits.
+        Subscribers are called in commit order on the committing thread,
+        after the commit, so an exception raised by one is logged and the
+        other subscribers are still called."""
+        with self._notify_lock:
+            if self.notified is None:
+                self.notified = self._read(self.last_seq)
+            self.subscribers.append((callback, set(tables) if tables is not None else None))
+            
+            
+    def unsubscribe(self, callback):
+        with self._notify_lock:
+            self.subscribers = [s for s in self.subscribers if s[0] != callback]
+            
+            
+    def notify(self):
+        """Pass the changes committed since the last call to the subscribers.
+        Does nothing inside a transaction, so only the outermost commit
+        notifies."""
+        if not self.subscribers or self.dbm.in_transaction():
+            return
+        with self._notify_lock:
+            changes = self._read(lambda: list(self.changes(self.notified)))
+            if not changes:
+                return
+            self.notified = changes[-1]['seq']
+            for callback, tables in list(self.subscribers):
+                if tables is not None:
+                    selected = [c for c in changes if c.get('table') in tables]
+                    if not selected:
+                        continue
+                else:
+                    selected = changes
+                try:
+                    callback(selected)
+                except Exception:
+                    log.exception("Change log subscriber %r failed", callback)
+                        
+                        
+    def _read(self, fn):
+        if self.dbm.in_transaction():
+            return fn()
+        self.dbm.transaction_start()
+        try:
+            return fn()
+        finally:
+            self.dbm.transaction_commit()
+            
+            
+    def truncate(self, upto):
+        """Delete the entries up to and including ``upto``. The last entry is
+        always kept so sequence numbers keep increasing."""
+        upto = min(upto, self.last_seq() - 1)
+        cur = self.dbm.cursor(NAMESPACE)
+        keys = []
+        for key, value in cur.iternext():
+            if load_seq(key) > upto:
+                break
+            keys.append(key)
+        for key in keys:
+            self.dbm.delete(NAMESPACE, key)
+            
+            
+class Replicator(object):
+    """Applies the change log of ``source`` to ``replica`` (both databases),
+    ``batch_size`` entries per transaction. :meth:`start` runs it on a
+    thread that polls every ``interval`` seconds while caught up. With
+    ``truncate`` the applied entries are deleted from the source's log."""
+    
+    def __init__(self, source, replica, batch_size=1000, interval=0.1, truncate=False):
+        assert source.changelog is not None, "The source database must be opened with changelog=True"
+        self.source = source
+        self.replica = replica
+        self.batch_size = batch_size
+        self.interval = interval
+        self.truncate = truncate
+        self.position = None
+        self.error = None
+        self.replica.dbm.add_namespace(POSITION_NAMESPACE)
+        self.replica.dbm.add_namespace(NAMESPACE, create=False)
+        self._thread = None
+        self._stop = threading.Event()
+        
+        
+    def get_position(self):
+        """The sequence number of the last entry applied to the replica."""
+        if self.position is None:
+            dbm = self.replica.dbm
+            with self.replica.read():
+                value = dbm.get(POSITION_NAMESPACE, POSITION_KEY)
+                if value is not None:
+                    self.position = load_seq(value)
+                elif dbm.has_namespace(NAMESPACE):
+                    self.position = last_seq(dbm)
+                else:
+                    self.position = 0
+        return self.position
+        
+        
+    def poll(self):
+        """Apply the next batch of entries. Returns the number applied."""
+        position = self.get_position()
+        changelog = self.source.changelog
+        with self.source.read():
+            entries = list(changelog.read(position, self.batch_size))
+            if (entries and entries[0][0] != position + 1) or (not entries and changelog.last_seq() > position):
+                raise ReplicaBehind, "The change log no longer has entry %d, restore the replica from a backup" % (position + 1)
+        if not entries:
+            return 0
+        with self.replica.write():
+            for seq, entry in entries:
+                self.apply(entry)
+            self.replica.dbm.put(POSITION_NAMESPACE, POSITION_KEY, dump_seq(entries[-1][0]))
+        self.position = entries[-1][0]
+        if self.truncate:
+            with self.source.write():
+                changelog.truncate(self.position)
+        return len(entries)
+        
+        
+    def apply(self, entry):
+        op = entry['op']
+        if op.startswith('edge_'):
+            edges = self.replica.get_edge_store(entry['store'], entry['sides'])
+            if op == 'edge_add':
+                edges.add(entry['side'], entry['owner'], entry['target'])
+            elif op == 'edge_remove':
+                edges.remove(entry['side'], entry['owner'], entry['target'])
+            elif op == 'edge_remove_all':
+                edges.remove_all(entry['side'], entry['owner'])
+            return
+        table = self.replica.get_table(entry['table'])
+        if op == 'save':
+            table.save(dson.loads(entry['value']))
+        elif op == 'remove':
+            if table.get(entry['id']) is not None:
+                table.remove(entry['id'])
+        elif op == 'remove_many':
+            table.remove_many(table.get_many(entry['ids']).values())
+        elif op == 'remove_all':
+            table.remove_all()
+            
+            
+    def lag(self):
+        """Return how many entries the replica is behind and the age in
+        seconds of the oldest one it hasn't applied."""
+        position = self.get_position()
+        changelog = self.source.changelog
+        with self.source.read():
+            behind = max(changelog.last_seq() - position, 0)
+            pending = list(changelog.read(position, 1))
+        seconds = time.time() - pending[0][1]['time'] if pending else 0.0
+        return {'entries': behind, 'seconds': seconds}
+        
+        
+    def catch_up(self):
+        """Apply entries until there are none left."""
+        total = 0
+        while True:
+            applied = self.poll()
+            total += applied
+            if applied < self.batch_size:
+                return total
+                
+                
+    def start(self):
+        assert self._thread is None, "The replicator is already running"
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="handbag-replicator")
+        self._thread.daemon = True
+        self._thread.start()
+        
+        
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            
+            
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                if self.poll() < self.batch_size:
+                    self._stop.wait(self.interval)
+        except Exception, e:
+            self.error = e
+            
\ No newline at end of file
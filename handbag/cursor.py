@@ -1,6 +1,7 @@
 import dson
 import random
 import math
+import functools
 
 
 class Cursor(object):
@@ -9,9 +10,14 @@ class Cursor(object):
         self.dbm = dbm
         self.name = name
         self.reverse = reverse
+        self.decode = dson.loads
         self._cursor = None
         
         
+    def project(self, include=None, exclude=None):
+        self.decode = functools.partial(dson.loads_fields, include=include, exclude=exclude)
+        
+        
     def next(self):
         if not self._cursor:
             self._cursor = self._create_cursor()
@@ -84,6 +90,21 @@ class Cursor(object):
         return self.get_iterator('all')
         
         
+    def batches(self, size=1000):
+        """Iterate over every entry in lists of up to ``size`` loaded 
+        values."""
+        cursor = self._create_cursor()
+        if self.reverse:
+            cursor.last()
+            batches = cursor.iterprev_batch(size)
+        else:
+            cursor.first()
+            batches = cursor.iternext_batch(size)
+        load = self.load
+        for batch in batches:
+            yield [load(v) for k, v in batch]
+        
+        
     def range(self, start=None, end=None):
         if start is None and end is None:
             return self.__iter__()
@@ -128,14 +149,15 @@ class Cursor(object):
         
         
     def load(self, data):
-        return dson.loads(data)
+        return self.decode(data)
         
         
     def get_iterator(self, name, *args):
         forward, backward = iterators.get(name)
         iterator = backward if self.reverse else forward
+        load = self.load
         for k,v in iterator(self._create_cursor(), *args):
-            yield self.load(v)
+            yield load(v)
             
             
     def get_count_with_iterator(self, name, *args):
@@ -1,18 +1,26 @@
+import time
 import threading
 import dbm
 from table import Table
+from edges import EdgeStore
+from changelog import ChangeLog
 
 
-def open(url):
-    return Database(dbm.open(url))
+def open(url, changelog=False):
+    return Database(dbm.open(url), changelog)
 
 
 class Database(object):
+    """With ``changelog`` every table and edge change is also recorded in a
+    :class:`~handbag.changelog.ChangeLog` for replicas to apply."""
     
-    def __init__(self, dbm):
+    def __init__(self, dbm, changelog=False):
         self.dbm = dbm
+        self.changelog = ChangeLog(dbm) if changelog else None
         self.tables = {}
+        self.edge_stores = {}
         self.indexes_synced = False
+        self._sync_lock = threading.Lock()
         
         
     def read(self):
@@ -22,7 +30,28 @@ class Database(object):
         
     def write(self):
         self.ensure_indexes_synced()
-        return DatabaseContext(self.dbm, writable=True)
+        return DatabaseContext(self.dbm, writable=True, changelog=self.changelog)
+        
+        
+    def transaction(self, fn, *args, **kwargs):
+        """Call ``fn`` in a write transaction and return its result. If the
+        dbm was opened with group commit, concurrent calls are committed 
+        together on the dbm's writer thread."""
+        self.ensure_indexes_synced()
+        result = self.dbm.run_write(fn, *args, **kwargs)
+        if self.changelog:
+            self.changelog.notify()
+        return result
+        
+        
+    def subscribe(self, callback, tables=None):
+        """See :meth:`~handbag.changelog.ChangeLog.subscribe`."""
+        assert self.changelog is not None, "The database must be opened with changelog=True"
+        self.changelog.subscribe(callback, tables)
+        
+        
+    def unsubscribe(self, callback):
+        self.changelog.unsubscribe(callback)
         
         
     def __getattr__(self, name):
@@ -35,10 +64,37 @@ class Database(object):
         
     def get_table(self, name):
         if name not in self.tables:
-            self.tables[name] = Table(self.dbm, name)
+            self.tables[name] = Table(self.dbm, name, self.changelog)
         return self.tables[name]
         
         
+    def get_edge_store(self, name, sides):
+        if name not in self.edge_stores:
+            self.edge_stores[name] = EdgeStore(self.dbm, name, sides, self.changelog)
+        return self.edge_stores[name]
+        
+        
+    def sync(self):
+        """Flush committed transactions to disk. Only needed when the dbm
+        was opened with deferred durability (e.g. ``sync=0``)."""
+        self.dbm.sync()
+        
+        
+    def backup(self, path, compact=True):
+        """Copy a consistent snapshot of the database to ``path`` while 
+        writers carry on. With ``compact`` free space is left out of the copy.
+        Returns the number of bytes written, the seconds taken and the 
+        throughput."""
+        start = time.time()
+        return backup_stats(self.dbm.backup(path, compact), time.time() - start)
+        
+        
+    def backup_to(self, fileobj, compact=True):
+        """Like :meth:`backup` but streams the copy to a file object."""
+        start = time.time()
+        return backup_stats(self.dbm.backup_to(fileobj, compact), time.time() - start)
+        
+        
     def close(self):
         self.dbm.close()
         
@@ -46,17 +102,33 @@ class Database(object):
     def ensure_indexes_synced(self):
         if self.indexes_synced:
             return
-        self.indexes_synced = True
-        
-        for table in self.tables.values():
-            table.indexes.sync()
-        
-        
+        with self._sync_lock:
+            if self.indexes_synced:
+                return
+            
+            for edge_store in self.edge_stores.values():
+                edge_store.migrate()
+            
+            for table in self.tables.values():
+                table.indexes.sync()
+            
+            self.indexes_synced = True
+        
+        
+def backup_stats(size, seconds):
+    return {
+        'bytes': size,
+        'seconds': seconds,
+        'bytes_per_second': size / seconds if seconds else None
+    }
+    
+    
 class DatabaseContext(object):
     
-    def __init__(self, dbm, writable=False):
+    def __init__(self, dbm, writable=False, changelog=None):
         self.dbm = dbm
         self.writable = writable
+        self.changelog = changelog
         self.is_dummy = False
         
         
@@ -74,4 +146,6 @@ class DatabaseContext(object):
             self.dbm.transaction_abort()
         else:
             self.dbm.transaction_commit()
+            if self.changelog:
+                self.changelog.notify()
             
\ No newline at end of file
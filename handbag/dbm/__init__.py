@@ -1,10 +1,16 @@
 from urlparse import urlparse
 from lmdbdbm import LMDBDBM
+from memorydbm import MemoryDBM
+from shardeddbm import ShardedDBM
+import cachingdbm
+import instrumenteddbm
 
 __all__ = ['backends', 'open']
 
 backends = {
-    'lmdb': LMDBDBM
+    'lmdb': LMDBDBM,
+    'memory': MemoryDBM,
+    'sharded': ShardedDBM
 }
 
 
@@ -13,4 +19,5 @@ def open(url):
     if parsed_url.scheme not in backends:
         raise Exception, "No backend found for scheme '%s'" % parsed_url.scheme
     dbm_cls = backends[parsed_url.scheme]
-    return dbm_cls(parsed_url)
\ No newline at end of file
+    dbm = cachingdbm.wrap(dbm_cls(parsed_url), parsed_url)
+    return instrumenteddbm.wrap(dbm, parsed_url)
\ No newline at end of file
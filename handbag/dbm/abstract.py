@@ -1,10 +1,17 @@
+from itertools import islice
+
+
 class AbstractDBM(object):
     
     def __init__(self, path):
         raise NotImplementedError
         
     
-    def add_namespace(self, namespace, duplicate_keys=False):
+    def add_namespace(self, namespace, duplicate_keys=False, create=True):
+        raise NotImplementedError
+        
+        
+    def has_namespace(self, namespace):
         raise NotImplementedError
         
     
@@ -28,6 +35,18 @@ class AbstractDBM(object):
         raise NotImplementedError
         
         
+    def run_write(self, fn, *args, **kwargs):
+        """Call ``fn`` in a write transaction and return its result."""
+        self.transaction_start(writable=True)
+        try:
+            result = fn(*args, **kwargs)
+        except:
+            self.transaction_abort()
+            raise
+        self.transaction_commit()
+        return result
+        
+        
     def put(self, namespace, key, value):
         raise NotImplementedError
         
@@ -44,6 +63,13 @@ class AbstractDBM(object):
         raise NotImplementedError
         
         
+    def get_decoded(self, namespace, key, decode):
+        """Return ``decode(value)`` for the value of ``key``, or None."""
+        value = self.get(namespace, key)
+        if value is not None:
+            return decode(value)
+        
+        
     def cursor(self, namespace):
         raise NotImplementedError
         
@@ -52,6 +78,21 @@ class AbstractDBM(object):
         raise NotImplementedError
         
         
+    def sync(self):
+        raise NotImplementedError
+        
+        
+    def backup(self, path, compact=True):
+        """Copy a consistent snapshot of the store to ``path`` without
+        blocking writers. Returns the number of bytes written."""
+        raise NotImplementedError
+        
+        
+    def backup_to(self, fileobj, compact=True):
+        """Like :meth:`backup` but writes the copy to a file object."""
+        raise NotImplementedError
+        
+        
     def close(self):
         raise NotImplementedError
         
@@ -79,6 +120,10 @@ class AbstractDBMCursor(object):
         raise NotImplementedError
         
         
+    def jump_dup(self, key, value):
+        raise NotImplementedError
+        
+        
     def key(self):
         raise NotImplementedError
         
@@ -93,4 +138,33 @@ class AbstractDBMCursor(object):
         
     def iterprev(self):
         raise NotImplementedError
-        
\ No newline at end of file
+        
+        
+    def iternext_batch(self, size=1000):
+        """Like :meth:`iternext` but yields lists of up to ``size`` 
+        (key, value) pairs."""
+        return iter_batches(self.iternext(), size)
+        
+        
+    def iterprev_batch(self, size=1000):
+        return iter_batches(self.iterprev(), size)
+        
+        
+def iter_batches(iterator, size):
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+    
+    
+def parse_size(value):
+    multipliers = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3}
+    value = value.strip().upper().rstrip('B')
+    if value and value[-1] in multipliers:
+        return int(float(value[:-1]) * multipliers[value[-1]])
+    return int(value)
+    
+    
+def parse_bool(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
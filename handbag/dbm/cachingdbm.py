@@ -0,0 +1,320 @@
+import threading
+import datetime
+from copy import deepcopy
+from collections import OrderedDict
+from urlparse import parse_qsl
+from abstract import AbstractDBM, parse_size, parse_bool
+
+
+def wrap(dbm, url):
+    """Wrap ``dbm`` in a :class:`CachingDBM` if the URL asks for a cache with
+    ``cache`` (the maximum number of entries) or ``cache_bytes``. Set
+    ``cache_docs=1`` to cache decoded documents too."""
+    options = dict(parse_qsl(url.query))
+    if 'cache' not in options and 'cache_bytes' not in options:
+        return dbm
+    return CachingDBM(dbm,
+        max_entries=int(options.get('cache', 0)) or None,
+        max_bytes=parse_size(options.get('cache_bytes', '0')) or None,
+        cache_docs=parse_bool(options.get('cache_docs', '0')))
+        
+        
+# Field values that can be shared between copies of a cached document.
+IMMUTABLE_TYPES = frozenset([type(None), bool, int, long, float, str, unicode,
+    datetime.datetime, datetime.date, datetime.time])
+
+
+def copy_doc(doc):
+    """Copy a cached document so that changing the copy, nested values
+    included, leaves the cached one alone. Only the values that aren't
+    immutable are deep copied, as those are usually few."""
+    if type(doc) is not dict:
+        return deepcopy(doc)
+    doc = dict(doc)
+    for name, value in doc.iteritems():
+        if type(value) not in IMMUTABLE_TYPES:
+            doc[name] = deepcopy(value)
+    return doc
+    
+    
+class CacheTransaction(object):
+    
+    __slots__ = ('writable', 'version', 'dirty', 'cleared')
+    
+    def __init__(self, writable, version):
+        self.writable = writable
+        self.version = version
+        self.dirty = set()
+        self.cleared = set()
+        
+        
+class CachingDBM(AbstractDBM):
+    """Wraps another DBM and keeps the values returned by :meth:`get` in an
+    LRU cache shared by all threads, evicting the least recently used entries
+    once there are more than ``max_entries`` or they add up to more than
+    ``max_bytes``. Missing keys are cached too. With ``cache_docs`` the
+    documents decoded by :meth:`get_decoded` are kept as well; callers get a
+    copy, so changing it doesn't change the cache.
+    
+    The cache only holds committed values. A transaction reads through it
+    while no write has been committed since the transaction started, and
+    skips it for the keys it has written itself. Committing a write
+    transaction removes the keys it wrote, so aborting one leaves the cache
+    untouched. Cursors read the wrapped DBM directly.
+    """
+    
+    def __init__(self, dbm, max_entries=10000, max_bytes=None, cache_docs=False):
+        self.dbm = dbm
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cache_docs = cache_docs
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._version = 0
+        self._committing = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        
+        
+    def add_namespace(self, namespace, duplicate_keys=False, create=True):
+        self.dbm.add_namespace(namespace, duplicate_keys, create)
+        
+        
+    def has_namespace(self, namespace):
+        return self.dbm.has_namespace(namespace)
+        
+        
+    def transaction_start(self, writable=False):
+        transactions = self._get_local_transactions()
+        if transactions:
+            version = transactions[-1].version
+        else:
+            version = self._version
+        txn = self.dbm.transaction_start(writable)
+        transactions.append(CacheTransaction(writable, version))
+        return txn
+        
+        
+    def transaction_commit(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        txn = transactions[-1]
+        if len(transactions) > 1:
+            try:
+                self.dbm.transaction_commit()
+            finally:
+                transactions.pop()
+            transactions[-1].dirty.update(txn.dirty)
+            transactions[-1].cleared.update(txn.cleared)
+        elif txn.dirty or txn.cleared:
+            self._begin_invalidation(txn)
+            try:
+                self.dbm.transaction_commit()
+            finally:
+                transactions.pop()
+                self._end_invalidation()
+        else:
+            try:
+                self.dbm.transaction_commit()
+            finally:
+                transactions.pop()
+                
+                
+    def transaction_abort(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        try:
+            self.dbm.transaction_abort()
+        finally:
+            transactions.pop()
+            
+            
+    def in_transaction(self):
+        return self.dbm.in_transaction()
+        
+        
+    def is_transaction_writable(self):
+        return self.dbm.is_transaction_writable()
+        
+        
+    def run_write(self, fn, *args, **kwargs):
+        if self.in_transaction():
+            return super(CachingDBM, self).run_write(fn, *args, **kwargs)
+        committing = []
+        
+        # The wrapped DBM may run fn on another thread (with group commit) and
+        # starts the transaction itself, so track fn's writes here instead.
+        def tracked():
+            transactions = self._get_local_transactions()
+            transactions.append(CacheTransaction(True, self._version))
+            try:
+                result = fn(*args, **kwargs)
+            finally:
+                txn = transactions.pop()
+            if txn.dirty or txn.cleared:
+                self._begin_invalidation(txn)
+                committing.append(txn)
+            return result
+            
+        try:
+            return self.dbm.run_write(tracked)
+        finally:
+            if committing:
+                self._end_invalidation()
+                
+                
+    def put(self, namespace, key, value):
+        self._current_transaction().dirty.add((namespace, key))
+        self.dbm.put(namespace, key, value)
+        
+        
+    def delete(self, namespace, key, value=None):
+        self._current_transaction().dirty.add((namespace, key))
+        self.dbm.delete(namespace, key, value)
+        
+        
+    def delete_all(self, namespace):
+        self._current_transaction().cleared.add(namespace)
+        self.dbm.delete_all(namespace)
+        
+        
+    def get(self, namespace, key):
+        return self._get(namespace, key)[0]
+        
+        
+    def get_decoded(self, namespace, key, decode):
+        if not self.cache_docs:
+            return super(CachingDBM, self).get_decoded(namespace, key, decode)
+        entry = self._get(namespace, key)
+        if entry[0] is None:
+            return None
+        if entry[2] is None:
+            entry[2] = decode(entry[0])
+        return copy_doc(entry[2])
+        
+        
+    def cursor(self, namespace):
+        return self.dbm.cursor(namespace)
+        
+        
+    def count(self, namespace):
+        return self.dbm.count(namespace)
+        
+        
+    def sync(self):
+        self.dbm.sync()
+        
+        
+    def backup(self, path, compact=True):
+        return self.dbm.backup(path, compact)
+        
+        
+    def backup_to(self, fileobj, compact=True):
+        return self.dbm.backup_to(fileobj, compact)
+        
+        
+    def close(self):
+        self.clear()
+        self.dbm.close()
+        
+        
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            
+            
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+        
+        
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate(),
+            'entries': len(self._entries),
+            'bytes': self._bytes
+        }
+        
+        
+    def _get(self, namespace, key):
+        """Return the cache entry, a list of (value, size, decoded doc)."""
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        cache_key = (namespace, key)
+        for txn in transactions:
+            if txn.writable and (cache_key in txn.dirty or namespace in txn.cleared):
+                with self._lock:
+                    self.misses += 1
+                return [self.dbm.get(namespace, key), 0, None]
+        version = transactions[-1].version
+        with self._lock:
+            if version == self._version:
+                entry = self._entries.pop(cache_key, None)
+                if entry is not None:
+                    self._entries[cache_key] = entry
+                    self.hits += 1
+                    return entry
+            self.misses += 1
+        value = self.dbm.get(namespace, key)
+        entry = [value, len(key) + len(value or ''), None]
+        with self._lock:
+            if version == self._version and not self._committing:
+                self._store(cache_key, entry)
+        return entry
+        
+        
+    def _store(self, cache_key, entry):
+        old = self._entries.pop(cache_key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._entries[cache_key] = entry
+        self._bytes += entry[1]
+        while self._entries and (
+                (self.max_entries and len(self._entries) > self.max_entries) or
+                (self.max_bytes and self._bytes > self.max_bytes)):
+            old = self._entries.popitem(last=False)[1]
+            self._bytes -= old[1]
+            self.evictions += 1
+            
+            
+    def _begin_invalidation(self, txn):
+        """Remove the keys a transaction wrote before it is committed. Nothing
+        is added to the cache until :meth:`_end_invalidation` is called, and
+        transactions started before then don't read from it afterwards."""
+        with self._lock:
+            self._committing += 1
+            for cache_key in txn.dirty:
+                old = self._entries.pop(cache_key, None)
+                if old is not None:
+                    self._bytes -= old[1]
+            if txn.cleared:
+                for cache_key in [k for k in self._entries if k[0] in txn.cleared]:
+                    self._bytes -= self._entries.pop(cache_key)[1]
+                    
+                    
+    def _end_invalidation(self):
+        with self._lock:
+            self._version += 1
+            self._committing -= 1
+            
+            
+    def _current_transaction(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        return transactions[-1]
+        
+        
+    def _get_local_transactions(self):
+        try:
+            return self._local.transactions
+        except AttributeError:
+            self._local.transactions = []
+            return self._local.transactions
+            
\ No newline at end of file
@@ -0,0 +1,156 @@
+import sys
+import threading
+import Queue
+
+
+class WriteRequest(object):
+    
+    def __init__(self, fn, args, kwargs):
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+        self.exc_info = None
+        self.done = threading.Event()
+        
+        
+    def run(self):
+        return self.fn(*self.args, **self.kwargs)
+        
+        
+    def succeed(self, result):
+        self.result = result
+        self.done.set()
+        
+        
+    def fail(self, exc_info):
+        self.exc_info = exc_info
+        self.done.set()
+        
+        
+    def wait(self):
+        self.done.wait()
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.result
+        
+        
+class GroupCommitter(object):
+    """Runs write functions submitted from many threads on a single writer 
+    thread. The functions waiting in the queue are run together in one write 
+    transaction, each in its own nested transaction, so a function that 
+    raises only rolls back its own changes. The group is committed (and 
+    synced) once, then every caller gets its own result or exception."""
+    
+    def __init__(self, dbm, max_batch_size=64):
+        self.dbm = dbm
+        self.max_batch_size = max_batch_size
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+        
+        
+    def submit(self, fn, *args, **kwargs):
+        # Queued before starting, so a writer thread that fails after
+        # draining the queue is replaced by the start() that follows.
+        request = WriteRequest(fn, args, kwargs)
+        self.queue.put(request)
+        self.start()
+        return request.wait()
+        
+        
+    def start(self):
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    thread = threading.Thread(target=self.run, name="handbag-group-commit")
+                    thread.daemon = True
+                    thread.start()
+                    self.thread = thread
+                    
+                    
+    def stop(self):
+        with self.lock:
+            if self.thread is not None:
+                self.queue.put(None)
+                self.thread.join()
+                self.thread = None
+                
+                
+    def run(self):
+        batch = []
+        try:
+            while True:
+                request = self.queue.get()
+                if request is None:
+                    return
+                batch = [request]
+                while len(batch) < self.max_batch_size:
+                    try:
+                        request = self.queue.get_nowait()
+                    except Queue.Empty:
+                        break
+                    if request is None:
+                        self.commit_batch(batch)
+                        return
+                    batch.append(request)
+                self.commit_batch(batch)
+        except:
+            self.fail_all(batch, sys.exc_info())
+            
+            
+    def fail_all(self, batch, exc_info):
+        """Fail the requests of the batch that aren't done and every queued
+        request, after an error the writer thread can't recover from. The 
+        thread exits and the next submit starts another one."""
+        while self.dbm.in_transaction():
+            try:
+                self.dbm.transaction_abort()
+            except:
+                break
+        self.thread = None
+        for request in batch:
+            if not request.done.is_set():
+                request.fail(exc_info)
+        while True:
+            try:
+                request = self.queue.get_nowait()
+            except Queue.Empty:
+                return
+            if request is not None:
+                request.fail(exc_info)
+                
+            
+    def commit_batch(self, batch):
+        try:
+            self.dbm.transaction_start(writable=True)
+        except:
+            exc_info = sys.exc_info()
+            for request in batch:
+                request.fail(exc_info)
+            return
+            
+        succeeded = []
+        depth = self.dbm.transaction_depth()
+        for request in batch:
+            try:
+                self.dbm.transaction_start(writable=True)
+                result = request.run()
+                self.dbm.transaction_commit()
+            except:
+                exc_info = sys.exc_info()
+                if self.dbm.transaction_depth() > depth:
+                    self.dbm.transaction_abort()
+                request.fail(exc_info)
+            else:
+                succeeded.append((request, result))
+                
+        try:
+            self.dbm.transaction_commit()
+        except:
+            exc_info = sys.exc_info()
+            for request, result in succeeded:
+                request.fail(exc_info)
+        else:
+            for request, result in succeeded:
+                request.succeed(result)
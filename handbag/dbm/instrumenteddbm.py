@@ -0,0 +1,392 @@
+import time
+import weakref
+import threading
+from urlparse import parse_qsl
+from abstract import AbstractDBM, AbstractDBMCursor, parse_bool
+
+timer = time.time
+
+# Latency buckets are powers of two in microseconds, the last one open ended.
+BUCKETS = 28
+
+
+def wrap(dbm, url):
+    """Wrap ``dbm`` in an :class:`InstrumentedDBM` if the URL has
+    ``metrics=1``. ``metrics_interval`` sets how often, in seconds, the
+    callback is called (10 by default)."""
+    options = dict(parse_qsl(url.query))
+    if not parse_bool(options.get('metrics', '0')):
+        return dbm
+    return InstrumentedDBM(dbm, interval=float(options.get('metrics_interval', 10)))
+    
+    
+class OpStats(object):
+    
+    __slots__ = ('count', 'seconds', 'bytes', 'histogram')
+    
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.histogram = [0] * BUCKETS
+        
+        
+    def add(self, elapsed, nbytes=0):
+        self.count += 1
+        self.seconds += elapsed
+        self.bytes += nbytes
+        self.histogram[min(int(elapsed * 1000000).bit_length(), BUCKETS - 1)] += 1
+        
+        
+    def clear(self):
+        self.count = 0
+        self.seconds = 0.0
+        self.bytes = 0
+        self.histogram[:] = [0] * BUCKETS
+        
+        
+    def merge(self, other):
+        self.count += other.count
+        self.seconds += other.seconds
+        self.bytes += other.bytes
+        for i, n in enumerate(other.histogram):
+            self.histogram[i] += n
+            
+            
+    def to_dict(self):
+        """The histogram maps the upper bound of each bucket in microseconds
+        (None for the last) to the number of operations in it."""
+        histogram = {}
+        for i, n in enumerate(self.histogram):
+            if n:
+                histogram[2 ** i if i < BUCKETS - 1 else None] = n
+        return {
+            'count': self.count,
+            'seconds': self.seconds,
+            'bytes': self.bytes,
+            'histogram': histogram
+        }
+        
+        
+class ThreadStats(object):
+    """The counters of one thread, so recording never takes a lock."""
+    
+    def __init__(self):
+        self.ops = {}
+        self.transactions = {}
+        self.started = []
+        
+        
+    def op(self, namespace, name):
+        key = (namespace, name)
+        stats = self.ops.get(key)
+        if stats is None:
+            stats = self.ops[key] = OpStats()
+        return stats
+        
+        
+    def transaction(self, kind, outcome):
+        key = (kind, outcome)
+        stats = self.transactions.get(key)
+        if stats is None:
+            stats = self.transactions[key] = OpStats()
+        return stats
+        
+        
+    def merge(self, other):
+        for key, op in other.ops.items():
+            self.op(*key).merge(op)
+        for key, op in other.transactions.items():
+            self.transaction(*key).merge(op)
+            
+            
+    def clear(self):
+        # In place, as open cursors hold on to their step counters.
+        for op in self.ops.values():
+            op.clear()
+        for op in self.transactions.values():
+            op.clear()
+            
+            
+class InstrumentedDBM(AbstractDBM):
+    """Wraps another DBM and records, per namespace, the number, latency and
+    bytes of ``get``, ``put``, ``delete``, ``delete_all``, ``count`` and
+    ``cursor`` calls and the number of cursor steps and bytes they read, plus
+    the duration of top-level transactions by kind (read or write) and
+    outcome (commit or abort). Latencies go into power of two histograms.
+    
+    :meth:`dump` returns everything as a dict. If ``callback`` is set it is
+    called with :meth:`dump` at most every ``interval`` seconds, from a thread
+    that has just finished a transaction.
+    """
+    
+    def __init__(self, dbm, callback=None, interval=10):
+        self.dbm = dbm
+        self.callback = callback
+        self.interval = interval
+        self._next_report = timer() + interval
+        self._report_lock = threading.Lock()
+        self._threads = []
+        self._retired = ThreadStats()
+        self._threads_lock = threading.Lock()
+        self._local = threading.local()
+        
+        
+    def add_namespace(self, namespace, duplicate_keys=False, create=True):
+        self.dbm.add_namespace(namespace, duplicate_keys, create)
+        
+        
+    def has_namespace(self, namespace):
+        return self.dbm.has_namespace(namespace)
+        
+        
+    def transaction_start(self, writable=False):
+        stats = self._get_local_stats()
+        txn = self.dbm.transaction_start(writable)
+        stats.started.append((timer(), writable))
+        return txn
+        
+        
+    def transaction_commit(self):
+        try:
+            self.dbm.transaction_commit()
+        except:
+            self._finish('abort')
+            raise
+        self._finish('commit')
+        
+        
+    def transaction_abort(self):
+        try:
+            self.dbm.transaction_abort()
+        finally:
+            self._finish('abort')
+            
+            
+    def in_transaction(self):
+        return self.dbm.in_transaction()
+        
+        
+    def is_transaction_writable(self):
+        return self.dbm.is_transaction_writable()
+        
+        
+    def run_write(self, fn, *args, **kwargs):
+        if self.in_transaction():
+            return super(InstrumentedDBM, self).run_write(fn, *args, **kwargs)
+        stats = self._get_local_stats()
+        start = timer()
+        try:
+            result = self.dbm.run_write(fn, *args, **kwargs)
+        except:
+            stats.transaction('write', 'abort').add(timer() - start)
+            raise
+        stats.transaction('write', 'commit').add(timer() - start)
+        self._maybe_report()
+        return result
+        
+        
+    def put(self, namespace, key, value):
+        start = timer()
+        self.dbm.put(namespace, key, value)
+        self._get_local_stats().op(namespace, 'put').add(timer() - start, len(key) + len(value))
+        
+        
+    def delete(self, namespace, key, value=None):
+        start = timer()
+        self.dbm.delete(namespace, key, value)
+        self._get_local_stats().op(namespace, 'delete').add(timer() - start)
+        
+        
+    def delete_all(self, namespace):
+        start = timer()
+        self.dbm.delete_all(namespace)
+        self._get_local_stats().op(namespace, 'delete_all').add(timer() - start)
+        
+        
+    def get(self, namespace, key):
+        start = timer()
+        value = self.dbm.get(namespace, key)
+        self._get_local_stats().op(namespace, 'get').add(timer() - start, len(value) if value else 0)
+        return value
+        
+        
+    def get_decoded(self, namespace, key, decode):
+        start = timer()
+        doc = self.dbm.get_decoded(namespace, key, decode)
+        self._get_local_stats().op(namespace, 'get').add(timer() - start)
+        return doc
+        
+        
+    def cursor(self, namespace):
+        start = timer()
+        cur = self.dbm.cursor(namespace)
+        stats = self._get_local_stats()
+        stats.op(namespace, 'cursor').add(timer() - start)
+        return InstrumentedCursor(cur, stats.op(namespace, 'step'))
+        
+        
+    def count(self, namespace):
+        start = timer()
+        n = self.dbm.count(namespace)
+        self._get_local_stats().op(namespace, 'count').add(timer() - start)
+        return n
+        
+        
+    def sync(self):
+        self.dbm.sync()
+        
+        
+    def backup(self, path, compact=True):
+        return self.dbm.backup(path, compact)
+        
+        
+    def backup_to(self, fileobj, compact=True):
+        return self.dbm.backup_to(fileobj, compact)
+        
+        
+    def close(self):
+        self.dbm.close()
+        
+        
+    def dump(self):
+        """Return the totals over all threads as ``{'namespaces': {namespace:
+        {op: stats}}, 'transactions': {kind: {outcome: stats}}}``."""
+        ops = {}
+        transactions = {}
+        with self._threads_lock:
+            self._retire_dead_threads()
+            threads = [stats for thread, stats in self._threads] + [self._retired]
+        for stats in threads:
+            for key, op in stats.ops.items():
+                ops.setdefault(key, OpStats()).merge(op)
+            for key, op in stats.transactions.items():
+                transactions.setdefault(key, OpStats()).merge(op)
+        result = {'namespaces': {}, 'transactions': {}}
+        for (namespace, name), op in ops.items():
+            if op.count:
+                result['namespaces'].setdefault(namespace, {})[name] = op.to_dict()
+        for (kind, outcome), op in transactions.items():
+            if op.count:
+                result['transactions'].setdefault(kind, {})[outcome] = op.to_dict()
+        return result
+        
+        
+    def reset(self):
+        with self._threads_lock:
+            self._retire_dead_threads()
+            for thread, stats in self._threads:
+                stats.clear()
+            self._retired.clear()
+            
+            
+    def _retire_dead_threads(self):
+        """Fold the counters of threads that have finished into the shared
+        total, so that ``_threads`` only grows with the live ones. Must be
+        called with ``_threads_lock`` held."""
+        live = []
+        for thread, stats in self._threads:
+            t = thread()
+            if t is not None and t.is_alive():
+                live.append((thread, stats))
+            else:
+                self._retired.merge(stats)
+        self._threads = live
+        
+                
+    def _finish(self, outcome):
+        stats = self._get_local_stats()
+        start, writable = stats.started.pop()
+        if not stats.started:
+            stats.transaction('write' if writable else 'read', outcome).add(timer() - start)
+            self._maybe_report()
+            
+            
+    def _maybe_report(self):
+        if self.callback is None or timer() < self._next_report:
+            return
+        if not self._report_lock.acquire(False):
+            return
+        try:
+            self._next_report = timer() + self.interval
+            self.callback(self.dump())
+        finally:
+            self._report_lock.release()
+            
+            
+    def _get_local_stats(self):
+        try:
+            return self._local.stats
+        except AttributeError:
+            stats = self._local.stats = ThreadStats()
+            with self._threads_lock:
+                self._retire_dead_threads()
+                self._threads.append((weakref.ref(threading.current_thread()), stats))
+            return stats
+            
+            
+class InstrumentedCursor(AbstractDBMCursor):
+    """Counts the steps a cursor takes and the bytes of the pairs it yields
+    while iterating."""
+    
+    def __init__(self, cur, steps):
+        self._cur = cur
+        self._steps = steps
+        
+        
+    def first(self):
+        self._steps.count += 1
+        return self._cur.first()
+        
+        
+    def last(self):
+        self._steps.count += 1
+        return self._cur.last()
+        
+        
+    def next(self):
+        self._steps.count += 1
+        return self._cur.next()
+        
+        
+    def prev(self):
+        self._steps.count += 1
+        return self._cur.prev()
+        
+        
+    def jump(self, key):
+        self._steps.count += 1
+        return self._cur.jump(key)
+        
+        
+    def jump_dup(self, key, value):
+        self._steps.count += 1
+        return self._cur.jump_dup(key, value)
+        
+        
+    def key(self):
+        return self._cur.key()
+        
+        
+    def value(self):
+        return self._cur.value()
+        
+        
+    def iternext(self):
+        return self._counted(self._cur.iternext())
+        
+        
+    def iterprev(self):
+        return self._counted(self._cur.iterprev())
+        
+        
+    def _counted(self, items):
+        count = nbytes = 0
+        try:
+            for item in items:
+                count += 1
+                nbytes += len(item[0]) + len(item[1])
+                yield item
+        finally:
+            self._steps.count += count
+            self._steps.bytes += nbytes
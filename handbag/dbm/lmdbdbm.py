@@ -1,73 +1,184 @@
+import os
+import sys
 import lmdb
+import weakref
 import threading
-from abstract import AbstractDBM, AbstractDBMCursor
+from urlparse import parse_qsl
+from abstract import AbstractDBM, AbstractDBMCursor, parse_size, parse_bool
+from group import GroupCommitter
+
+BACKUP_CHUNK_SIZE = 1024 * 1024
 
 class LMDBDBM(AbstractDBM):
+    """A DBM backed by LMDB. Options are passed in the URL query string:
+    
+    * ``max_readers`` - the maximum number of concurrent read transactions
+      (126 by default).
+    * ``max_spare_txns`` - the number of finished read transactions LMDB keeps
+      reset for reuse (16 by default). Starting a read renews a spare 
+      transaction instead of allocating a new one and its reader slot.
+    * ``group_commit`` - set to 1 to run the functions passed to 
+      :meth:`run_write` from different threads together on one writer 
+      thread, committing them as a group. ``group_commit_size`` limits the 
+      number of functions per group (64 by default).
+    * ``map_size`` - the initial size of the memory map in bytes, optionally
+      with a K, M or G suffix (2G by default).
+    * ``map_growth`` - when a write fills the map it is multiplied by this
+      factor (2 by default) and the write transaction is retried. Set to 0 to
+      raise ``lmdb.MapFullError`` instead. ``max_map_size`` caps the growth.
+    * ``map_headroom`` - the map is also grown before a write transaction 
+      starts if less than this fraction of it is free (0.25 by default).
+    * ``max_replay_size`` - the most bytes of writes kept for replaying a
+      transaction after the map grows (64M by default). A transaction that
+      writes more raises ``lmdb.MapFullError`` if it fills the map.
+    
+    * ``sync``, ``metasync``, ``map_async``, ``writemap``, ``readahead`` and
+      ``lock`` - set the LMDB environment flags of the same names, e.g. 
+      ``lmdb:///data/db?writemap=1&sync=0``. With ``sync=0`` (or 
+      ``map_async=1`` and ``writemap=1``) committed transactions are only
+      durable after :meth:`sync`. ``lock=0`` turns off LMDB's locking and is 
+      only safe for a single-threaded process that owns the database.
+    
+    Most of the time the map is grown between transactions. When a write
+    fills it anyway, the full write transaction is aborted. Once no other
+    transaction in the process is running, the map is resized and the 
+    transaction's writes are replayed in a new one. Cursors opened in the
+    transaction are moved to the same pair in the new one, and iterators
+    over them carry on from there.
+    """
     
     def __init__(self, url):
         self._path = url.path
+        options = dict(parse_qsl(url.query))
+        self._max_readers = int(options.get('max_readers', 126))
+        self._max_spare_txns = min(int(options.get('max_spare_txns', 16)), self._max_readers)
+        self._map_size = parse_size(options.get('map_size', '2G'))
+        self._map_growth = float(options.get('map_growth', 2))
+        self._max_map_size = parse_size(options.get('max_map_size', '0'))
+        self._map_headroom = float(options.get('map_headroom', 0.25))
+        self._max_replay_size = parse_size(options.get('max_replay_size', '64M'))
+        self._replay_writes = self._map_growth > 1
+        self._flags = dict((k, parse_bool(options.get(k, default))) for k, default in (
+            ('sync', '1'),
+            ('metasync', '1'),
+            ('map_async', '0'),
+            ('writemap', '0'),
+            ('readahead', '1'),
+            ('lock', '1')
+        ))
+        if parse_bool(options.get('group_commit', '0')):
+            self._group_committer = GroupCommitter(self, int(options.get('group_commit_size', 64)))
+        else:
+            self._group_committer = None
         self._env = None
         self._dbs = {}
+        self._dupsort = {}
         self._local = threading.local()
+        self._env_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._gate_lock = threading.Lock()
+        self._gate = threading.Condition(self._gate_lock)
+        self._active = 0
+        self._waiting_to_grow = 0
+        self._generation = 0
         
         
-    def add_namespace(self, namespace, duplicate_keys=False):
+    def add_namespace(self, namespace, duplicate_keys=False, create=True):
         assert self._env is None, "Can't add a namespace after the environment has been opened"
         if namespace not in self._dbs:
             self._dbs[namespace] = {
-                'duplicate_keys': duplicate_keys
+                'duplicate_keys': duplicate_keys,
+                'create': create
             }
+        elif create:
+            self._dbs[namespace]['create'] = True
+            
+            
+    def has_namespace(self, namespace):
+        self._get_env()
+        return self._dbs.get(namespace) is not None
         
     
     def transaction_start(self, writable=False):
-        if len(self._get_local_transactions()) > 0:
-            parent = self._get_local_transactions()[-1][1]
+        transactions = self._get_local_transactions()
+        if transactions:
+            parent = transactions[-1][1]
         else:
             parent = None
-        txn = lmdb.Transaction(self._get_env(), write=writable, parent=parent)
-        self._get_local_transactions().append((writable, txn))
+            if writable:
+                self._write_lock.acquire()
+                try:
+                    self._grow_ahead()
+                except:
+                    self._write_lock.release()
+                    raise
+                self._local.replay_size = 0
+                self._local.cursors = []
+            self._enter_gate()
+        try:
+            txn = lmdb.Transaction(self._get_env(), write=writable, parent=parent)
+        except:
+            if parent is None:
+                self._leave(writable)
+            raise
+        transactions.append((writable, txn, []))
         return txn
         
         
     def transaction_commit(self):
-        self._require_transaction()
-        txn = self._get_local_transactions().pop()[1]
-        txn.commit()
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        cursors = self._open_cursors(transactions)
+        try:
+            transactions[-1][1].commit()
+        except lmdb.MapFullError:
+            self._commit_after_growing(sys.exc_info(), cursors)
+        except:
+            self._finish_transaction(transactions, False)
+            raise
+        self._finish_transaction(transactions, True)
         
         
     def transaction_abort(self):
-        self._require_transaction()
-        txn = self._get_local_transactions().pop()[1]
-        txn.abort()
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        transactions[-1][1].abort()
+        self._finish_transaction(transactions, False)
         
         
     def in_transaction(self):
         return len(self._get_local_transactions()) > 0
         
         
+    def transaction_depth(self):
+        """The number of transactions open on this thread, nested ones 
+        included. A commit that fails ends its transaction."""
+        return len(self._get_local_transactions())
+        
+        
     def is_transaction_writable(self):
         self._require_transaction()
         return self._get_local_transactions()[-1][0]
         
         
+    def run_write(self, fn, *args, **kwargs):
+        if self._group_committer and not self.in_transaction():
+            return self._group_committer.submit(fn, *args, **kwargs)
+        return super(LMDBDBM, self).run_write(fn, *args, **kwargs)
+        
+        
     def put(self, namespace, key, value):
-        db = self._dbs[namespace]
-        txn = self._current_transaction()
-        txn.put(key, value, db=db)
+        self._write(('put', namespace, key, value))
         
         
     def delete(self, namespace, key, value=None):
         if value is None:
             value = ''
-        db = self._dbs[namespace]
-        txn = self._current_transaction()
-        txn.delete(key, value=value, db=db)
+        self._write(('delete', namespace, key, value))
         
         
     def delete_all(self, namespace):
-        db = self._dbs[namespace]
-        txn = self._current_transaction()
-        txn.drop(db, delete=False)
+        self._write(('delete_all', namespace))
         
         
     def get(self, namespace, key):
@@ -80,8 +191,11 @@ class LMDBDBM(AbstractDBM):
     def cursor(self, namespace):
         db = self._dbs[namespace]
         txn = self._current_transaction()
-        cur = txn.cursor(db=db)
-        return LMDBCursor(cur)
+        if not self._replay_writes or not self._get_local_transactions()[0][0]:
+            return LMDBCursor(txn.cursor(db=db))
+        cur = ReplayableCursor(txn, db, self._dupsort[namespace])
+        self._local.cursors.append(weakref.ref(cur))
+        return cur
         
         
     def count(self, namespace):
@@ -90,7 +204,67 @@ class LMDBDBM(AbstractDBM):
         return txn.stat(db)['entries']
         
         
+    def sync(self):
+        self._get_env().sync(True)
+        
+        
+    def backup(self, path, compact=True):
+        """Copy the environment into the directory ``path``, creating it if
+        needed. LMDB copies from its own read transaction, so writers carry 
+        on while it runs. With ``compact`` free pages are left out and the 
+        copy can be much smaller than the original."""
+        env = self._get_env()
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self._enter_gate()
+        try:
+            env.copy(path, compact=compact)
+        finally:
+            self._leave(False)
+        return os.path.getsize(os.path.join(path, 'data.mdb'))
+        
+        
+    def backup_to(self, fileobj, compact=True):
+        """Stream a copy of the environment's data file to ``fileobj``. LMDB
+        writes the copy into a pipe from another thread while this one 
+        copies it to ``fileobj``."""
+        env = self._get_env()
+        read_fd, write_fd = os.pipe()
+        errors = []
+        
+        def copy():
+            try:
+                env.copyfd(write_fd, compact=compact)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                os.close(write_fd)
+                
+        self._enter_gate()
+        try:
+            thread = threading.Thread(target=copy, name="handbag-backup")
+            thread.start()
+            written = 0
+            try:
+                with os.fdopen(read_fd, 'rb') as pipe:
+                    while True:
+                        chunk = pipe.read(BACKUP_CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        fileobj.write(chunk)
+                        written += len(chunk)
+            finally:
+                thread.join()
+        finally:
+            self._leave(False)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return written
+        
+        
     def close(self):
+        if self._group_committer:
+            self._group_committer.stop()
         if self._env:
             self._env.close()
         
@@ -104,28 +278,335 @@ class LMDBDBM(AbstractDBM):
         assert self.in_transaction(), "An active transaction is required"
         
         
+    def _write(self, op):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        cursors = self._open_cursors(transactions)
+        try:
+            self._apply(transactions[-1][1], op)
+        except lmdb.MapFullError:
+            if not self._can_grow():
+                raise
+            self._grow_and_replay(cursors)
+            return self._write(op)
+        if self._replay_writes:
+            self._record(transactions, op)
+            
+            
+    def _record(self, transactions, op):
+        """Keep ``op`` for replaying, unless the transaction has written more
+        than ``max_replay_size``, in which case the log is dropped."""
+        size = self._local.replay_size
+        if size is None:
+            return
+        size += sum(len(part) for part in op[1:])
+        if size > self._max_replay_size:
+            self._local.replay_size = None
+            for writable, txn, ops in transactions:
+                del ops[:]
+            return
+        self._local.replay_size = size
+        transactions[-1][2].append(op)
+        
+        
+    def _commit_after_growing(self, exc_info, cursors):
+        transactions = self._get_local_transactions()
+        while True:
+            if not self._can_grow():
+                self._finish_transaction(transactions, False)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            self._grow_and_replay(cursors)
+            try:
+                transactions[-1][1].commit()
+                return
+            except lmdb.MapFullError:
+                exc_info = sys.exc_info()
+            except:
+                self._finish_transaction(transactions, False)
+                raise
+                
+                
+    def _apply(self, txn, op):
+        db = self._dbs[op[1]]
+        if op[0] == 'put':
+            txn.put(op[2], op[3], db=db)
+        elif op[0] == 'delete':
+            txn.delete(op[2], value=op[3], db=db)
+        else:
+            txn.drop(db, delete=False)
+            
+            
+    def _finish_transaction(self, transactions, committed):
+        writable, txn, ops = transactions.pop()
+        if transactions:
+            if committed and ops:
+                transactions[-1][2].extend(ops)
+        else:
+            if writable:
+                self._local.cursors = []
+            self._leave(writable)
+            
+            
+    def _enter_gate(self):
+        with self._gate_lock:
+            while self._waiting_to_grow:
+                self._gate.wait()
+            self._active += 1
+            
+            
+    def _leave(self, writable):
+        with self._gate_lock:
+            self._active -= 1
+            if self._waiting_to_grow:
+                self._gate.notify_all()
+        if writable:
+            self._write_lock.release()
+            
+            
+    def _can_grow(self):
+        if not self._replay_writes or self._local.replay_size is None:
+            return False
+        return self._can_grow_map(self._env)
+        
+        
+    def _can_grow_map(self, env):
+        if self._map_growth <= 1:
+            return False
+        return not self._max_map_size or env.info()['map_size'] < self._max_map_size
+        
+        
+    def _needs_room(self, env):
+        info = env.info()
+        used = (info['last_pgno'] + 1) * env.stat()['psize']
+        return info['map_size'] - used < info['map_size'] * self._map_headroom
+        
+        
+    def _grow_ahead(self):
+        """Grow the map before a write transaction starts if it's nearly full,
+        so the transaction rarely has to be replayed. Called with the write
+        lock held."""
+        env = self._get_env()
+        if not self._needs_room(env) or not self._can_grow_map(env):
+            return
+        with self._gate:
+            self._waiting_to_grow += 1
+            try:
+                while self._active > 0:
+                    self._gate.wait()
+                while self._needs_room(env) and self._can_grow_map(env):
+                    self._grow()
+            finally:
+                self._waiting_to_grow -= 1
+                self._gate.notify_all()
+        
+        
+    def _grow_and_replay(self, cursors):
+        """Abort this thread's transactions, grow the map once no other 
+        transaction is running and start the transactions again, replaying 
+        their writes and moving ``cursors`` (from :meth:`_open_cursors`) to
+        the new transactions. The write lock is held throughout so no other
+        writer in this process can commit in between."""
+        transactions = self._get_local_transactions()
+        while True:
+            generation = self._generation
+            levels = [(writable, ops) for writable, txn, ops in transactions]
+            for writable, txn, ops in reversed(transactions):
+                txn.abort()
+            del transactions[:]
+            
+            with self._gate:
+                self._active -= 1
+                self._waiting_to_grow += 1
+                try:
+                    while self._active > 0 and self._generation == generation:
+                        self._gate.wait()
+                    if self._generation == generation:
+                        self._grow()
+                finally:
+                    self._waiting_to_grow -= 1
+                    self._active += 1
+                    self._gate.notify_all()
+                    
+            try:
+                parent = None
+                for writable, ops in levels:
+                    txn = lmdb.Transaction(self._env, write=writable, parent=parent)
+                    transactions.append((writable, txn, ops))
+                    for op in ops:
+                        self._apply(txn, op)
+                    parent = txn
+            except lmdb.MapFullError:
+                if not self._can_grow():
+                    raise
+            else:
+                for cur, level, position in cursors:
+                    cur.rebind(transactions[level][1], position)
+                return
+                
+                
+    def _open_cursors(self, transactions):
+        """Return the cursors open in ``transactions`` with the level of
+        their transaction and the pair they're on. Taken before each write,
+        since a transaction can't be read once the map is full."""
+        if not self._replay_writes or not transactions[0][0] or not self._local.cursors:
+            return ()
+        levels = dict((id(txn), level) for level, (writable, txn, ops) in enumerate(transactions))
+        cursors = []
+        live = []
+        for ref in self._local.cursors:
+            cur = ref()
+            if cur is not None and id(cur.txn) in levels:
+                live.append(ref)
+                cursors.append((cur, levels[id(cur.txn)], cur.position()))
+        self._local.cursors = live
+        return cursors
+                    
+                    
+    def _grow(self):
+        self._env.set_mapsize(self._grown_size(self._env))
+        self._generation += 1
+        
+        
+    def _grown_size(self, env):
+        size = int(env.info()['map_size'] * self._map_growth)
+        if self._max_map_size:
+            size = min(size, self._max_map_size)
+        return size
+        
+        
     def _get_env(self):
         if not self._env:
-            self._env = lmdb.Environment(self._path, subdir=True, map_size=2147483648, max_dbs=len(self._dbs))
-            for name,options in self._dbs.items():
-                self._dbs[name] = self._env.open_db(name, 
-                    dupsort=options.get('duplicate_keys', False))
+            with self._env_lock:
+                if not self._env:
+                    env = lmdb.Environment(self._path, subdir=True, map_size=self._map_size, max_dbs=len(self._dbs),
+                        max_readers=self._max_readers, max_spare_txns=self._max_spare_txns, **self._flags)
+                    while self._needs_room(env) and self._can_grow_map(env):
+                        env.set_mapsize(self._grown_size(env))
+                    while True:
+                        try:
+                            self._open_dbs(env)
+                            break
+                        except lmdb.MapFullError:
+                            if not self._can_grow_map(env):
+                                raise
+                            env.set_mapsize(self._grown_size(env))
+                    self._env = env
         return self._env
         
+        
+    def _open_dbs(self, env):
+        dbs = {}
+        for name,options in self._dbs.items():
+            self._dupsort[name] = options.get('duplicate_keys', False)
+            try:
+                dbs[name] = env.open_db(name, 
+                    dupsort=self._dupsort[name],
+                    create=options.get('create', True))
+            except lmdb.NotFoundError:
+                dbs[name] = None
+        self._dbs = dbs
+        
+        
     def _get_local_transactions(self):
-        if not hasattr(self._local, 'transactions'):
+        try:
+            return self._local.transactions
+        except AttributeError:
             self._local.transactions = []
-        return self._local.transactions
+            return self._local.transactions
         
         
 class LMDBCursor(AbstractDBMCursor):
+    """Wraps a py-lmdb cursor. The cursor's methods are bound to the wrapper
+    once, when it's created, so calls on the scan path cost no more than 
+    calling the py-lmdb cursor directly."""
     
     def __init__(self, dbm_cur):
-        super(LMDBCursor, self).__setattr__('_dbm_cur', dbm_cur)
+        self._bind(dbm_cur)
+        
+        
+    def _bind(self, dbm_cur):
+        self._dbm_cur = dbm_cur
+        self.first = dbm_cur.first
+        self.last = dbm_cur.last
+        self.next = dbm_cur.next
+        self.prev = dbm_cur.prev
+        self.jump = dbm_cur.set_range
+        self.jump_dup = dbm_cur.set_key_dup
+        self.key = dbm_cur.key
+        self.value = dbm_cur.value
+        self.iternext = dbm_cur.iternext
+        self.iterprev = dbm_cur.iterprev
         
         
-    def __getattribute__(self, name):
-        if name == 'jump':
-            return super(LMDBCursor, self).__getattribute__('_dbm_cur').set_range
-        return getattr(super(LMDBCursor, self).__getattribute__('_dbm_cur'), name)
-        
\ No newline at end of file
+    def __getattr__(self, name):
+        return getattr(self._dbm_cur, name)
+        
+        
+class ReplayableCursor(LMDBCursor):
+    """A cursor in a write transaction. If the map grows while it is open,
+    :meth:`rebind` moves it to the pair it was on in the replayed 
+    transaction and the iterators it returned carry on from there."""
+    
+    def __init__(self, txn, db, dupsort):
+        self.txn = txn
+        self._db = db
+        self._dupsort = dupsort
+        self._resume = None
+        LMDBCursor.__init__(self, txn.cursor(db=db))
+        
+        
+    def _bind(self, dbm_cur):
+        LMDBCursor._bind(self, dbm_cur)
+        self.iternext = self._iternext
+        self.iterprev = self._iterprev
+        
+        
+    def position(self):
+        key = self._dbm_cur.key()
+        if key:
+            return (key, self._dbm_cur.value())
+        
+        
+    def rebind(self, txn, position):
+        """Move to ``txn``, on ``position`` or, if it's gone, the next pair."""
+        cur = txn.cursor(db=self._db)
+        if position is None:
+            self._resume = 'unpositioned'
+        elif cur.set_key_dup(*position) if self._dupsort else cur.set_key(position[0]):
+            self._resume = 'on'
+        elif cur.set_range_dup(*position) if self._dupsort else cur.set_range(position[0]):
+            self._resume = 'after'
+        else:
+            self._resume = 'end'
+        self.txn = txn
+        self._bind(cur)
+        
+        
+    def _iternext(self, keys=True, values=True):
+        return self._iterate(True, keys, values)
+        
+        
+    def _iterprev(self, keys=True, values=True):
+        return self._iterate(False, keys, values)
+        
+        
+    def _iterate(self, forward, keys, values):
+        while True:
+            cur = self._dbm_cur
+            items = cur.iternext(keys, values) if forward else cur.iterprev(keys, values)
+            for item in items:
+                yield item
+                if self._dbm_cur is not cur:
+                    break
+            else:
+                return
+            # Rebound while the caller had the last item, which the new cursor
+            # is on unless that pair was deleted.
+            if forward:
+                if self._resume == 'end' or (self._resume == 'on' and not self._dbm_cur.next()):
+                    return
+            elif self._resume == 'end':
+                if not self._dbm_cur.last():
+                    return
+            elif not self._dbm_cur.prev():
+                return
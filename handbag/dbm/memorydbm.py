@@ -0,0 +1,396 @@
+import threading
+from bisect import bisect_left, bisect_right
+from abstract import AbstractDBM, AbstractDBMCursor
+
+
+CHUNK_SIZE = 256
+
+
+class MemoryDBM(AbstractDBM):
+    """A DBM that keeps everything in memory, for caches and tests. Each
+    ``memory://`` URL opens a new, empty store.
+    
+    Namespaces are sorted sequences of (key, value) pairs split into chunks.
+    Committed namespaces are never changed; a write transaction copies the
+    namespaces it writes to, and then only the chunks it changes, so readers
+    keep a consistent snapshot without locking. As with LMDB there is one
+    writer at a time and write transactions can be nested.
+    """
+    
+    def __init__(self, url):
+        self._committed = {}
+        self._local = threading.local()
+        self._write_lock = threading.Lock()
+        self._lock = threading.Lock()
+        
+        
+    def add_namespace(self, namespace, duplicate_keys=False, create=True):
+        if not create:
+            return
+        with self._lock:
+            if namespace not in self._committed:
+                committed = dict(self._committed)
+                committed[namespace] = Namespace(duplicate_keys)
+                self._committed = committed
+                
+                
+    def has_namespace(self, namespace):
+        return namespace in self._committed
+        
+        
+    def transaction_start(self, writable=False):
+        transactions = self._get_local_transactions()
+        if transactions:
+            parent = transactions[-1]
+            txn = MemoryTransaction(parent.namespaces, writable)
+        else:
+            if writable:
+                self._write_lock.acquire()
+            txn = MemoryTransaction(self._committed, writable)
+        transactions.append(txn)
+        return txn
+        
+        
+    def transaction_commit(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        txn = transactions.pop()
+        if not txn.writable:
+            return
+        if transactions:
+            transactions[-1].adopt(txn)
+        else:
+            try:
+                with self._lock:
+                    committed = dict(self._committed)
+                    for name in txn.copied:
+                        ns = txn.namespaces[name]
+                        ns.owned = {}
+                        committed[name] = ns
+                    self._committed = committed
+            finally:
+                self._write_lock.release()
+                
+                
+    def transaction_abort(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        txn = transactions.pop()
+        if txn.writable and not transactions:
+            self._write_lock.release()
+            
+            
+    def in_transaction(self):
+        return len(self._get_local_transactions()) > 0
+        
+        
+    def is_transaction_writable(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        return transactions[-1].writable
+        
+        
+    def put(self, namespace, key, value):
+        self._writable_namespace(namespace).put(key, value)
+        
+        
+    def delete(self, namespace, key, value=None):
+        self._writable_namespace(namespace).delete(key, value)
+        
+        
+    def delete_all(self, namespace):
+        txn = self._current_transaction()
+        assert txn.writable, "Transaction is read-only."
+        txn.namespaces[namespace] = Namespace(txn.namespaces[namespace].duplicate_keys)
+        txn.copied.add(namespace)
+        
+        
+    def get(self, namespace, key):
+        return self._current_transaction().namespaces[namespace].get(key)
+        
+        
+    def cursor(self, namespace):
+        return MemoryCursor(self._current_transaction(), namespace)
+        
+        
+    def count(self, namespace):
+        return self._current_transaction().namespaces[namespace].count
+        
+        
+    def sync(self):
+        pass
+        
+        
+    def close(self):
+        self._committed = {}
+        
+        
+    def _writable_namespace(self, namespace):
+        txn = self._current_transaction()
+        assert txn.writable, "Transaction is read-only."
+        return txn.writable_namespace(namespace)
+        
+        
+    def _current_transaction(self):
+        transactions = self._get_local_transactions()
+        assert transactions, "An active transaction is required"
+        return transactions[-1]
+        
+        
+    def _get_local_transactions(self):
+        try:
+            return self._local.transactions
+        except AttributeError:
+            self._local.transactions = []
+            return self._local.transactions
+            
+            
+class MemoryTransaction(object):
+    
+    def __init__(self, namespaces, writable):
+        self.namespaces = dict(namespaces) if writable else namespaces
+        self.writable = writable
+        self.copied = set()
+        
+        
+    def writable_namespace(self, name):
+        if name not in self.copied:
+            self.namespaces[name] = self.namespaces[name].copy()
+            self.copied.add(name)
+        return self.namespaces[name]
+        
+        
+    def adopt(self, child):
+        """Take the namespaces of a committed child transaction."""
+        for name in child.copied:
+            ns = child.namespaces[name]
+            if name in self.copied:
+                ns.owned.update(self.namespaces[name].owned)
+            self.namespaces[name] = ns
+            self.copied.add(name)
+            
+            
+class Namespace(object):
+    """A sorted sequence of (key, value) pairs kept as a list of sorted
+    chunks, with the first pair of each chunk in ``firsts`` for bisecting.
+    ``owned`` holds the chunks this copy may change in place, by id."""
+    
+    __slots__ = ('duplicate_keys', 'chunks', 'firsts', 'count', 'owned')
+    
+    def __init__(self, duplicate_keys, chunks=None, firsts=None, count=0):
+        self.duplicate_keys = duplicate_keys
+        self.chunks = chunks if chunks is not None else []
+        self.firsts = firsts if firsts is not None else []
+        self.count = count
+        self.owned = {}
+        
+        
+    def copy(self):
+        return Namespace(self.duplicate_keys, list(self.chunks), list(self.firsts), self.count)
+        
+        
+    def find(self, item):
+        """Return the position of the first pair >= ``item``."""
+        if not self.chunks:
+            return None
+        i = max(bisect_right(self.firsts, item) - 1, 0)
+        chunk = self.chunks[i]
+        j = bisect_left(chunk, item)
+        if j == len(chunk):
+            if i + 1 == len(self.chunks):
+                return None
+            return i + 1, 0
+        return i, j
+        
+        
+    def at(self, position):
+        if position is not None:
+            return self.chunks[position[0]][position[1]]
+            
+            
+    def before(self, position):
+        if position is None:
+            return self.last()
+        i, j = position
+        if j > 0:
+            return self.chunks[i][j - 1]
+        if i > 0:
+            return self.chunks[i - 1][-1]
+            
+            
+    def first(self):
+        if self.chunks:
+            return self.chunks[0][0]
+            
+            
+    def last(self):
+        if self.chunks:
+            return self.chunks[-1][-1]
+            
+            
+    def ge(self, item):
+        return self.at(self.find(item))
+        
+        
+    def gt(self, item):
+        position = self.find(item)
+        found = self.at(position)
+        if found is not None and found == item:
+            i, j = position
+            if j + 1 < len(self.chunks[i]):
+                return self.chunks[i][j + 1]
+            if i + 1 < len(self.chunks):
+                return self.chunks[i + 1][0]
+            return None
+        return found
+        
+        
+    def lt(self, item):
+        return self.before(self.find(item))
+        
+        
+    def get(self, key):
+        found = self.ge((key,))
+        if found is not None and found[0] == key:
+            return found[1]
+            
+            
+    def put(self, key, value):
+        item = (key, value)
+        if not self.duplicate_keys:
+            self.delete(key)
+        position = self.find(item)
+        if position is None:
+            if not self.chunks:
+                self.chunks.append([])
+                self.firsts.append(item)
+            i = len(self.chunks) - 1
+            j = len(self.chunks[i])
+        else:
+            i, j = position
+            if self.chunks[i][j] == item:
+                return
+            if j == 0 and i > 0:
+                i, j = i - 1, len(self.chunks[i - 1])
+        chunk = self._own(i)
+        chunk.insert(j, item)
+        self.firsts[i] = chunk[0]
+        self.count += 1
+        if len(chunk) > CHUNK_SIZE * 2:
+            tail = chunk[CHUNK_SIZE:]
+            del chunk[CHUNK_SIZE:]
+            self.chunks.insert(i + 1, tail)
+            self.firsts.insert(i + 1, tail[0])
+            self.owned[id(tail)] = tail
+            
+            
+    def delete(self, key, value=None):
+        if value and self.duplicate_keys:
+            item = (key, value)
+            while True:
+                position = self.find(item)
+                if position is None or self.at(position) != item:
+                    return
+                self._remove(position)
+        else:
+            while True:
+                position = self.find((key,))
+                if position is None or self.at(position)[0] != key:
+                    return
+                self._remove(position)
+                
+                
+    def _remove(self, position):
+        i, j = position
+        chunk = self._own(i)
+        del chunk[j]
+        self.count -= 1
+        if chunk:
+            self.firsts[i] = chunk[0]
+        else:
+            del self.chunks[i]
+            del self.firsts[i]
+            
+            
+    def _own(self, i):
+        chunk = self.chunks[i]
+        if id(chunk) not in self.owned:
+            chunk = list(chunk)
+            self.chunks[i] = chunk
+            self.owned[id(chunk)] = chunk
+        return chunk
+        
+        
+class MemoryCursor(AbstractDBMCursor):
+    """A cursor positioned on a (key, value) pair rather than an index, so
+    writes in the same transaction don't invalidate it."""
+    
+    def __init__(self, txn, namespace):
+        self._txn = txn
+        self._namespace = namespace
+        self._current = None
+        
+        
+    def _ns(self):
+        return self._txn.namespaces[self._namespace]
+        
+        
+    def _move(self, item):
+        self._current = item
+        return item is not None
+        
+        
+    def first(self):
+        return self._move(self._ns().first())
+        
+        
+    def last(self):
+        return self._move(self._ns().last())
+        
+        
+    def next(self):
+        if self._current is None:
+            return self.first()
+        return self._move(self._ns().gt(self._current))
+        
+        
+    def prev(self):
+        if self._current is None:
+            return self.last()
+        return self._move(self._ns().lt(self._current))
+        
+        
+    def jump(self, key):
+        return self._move(self._ns().ge((key,)))
+        
+        
+    def jump_dup(self, key, value):
+        found = self._ns().ge((key, value))
+        if found is not None and found == (key, value):
+            return self._move(found)
+        return self._move(None)
+        
+        
+    def key(self):
+        return self._current[0] if self._current is not None else ''
+        
+        
+    def value(self):
+        return self._current[1] if self._current is not None else ''
+        
+        
+    def iternext(self):
+        if self._current is None:
+            self.first()
+        while self._current is not None:
+            yield self._current
+            self.next()
+            
+            
+    def iterprev(self):
+        if self._current is None:
+            self.last()
+        while self._current is not None:
+            yield self._current
+            self.prev()
+            
\ No newline at end of file
@@ -0,0 +1,445 @@
+import os
+import sys
+import heapq
+import threading
+from zlib import crc32
+from urlparse import urlparse, parse_qsl
+from abstract import AbstractDBM, AbstractDBMCursor
+
+
+class ShardDeadlock(Exception):
+    
+    def __init__(self, shard, owner):
+        Exception.__init__(self, "Waiting for shard %d would deadlock" % shard)
+        self.shard = shard
+        self.owner = owner
+    
+    
+class ShardedDBM(AbstractDBM):
+    """Spreads namespaces over several DBMs, each with its own writer, so
+    writes to different shards don't wait for each other::
+        
+        sharded:///data/db?backend=lmdb&shards=4&route=namespace
+        
+    Shard ``i`` is opened with ``<backend>://<path>/<i>`` and the rest of the
+    query string. With ``route=namespace`` (the default) each table lives in
+    one shard along with its indexes, picked by a hash of the part of the
+    namespace name before the first dot. With ``route=key`` every namespace
+    is split over all the shards by a hash of the key, and cursors merge the
+    shards in key order.
+    
+    A transaction only starts transactions on the shards it uses, when it
+    first uses them. Guarantees are weaker than with a single DBM:
+        
+    * Each shard's transaction is atomic and isolated, but a transaction that
+      reads several shards may see them at slightly different points in time.
+    * On commit the shards are committed one at a time in shard order. If one
+      fails, the rest are aborted and the error is raised, but the shards
+      before it stay committed.
+    * Write transactions wait for the writer of each shard they use. If that
+      would deadlock with another write transaction :class:`ShardDeadlock` is
+      raised and the transaction must be aborted. :meth:`run_write` retries
+      the function once the other transaction has let go of the shard.
+    """
+    
+    def __init__(self, url):
+        from handbag.dbm import backends
+        options = dict(parse_qsl(url.query))
+        num_shards = int(options.pop('shards', 4))
+        scheme = options.pop('backend', 'lmdb')
+        self.route = options.pop('route', 'namespace')
+        assert self.route in ('namespace', 'key'), "route must be 'namespace' or 'key'"
+        self.max_retries = int(options.pop('max_retries', 10))
+        if url.path and not os.path.exists(url.path):
+            os.makedirs(url.path)
+        query = '&'.join('%s=%s' % item for item in options.items())
+        self.shards = [backends[scheme](urlparse('%s://%s?%s' % (scheme, os.path.join(url.path, str(i)), query)))
+            for i in range(num_shards)]
+        self._duplicate_keys = {}
+        self._locks = ShardLocks(num_shards)
+        self._local = threading.local()
+        
+        
+    def add_namespace(self, namespace, duplicate_keys=False, create=True):
+        if create:
+            self._duplicate_keys[namespace] = duplicate_keys
+        for shard in self._namespace_shards(namespace):
+            self.shards[shard].add_namespace(namespace, duplicate_keys, create)
+            
+            
+    def has_namespace(self, namespace):
+        return any(self.shards[shard].has_namespace(namespace) for shard in self._namespace_shards(namespace))
+        
+        
+    def transaction_start(self, writable=False):
+        self._get_local_state().frames.append(writable)
+        
+        
+    def transaction_commit(self):
+        self._finish(True)
+        
+        
+    def transaction_abort(self):
+        self._finish(False)
+        
+        
+    def in_transaction(self):
+        return len(self._get_local_state().frames) > 0
+        
+        
+    def is_transaction_writable(self):
+        frames = self._get_local_state().frames
+        assert frames, "An active transaction is required"
+        return frames[-1]
+        
+        
+    def run_write(self, fn, *args, **kwargs):
+        if self.in_transaction():
+            return super(ShardedDBM, self).run_write(fn, *args, **kwargs)
+        for attempt in range(self.max_retries):
+            try:
+                return super(ShardedDBM, self).run_write(fn, *args, **kwargs)
+            except ShardDeadlock, e:
+                self._locks.wait_until_released(e.shard, e.owner)
+        return super(ShardedDBM, self).run_write(fn, *args, **kwargs)
+        
+        
+    def put(self, namespace, key, value):
+        self._enter(self._key_shard(namespace, key)).put(namespace, key, value)
+        
+        
+    def delete(self, namespace, key, value=None):
+        self._enter(self._key_shard(namespace, key)).delete(namespace, key, value)
+        
+        
+    def delete_all(self, namespace):
+        for shard in self._namespace_shards(namespace):
+            self._enter(shard).delete_all(namespace)
+            
+            
+    def get(self, namespace, key):
+        return self._enter(self._key_shard(namespace, key)).get(namespace, key)
+        
+        
+    def cursor(self, namespace):
+        shards = self._namespace_shards(namespace)
+        if len(shards) == 1:
+            return self._enter(shards[0]).cursor(namespace)
+        cursors = [self._enter(shard).cursor(namespace) for shard in shards]
+        return MergedCursor(cursors, self._duplicate_keys.get(namespace, False))
+        
+        
+    def count(self, namespace):
+        return sum(self._enter(shard).count(namespace) for shard in self._namespace_shards(namespace))
+        
+        
+    def sync(self):
+        for dbm in self.shards:
+            dbm.sync()
+            
+            
+    def backup(self, path, compact=True):
+        """Back up each shard into ``path/<i>``. Each shard is a consistent
+        snapshot on its own but they are taken one after the other."""
+        return sum(dbm.backup(os.path.join(path, str(i)), compact) for i, dbm in enumerate(self.shards))
+        
+        
+    def close(self):
+        for dbm in self.shards:
+            dbm.close()
+            
+            
+    def _namespace_shards(self, namespace):
+        if self.route == 'key':
+            return range(len(self.shards))
+        return [self._hash(namespace.split('.')[0]) % len(self.shards)]
+        
+        
+    def _key_shard(self, namespace, key):
+        if self.route == 'key':
+            return self._hash(key) % len(self.shards)
+        return self._hash(namespace.split('.')[0]) % len(self.shards)
+        
+        
+    def _hash(self, value):
+        return crc32(value) & 0xffffffff
+        
+        
+    def _enter(self, shard):
+        """Return the DBM for ``shard``, starting transactions on it up to the
+        current nesting depth."""
+        state = self._get_local_state()
+        depth = len(state.frames)
+        assert depth, "An active transaction is required"
+        current = state.depths[shard]
+        dbm = self.shards[shard]
+        if current == depth:
+            return dbm
+        if current == 0:
+            writable = state.frames[0]
+            if writable:
+                self._locks.acquire(shard)
+            try:
+                dbm.transaction_start(writable=writable)
+            except:
+                if writable:
+                    self._locks.release(shard)
+                raise
+            current = state.depths[shard] = 1
+        while current < depth:
+            dbm.transaction_start(writable=state.frames[current])
+            current = state.depths[shard] = current + 1
+        return dbm
+        
+        
+    def _finish(self, committed):
+        state = self._get_local_state()
+        depth = len(state.frames)
+        assert depth, "An active transaction is required"
+        error = None
+        for shard, dbm in enumerate(self.shards):
+            if state.depths[shard] != depth:
+                continue
+            try:
+                if committed and error is None:
+                    dbm.transaction_commit()
+                else:
+                    dbm.transaction_abort()
+            except Exception:
+                if error is None:
+                    error = sys.exc_info()
+            state.depths[shard] -= 1
+            if depth == 1 and state.frames[0]:
+                self._locks.release(shard)
+        state.frames.pop()
+        if error is not None:
+            raise error[0], error[1], error[2]
+            
+            
+    def _get_local_state(self):
+        try:
+            return self._local.state
+        except AttributeError:
+            self._local.state = ShardedState(len(self.shards))
+            return self._local.state
+            
+            
+class ShardedState(object):
+    """A thread's transactions: the writable flag of each nested transaction
+    and how many of them have been started on each shard."""
+    
+    def __init__(self, num_shards):
+        self.frames = []
+        self.depths = [0] * num_shards
+        
+        
+class ShardLocks(object):
+    """One writer lock per shard. A thread that would wait for a shard held
+    by a thread that is (indirectly) waiting for one of its own shards gets
+    :class:`ShardDeadlock` instead."""
+    
+    def __init__(self, num_shards):
+        self.owners = [None] * num_shards
+        self.waiting = {}
+        self.condition = threading.Condition(threading.Lock())
+        
+        
+    def acquire(self, shard):
+        me = threading.current_thread()
+        with self.condition:
+            while self.owners[shard] is not None:
+                if self._would_deadlock(me, shard):
+                    raise ShardDeadlock(shard, self.owners[shard])
+                self.waiting[me] = shard
+                try:
+                    self.condition.wait()
+                finally:
+                    del self.waiting[me]
+            self.owners[shard] = me
+            
+            
+    def wait_until_released(self, shard, owner):
+        with self.condition:
+            while self.owners[shard] is owner:
+                self.condition.wait()
+                
+                
+    def release(self, shard):
+        with self.condition:
+            self.owners[shard] = None
+            self.condition.notify_all()
+            
+            
+    def _would_deadlock(self, me, shard):
+        owner = self.owners[shard]
+        while owner is not None:
+            if owner is me:
+                return True
+            if owner not in self.waiting:
+                return False
+            owner = self.owners[self.waiting[owner]]
+        return False
+        
+        
+class MergedCursor(AbstractDBMCursor):
+    """Walks the cursors of several shards in (key, value) order. Each shard
+    cursor stays on the next pair it has to offer and a heap picks the 
+    smallest of them (the largest going backwards), so a step only moves one
+    shard cursor. After a jump or a change of direction the shard cursors
+    are repositioned around the current pair."""
+    
+    def __init__(self, cursors, duplicate_keys=False):
+        self._cursors = cursors
+        self._duplicate_keys = duplicate_keys
+        self._heap = []
+        self._forward = True
+        self._current = None
+        self._shard = None
+        
+        
+    def first(self):
+        return self._start(True, [c.first() for c in self._cursors])
+        
+        
+    def last(self):
+        return self._start(False, [c.last() for c in self._cursors])
+        
+        
+    def next(self):
+        if self._current is None:
+            return self.first()
+        if self._heap is None or not self._forward:
+            self._reposition(True)
+        else:
+            self._advance(self._shard)
+        return self._pop()
+        
+        
+    def prev(self):
+        if self._current is None:
+            return self.last()
+        if self._heap is None or self._forward:
+            self._reposition(False)
+        else:
+            self._advance(self._shard)
+        return self._pop()
+        
+        
+    def jump(self, key):
+        return self._start(True, [c.jump(key) for c in self._cursors])
+        
+        
+    def jump_dup(self, key, value):
+        for i, c in enumerate(self._cursors):
+            if c.jump_dup(key, value):
+                self._current = (key, value)
+                self._shard = i
+                self._heap = None
+                return True
+        self._current = None
+        return False
+        
+        
+    def key(self):
+        return self._current[0] if self._current is not None else ''
+        
+        
+    def value(self):
+        return self._current[1] if self._current is not None else ''
+        
+        
+    def iternext(self):
+        if self._current is None:
+            self.first()
+        while self._current is not None:
+            yield self._current
+            self.next()
+            
+            
+    def iterprev(self):
+        if self._current is None:
+            self.last()
+        while self._current is not None:
+            yield self._current
+            self.prev()
+            
+            
+    def _start(self, forward, positioned):
+        self._forward = forward
+        self._heap = []
+        for i, found in enumerate(positioned):
+            if found:
+                self._push(i)
+        return self._pop()
+        
+        
+    def _push(self, i):
+        item = (self._cursors[i].key(), self._cursors[i].value())
+        entry = (self._order(item), i, item)
+        heapq.heappush(self._heap, entry if self._forward else Descending(entry))
+        
+        
+    def _pop(self):
+        if not self._heap:
+            self._current = None
+            return False
+        entry = heapq.heappop(self._heap)
+        if not self._forward:
+            entry = entry.entry
+        self._current = entry[2]
+        self._shard = entry[1]
+        return True
+        
+        
+    def _advance(self, i):
+        cursor = self._cursors[i]
+        if cursor.next() if self._forward else cursor.prev():
+            self._push(i)
+            
+            
+    def _reposition(self, forward):
+        """Put each shard cursor on its first pair after (or last pair before)
+        the current one."""
+        self._forward = forward
+        self._heap = []
+        for i, cursor in enumerate(self._cursors):
+            if forward:
+                found = self._seek(cursor, self._current, False)
+            elif self._seek(cursor, self._current, True):
+                found = cursor.prev()
+            else:
+                found = cursor.last()
+            if found:
+                self._push(i)
+                
+                
+    def _order(self, item):
+        return item if self._duplicate_keys else item[0]
+        
+        
+    def _seek(self, cursor, item, inclusive):
+        """Position ``cursor`` on its first pair after ``item`` (or equal to
+        it when ``inclusive``). Returns False if there is none."""
+        if self._duplicate_keys and cursor.jump_dup(item[0], item[1]):
+            return inclusive or cursor.next()
+        target = self._order(item)
+        found = cursor.jump(item[0])
+        while found:
+            order = self._order((cursor.key(), cursor.value()))
+            if order > target or (inclusive and order == target):
+                return True
+            found = cursor.next()
+        return False
+        
+        
+class Descending(object):
+    """Reverses the order of a heap entry, for walking backwards."""
+    
+    __slots__ = ('entry',)
+    
+    def __init__(self, entry):
+        self.entry = entry
+        
+        
+    def __lt__(self, other):
+        return other.entry < self.entry
@@ -33,7 +33,39 @@ def loads(bytes):
 def load(stream):
     return decode(stream)
     
+    
+def loads_fields(bytes, include=None, exclude=None):
+    """Decode an encoded dict, only decoding the values of the keys in 
+    ``include`` (if given) that aren't in ``exclude`` (if given). The values
+    of other keys are skipped over without being decoded."""
+    stream = cStringIO.StringIO(bytes)
+    if read_type(stream) != 'dict':
+        raise DecodeError, "Expected an encoded dict"
+    d = {}
+    while True:
+        try:
+            k = decode(stream)
+        except StopDecoding:
+            break
+        if (include is not None and k not in include) or (exclude is not None and k in exclude):
+            skip(stream)
+        else:
+            d[k] = decode(stream)
+    return d
+    
 
+def estimate_size(value):
+    """Roughly how many bytes ``value`` takes once encoded, without 
+    encoding it."""
+    if isinstance(value, dict):
+        return 2 + sum(estimate_size(k) + estimate_size(v) for k, v in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return 2 + sum(estimate_size(v) for v in value)
+    if isinstance(value, basestring):
+        return 5 + len(value)
+    return 13
+    
+    
 _type_by_magic = {
     '\x01': "dict",
     '\x02': "list",
@@ -157,6 +189,22 @@ def decode(stream):
         return decode_fn(data)
         
         
+def skip(stream):
+    type_name = read_type(stream)
+    
+    if type_name in ('dict', 'list'):
+        while True:
+            try:
+                skip(stream)
+            except StopDecoding:
+                break
+    else:
+        data = stream.read(struct.calcsize('>I'))
+        if not data:
+            raise StopDecoding
+        stream.seek(struct.unpack('>I', data)[0], 1)
+        
+        
 def read_type(stream):
     magic = stream.read(1)
     if not magic:
@@ -0,0 +1,139 @@
+import dson
+import cursor
+
+
+class EdgeStore(object):
+    """Stores the edges of a many-to-many relationship as two sorted 
+    adjacency lists, one for each side of the relationship. Each side is 
+    a namespace with duplicate keys that maps an owner id to the ids of 
+    its targets so adding, removing and checking for an edge are all 
+    single b-tree lookups.
+    
+    :param dbm: The dbm to store the edges in.
+    :param name: The name of the store.
+    :param sides: The full names of the two relationships, e.g. ``('Foo.bars', 'Bar.foos')``.
+    :param changelog: A :class:`~handbag.changelog.ChangeLog` to record changes in.
+    """
+    
+    def __init__(self, dbm, name, sides, changelog=None):
+        self.dbm = dbm
+        self.name = name
+        self.changelog = changelog
+        self.sides = tuple(sorted(sides))
+        for side in self.sides:
+            self.dbm.add_namespace(self.get_namespace(side), duplicate_keys=True)
+        self.legacy_namespaces = [self.name] + ['%s.%s' % (self.name, fields) for fields in (
+            ','.join(self.get_model_names()), self.get_model_names()[0], self.get_model_names()[1])]
+        self.dbm.add_namespace(self.legacy_namespaces[0], create=False)
+        for namespace in self.legacy_namespaces[1:]:
+            self.dbm.add_namespace(namespace, duplicate_keys=True, create=False)
+        
+        
+    def get_namespace(self, side):
+        return '%s:%s' % (self.name, side)
+        
+        
+    def get_other_side(self, side):
+        if side == self.sides[0]:
+            return self.sides[1]
+        return self.sides[0]
+        
+        
+    def get_model_names(self):
+        return tuple(sorted([side.split('.')[0] for side in self.sides]))
+        
+        
+    def add(self, side, owner_id, target_id):
+        owner_key = dson.dumpone(owner_id)
+        target_key = dson.dumpone(target_id)
+        if self._contains(side, owner_key, target_key):
+            return False
+        self.dbm.put(self.get_namespace(side), owner_key, target_key)
+        self.dbm.put(self.get_namespace(self.get_other_side(side)), target_key, owner_key)
+        self._log('edge_add', side, owner_id, target=target_id)
+        return True
+        
+        
+    def remove(self, side, owner_id, target_id):
+        owner_key = dson.dumpone(owner_id)
+        target_key = dson.dumpone(target_id)
+        if not self._contains(side, owner_key, target_key):
+            return False
+        self.dbm.delete(self.get_namespace(side), owner_key, target_key)
+        self.dbm.delete(self.get_namespace(self.get_other_side(side)), target_key, owner_key)
+        self._log('edge_remove', side, owner_id, target=target_id)
+        return True
+        
+        
+    def remove_all(self, side, owner_id):
+        owner_key = dson.dumpone(owner_id)
+        other_namespace = self.get_namespace(self.get_other_side(side))
+        target_ids = list(self.targets(side, owner_id))
+        for target_id in target_ids:
+            self.dbm.delete(other_namespace, dson.dumpone(target_id), owner_key)
+        if target_ids:
+            self.dbm.delete(self.get_namespace(side), owner_key)
+            self._log('edge_remove_all', side, owner_id)
+        return target_ids
+        
+        
+    def contains(self, side, owner_id, target_id):
+        return self._contains(side, dson.dumpone(owner_id), dson.dumpone(target_id))
+        
+        
+    def targets(self, side, owner_id):
+        return EdgeCursor(self.dbm, self.get_namespace(side)).key(owner_id)
+        
+        
+    def count(self, side, owner_id):
+        return EdgeCursor(self.dbm, self.get_namespace(side)).count_key(owner_id)
+        
+        
+    def migrate(self):
+        """Move the edges of a join table written by an older version of 
+        handbag into this store and empty the join table."""
+        if not self.dbm.has_namespace(self.name):
+            return
+        
+        self.dbm.transaction_start(writable=False)
+        try:
+            num_docs = self.dbm.count(self.name)
+        finally:
+            self.dbm.transaction_commit()
+        
+        if num_docs == 0:
+            return
+        
+        self.dbm.transaction_start(writable=True)
+        try:
+            side = self.sides[0]
+            owner_model = side.split('.')[0]
+            target_model = self.get_other_side(side).split('.')[0]
+            for doc in cursor.Cursor(self.dbm, self.name):
+                self.add(side, doc[owner_model], doc[target_model])
+            for namespace in self.legacy_namespaces:
+                if self.dbm.has_namespace(namespace):
+                    self.dbm.delete_all(namespace)
+            self.dbm.delete('_indexes', self.name)
+        except:
+            self.dbm.transaction_abort()
+            raise
+        else:
+            self.dbm.transaction_commit()
+        
+        
+    def _contains(self, side, owner_key, target_key):
+        cur = self.dbm.cursor(self.get_namespace(side))
+        return bool(cur.jump_dup(owner_key, target_key))
+        
+        
+    def _log(self, op, side, owner_id, **entry):
+        if self.changelog:
+            self.changelog.append(op, store=self.name, sides=list(self.sides), side=side, owner=owner_id, **entry)
+        
+        
+        
+class EdgeCursor(cursor.Cursor):
+    
+    def load(self, data):
+        return dson.loadone(data)
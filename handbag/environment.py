@@ -1,21 +1,45 @@
+import threading
 import database
 import registry
 import model
 import uniqueid
+from changelog import Replicator
+from expiry import Sweeper
 
 
-def open(path):
-    return Environment(path)
+def open(path, **kwargs):
+    return Environment(path, **kwargs)
+
+
+FLUSH_POLICIES = ('count', 'bytes', 'commit')
 
 
 class Environment(object):
+    """Write contexts buffer changed instances and save them in a batch. 
+    ``flush_policy`` decides when the buffer is flushed before the end of
+    the transaction:
+    
+    * ``'count'`` - when more than ``max_queue_size`` instances are queued.
+    * ``'bytes'`` - when the queued instances take roughly more than 
+      ``max_queue_bytes`` once encoded.
+    * ``'commit'`` - only when the transaction ends.
     
-    def __init__(self, path):
-        self.db = database.open(path)
+    With ``changelog`` the database records every change so it can be
+    replicated with :meth:`replicate_to`.
+    """
+    
+    def __init__(self, path, identity_map_size=1000, flush_policy='count', max_queue_size=20, max_queue_bytes=1048576, changelog=False):
+        assert flush_policy in FLUSH_POLICIES, "flush_policy must be one of %s" % ', '.join(FLUSH_POLICIES)
+        self.db = database.open(path, changelog)
+        self.identity_map_size = identity_map_size
+        self.flush_policy = flush_policy
+        self.max_queue_size = max_queue_size
+        self.max_queue_bytes = max_queue_bytes
         self.backreferences = registry.BackreferenceRegistry()
         self.instances = registry.ModelInstanceRegistry()
         self.models = {}
-        self.context = None
+        self._local = threading.local()
+        self.aio = None
         self.Model = model.create(self)
         
         
@@ -28,19 +52,90 @@ class Environment(object):
         return uniqueid.create()
         
         
+    def sync(self):
+        self.db.sync()
+        
+        
+    def backup(self, path, compact=True):
+        return self.db.backup(path, compact)
+        
+        
+    def backup_to(self, fileobj, compact=True):
+        return self.db.backup_to(fileobj, compact)
+        
+        
+    def subscribe(self, callback, models=None):
+        """Call ``callback`` with the changes to ``models`` (all tables by
+        default) after each write transaction commits. The environment must
+        be opened with ``changelog=True``."""
+        tables = [model.table.name for model in models] if models is not None else None
+        self.db.subscribe(callback, tables)
+        
+        
+    def unsubscribe(self, callback):
+        self.db.unsubscribe(callback)
+        
+        
+    def replicate_to(self, replica, **kwargs):
+        """Return a :class:`~handbag.changelog.Replicator` that applies this
+        environment's change log to the ``replica`` environment."""
+        return Replicator(self.db, replica.db, **kwargs)
+        
+        
+    def sweep_expired(self, batch_size=1000):
+        """Remove the expired instances of every model with a ``ttl`` or an
+        ``expires_field``, ``batch_size`` per transaction. Returns the
+        number removed."""
+        return Sweeper(self, batch_size).sweep()
+        
+        
+    def sweeper(self, **kwargs):
+        """Return a :class:`~handbag.expiry.Sweeper` to run in the background."""
+        return Sweeper(self, **kwargs)
+        
+        
     def read(self):
-        self.context = EnvironmentContext(self)
-        return self.context
+        return EnvironmentContext(self)
         
         
     def write(self):
-        self.context = EnvironmentContext(self, writable=True)
-        return self.context
+        return EnvironmentContext(self, writable=True)
+        
+        
+    def transaction(self, fn, *args, **kwargs):
+        """Call ``fn`` in a write context and return its result. With group 
+        commit enabled ``fn`` runs on the writer thread, so it should return
+        ids or plain values rather than model instances."""
+        def run():
+            with self.write():
+                return fn(*args, **kwargs)
+        return self.db.transaction(run)
         
         
     def current_context(self):
-        assert self.context is not None, "An active transaction is required"
-        return self.context
+        contexts = self._get_local_contexts()
+        assert len(contexts) > 0, "An active transaction is required"
+        return contexts[-1]
+        
+        
+    def in_context(self):
+        return len(self._get_local_contexts()) > 0
+        
+        
+    def push_context(self, context):
+        self._get_local_contexts().append(context)
+        
+        
+    def pop_context(self, context):
+        contexts = self._get_local_contexts()
+        assert contexts and contexts[-1] is context, "Contexts must be exited in the order they were entered"
+        contexts.pop()
+        
+        
+    def _get_local_contexts(self):
+        if not hasattr(self._local, 'contexts'):
+            self._local.contexts = []
+        return self._local.contexts
         
         
         
@@ -50,7 +145,12 @@ class EnvironmentContext(object):
         self.env = env
         self.writable = writable
         self.queue = {}
-        self.max_queue_size = 20
+        self.queue_bytes = 0
+        self.flush_policy = env.flush_policy
+        self.max_queue_size = env.max_queue_size
+        self.max_queue_bytes = env.max_queue_bytes
+        self.identity_map = None
+        self.owns_identity_map = False
         
         if writable:
             self.db_context = self.env.db.write()
@@ -60,6 +160,14 @@ class EnvironmentContext(object):
         
     def __enter__(self):
         self.db_context.__enter__()
+        # Nested contexts share the outermost context's identity map, so an
+        # id loads as the same instance throughout the transaction.
+        if self.env.in_context():
+            self.identity_map = self.env.current_context().identity_map
+        else:
+            self.identity_map = registry.IdentityMap(self.env.identity_map_size)
+            self.owns_identity_map = True
+        self.env.push_context(self)
         
         
     def __exit__(self, type, value, traceback):
@@ -67,24 +175,50 @@ class EnvironmentContext(object):
             if self.writable and not value:
                 self.flush()
         except Exception, e:
+            self.clear_identity_map()
+            self.env.pop_context(self)
             self.db_context.__exit__(e.__class__, e, None)
             raise
         else:
+            self.clear_identity_map()
+            self.env.pop_context(self)
             self.db_context.__exit__(type, value, traceback)
+            
+            
+    def clear_identity_map(self):
+        if self.owns_identity_map:
+            self.identity_map.clear()
         
         
     def enqueue(self, inst):
         if self.writable:
             if inst.id not in self.queue:
-                if len(self.queue) > self.max_queue_size:
-                    self.flush()
+                if self.flush_policy == 'count':
+                    if len(self.queue) > self.max_queue_size:
+                        self.flush()
+                elif self.flush_policy == 'bytes':
+                    if self.queue_bytes > self.max_queue_bytes:
+                        self.flush()
+                    self.queue_bytes += inst.estimate_size()
                 self.queue[inst.id] = inst
         elif inst.is_dirty():
             raise AssertionError, "A writable transaction is required."
         
         
+    def discard(self, id):
+        self.queue.pop(id, None)
+        self.identity_map.discard(id)
+        
+        
     def flush(self):
         if len(self.queue) > 0:
-            for inst in self.queue.values():
+            queue = self.queue
+            self.queue = {}
+            self.queue_bytes = 0
+            for inst in sorted(queue.values(), key=flush_order):
                 inst.save()
+                
+                
+def flush_order(inst):
+    return (inst.table.name, inst.table.dump_key(inst.id))
                 
\ No newline at end of file
@@ -0,0 +1,64 @@
+import threading
+
+
+class Sweeper(object):
+    """Removes the expired instances of the models with a ``ttl`` or an
+    ``expires_field``, at most ``batch_size`` per write transaction, so the
+    work done is proportional to the number of expired instances rather
+    than the size of the tables. :meth:`start` runs it on a thread that
+    sweeps every ``interval`` seconds."""
+    
+    def __init__(self, env, batch_size=1000, interval=60):
+        self.env = env
+        self.batch_size = batch_size
+        self.interval = interval
+        self.error = None
+        self._thread = None
+        self._stop = threading.Event()
+        
+        
+    def get_models(self):
+        """One expiring model per table, since they share the expiry index."""
+        models = {}
+        for name, model in sorted(self.env.models.items()):
+            if model.expiry_index is not None:
+                models.setdefault(model.table.name, model)
+        return models.values()
+        
+        
+    def sweep(self):
+        """Remove expired instances until there are none left and return
+        how many were removed."""
+        total = 0
+        for model in self.get_models():
+            while True:
+                removed = self.env.transaction(model.remove_expired, self.batch_size)
+                total += removed
+                if removed < self.batch_size:
+                    break
+        return total
+        
+        
+    def start(self):
+        assert self._thread is None, "The sweeper is already running"
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="handbag-sweeper")
+        self._thread.daemon = True
+        self._thread.start()
+        
+        
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            
+            
+    def run(self):
+        try:
+            while not self._stop.is_set():
+                self.sweep()
+                self._stop.wait(self.interval)
+        except Exception, e:
+            self.error = e
+            
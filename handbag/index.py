@@ -87,6 +87,10 @@ class IndexCollection(object):
     def __iter__(self):
         for k in self.indexes:
             yield k
+            
+            
+    def get_virtual(self, field):
+        return [index for index in self.indexes.values() if field in index.fields.virtual]
         
         
     def update(self, old_doc, new_doc):
@@ -99,6 +103,11 @@ class IndexCollection(object):
             index.remove(doc)
             
             
+    def remove_many(self, docs):
+        for index in self.indexes.values():
+            index.remove_many(docs)
+            
+            
     def remove_all(self):
         for index in self.indexes.values():
             index.remove_all()
@@ -169,6 +178,9 @@ class Index(object):
                 self.remove(old_doc)
             return
             
+        if old_doc and self.fields.virtual and self.has_same_values(old_doc, new_doc):
+            return
+        
         value = dson.dumpone(new_doc['id'])
         new_keys = self.make_keys(new_doc)
         
@@ -200,16 +212,61 @@ class Index(object):
             if doc_value:
                 yield dson.loads(doc_value)
             cur.next()
+            
+            
+    def ids(self, key):
+        string_key = self.get_key(key)
+        cur = self.dbm.cursor(self.name)
+        cur.jump(string_key)
+        while cur.key() == string_key:
+            yield dson.loadone(cur.value())
+            cur.next()
+            
+            
+    def range_ids(self, start=None, end=None):
+        """Yield the ids of the entries from ``start`` up to, but not
+        including, ``end``."""
+        cur = self.dbm.cursor(self.name)
+        start = start if start is None else self.get_key(start)
+        end = end if end is None else self.get_key(end)
+        for key, value in cursor.iter_range(cur, start, end):
+            yield dson.loadone(value)
+            
+            
+    def remove_ids(self, key, ids):
+        string_key = self.get_key(key)
+        for id in ids:
+            self.dbm.delete(self.name, string_key, value=dson.dumpone(id))
         
         
-    def remove(self, doc):
-        try:
-            key = self.get_key(doc)
-        except:
+    def update_virtual(self, field, field_value, doc, add=True):
+        """Add or remove the entries for ``doc`` that have ``field_value`` for the
+        virtual ``field`` without recomputing the rest of the virtual values."""
+        if self.filter and not self.filter(doc):
             return
-        else:
+        value = dson.dumpone(doc['id'])
+        for k in self.make_keys(doc, {field: [field_value]}):
+            if add:
+                self.dbm.put(self.name, k, value)
+            else:
+                self.dbm.delete(self.name, k, value)
+        
+        
+    def remove(self, doc):
+        value = dson.dumpone(doc['id'])
+        for k in self.make_keys(doc):
+            self.dbm.delete(self.name, k, value=value)
+            
+            
+    def remove_many(self, docs):
+        entries = []
+        for doc in docs:
             value = dson.dumpone(doc['id'])
-            self.dbm.delete(self.name, key, value=value)
+            for k in self.make_keys(doc):
+                entries.append((k, value))
+        entries.sort()
+        for k, value in entries:
+            self.dbm.delete(self.name, k, value=value)
         
         
     def remove_all(self):
@@ -224,11 +281,14 @@ class Index(object):
         return self.dbm.count(self.name)
         
         
-    def make_keys(self, doc):
+    def make_keys(self, doc, virtual_values=None):
         rows = []
         for f in self.fields.names:
             if f in self.fields.virtual:
-                values = self.fields.virtual[f](doc)
+                if virtual_values and f in virtual_values:
+                    values = virtual_values[f]
+                else:
+                    values = self.fields.virtual[f](doc)
                 if len(values) > 0:
                     rows.append(values)
             else:
@@ -247,6 +307,18 @@ class Index(object):
         return keys
         
         
+    def has_same_values(self, old_doc, new_doc):
+        for f in self.fields.names:
+            if f in self.fields.virtual:
+                continue
+            try:
+                if self.get_value(old_doc, f) != self.get_value(new_doc, f):
+                    return False
+            except KeyError:
+                return False
+        return True
+        
+        
     def get_value(self, doc, field):
         if '.' in field:
             parts = field.split('.')
@@ -300,7 +372,7 @@ class IndexCursor(cursor.Cursor):
     def load(self, data):
         doc_value = self.index.dbm.get(self.index.table_name, data)
         if doc_value:
-            return dson.loads(doc_value)
+            return self.decode(doc_value)
 
 
 def make_key(base_key, extension_fields, key=None):
@@ -378,6 +450,18 @@ class BaseKeyIndexProxy(object):
         )
         
         
+    def ids(self, key):
+        return self.index.ids(
+            self.make_key(key)
+        )
+        
+        
+    def remove_ids(self, key, ids):
+        return self.index.remove_ids(
+            self.make_key(key), ids
+        )
+        
+        
     def count(self):
         return self.index.cursor().count_prefix(self.make_key())
         
@@ -434,4 +518,24 @@ class BaseKeyIndexCursorProxy(object):
         
     def count_key(self, key):
         return self.cursor.count_key(self.make_key(key))
+        
+        
+    def prefetch(self, *names):
+        self.cursor.prefetch(*names)
+        return self
+        
+        
+    def as_rows(self):
+        self.cursor.as_rows()
+        return self
+        
+        
+    def only(self, *names):
+        self.cursor.only(*names)
+        return self
+        
+        
+    def defer(self, *names):
+        self.cursor.defer(*names)
+        return self
         
\ No newline at end of file
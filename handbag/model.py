@@ -1,14 +1,99 @@
+import time
 import inspect
-from validators import Validator, GroupValidator
-from relationships import Relationship
+import calendar
+import itertools
+from datetime import datetime
+import dson
+from operator import itemgetter
+from validators import Validator, ValidationPlan
+from relationships import Relationship, One, prefetch, prefetch_iter
 from index import BaseKeyIndexCollectionProxy
+from cascade import CascadeDelete
+
+
+# The internal field and index that hold the expiry time of expiring models.
+EXPIRES = '_expires'
 
 
 def create(env):
     return type('Model', (BaseModel,), dict(env=env))
+    
+    
+def has_expiry(doc):
+    return doc.get(EXPIRES) is not None
+    
+    
+def is_expired(doc, now=None):
+    expires = doc.get(EXPIRES)
+    return expires is not None and expires < (now if now is not None else time.time())
+    
+    
+def to_timestamp(value):
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple()) + value.microsecond / 1000000.0
+    return float(value)
+
+
+class Deferred(object):
+    """Stands in for the old value of a deferred field that is assigned to
+    before it has been loaded."""
+    
+    
+class Field(object):
+    """Stands in for a validator on a model class. It stores the field value 
+    in a slot on the instance and marks the instance dirty when the value
+    changes. Accessed on the class it returns the validator."""
+    
+    def __init__(self, name, validator, slot):
+        self.name = name
+        self.validator = validator
+        self.slot = slot
+        
+        
+    def __get__(self, instance, cls):
+        if instance is None:
+            return self.validator
+        try:
+            return self.slot.__get__(instance, cls)
+        except AttributeError:
+            instance.load_deferred()
+            return self.slot.__get__(instance, cls)
+        
+        
+    def __set__(self, instance, value):
+        context = instance.env.current_context()
+        assert context.writable, "Transaction is read-only."
+        try:
+            old_value = self.slot.__get__(instance)
+        except AttributeError:
+            old_value = Deferred
+            instance._deferred = tuple(k for k in instance._deferred if k != self.name)
+        if old_value != value:
+            self.slot.__set__(instance, value)
+            instance._dirty = True
+            if instance._changed is not None and self.name not in instance._changed:
+                instance._changed += (self.name,)
+            context.enqueue(instance)
+            
+            
+    def init(self, instance, value):
+        self.slot.__set__(instance, value)
 
 
 class ModelMeta(type):
+    
+    def __new__(meta, name, bases, dict):
+        field_names = [k for k,v in dict.items() if isinstance(v, Validator)]
+        validators = [(k, dict.pop(k)) for k in field_names]
+        dict['__slots__'] = tuple(dict.get('__slots__', ())) + tuple(field_names)
+        cls = super(ModelMeta, meta).__new__(meta, name, bases, dict)
+        for k, v in validators:
+            setattr(cls, k, Field(k, v, cls.__dict__[k]))
+        return cls
+        
+        
     def __init__(cls, name, bases, dict):
         super(ModelMeta, cls).__init__(name, bases, dict)
         
@@ -16,9 +101,21 @@ class ModelMeta(type):
             cls.env.register_model(cls)
             cls._setup_inheritance()
             cls._setup_indexes(dict)
+            cls._setup_expiry()
             cls._setup_relationships(dict)
             cls.validators = inspect.getmembers(cls, lambda x: isinstance(x, Validator))
             cls.relationships = inspect.getmembers(cls, lambda x: isinstance(x, Relationship))
+            cls.fields = cls._get_fields()
+            cls.validation_plan = ValidationPlan(cls.validators)
+            
+            
+    def _get_fields(cls):
+        fields = {}
+        for c in reversed(cls.__mro__):
+            for k, v in c.__dict__.items():
+                if isinstance(v, Field):
+                    fields[k] = v
+        return sorted(fields.items())
     
     
     def _setup_inheritance(cls):
@@ -70,6 +167,15 @@ class ModelMeta(type):
                     cls.indexes.add(*fields)
         
         
+    def _setup_expiry(cls):
+        if cls.ttl is None and cls.expires_field is None:
+            return
+        indexes = cls.table.indexes
+        if EXPIRES not in indexes:
+            indexes.add(EXPIRES, filter=has_expiry)
+        cls.expiry_index = indexes[EXPIRES]
+        
+        
     def _setup_relationships(cls, dict):
         for k,v in dict.items():
             if isinstance(v, Relationship):
@@ -82,17 +188,62 @@ class ModelMeta(type):
     
     
     def get(cls, id):
+        inst = cls.env.current_context().identity_map.get(id)
+        if inst is not None and isinstance(inst, cls):
+            # The instance may have come from a projected query.
+            inst.load_deferred()
+            return inst
         if cls.primary_index:
             return cls.primary_index.get(id)
         else:
             return cls.load(cls.table.get(id))
         
         
-    def cursor(cls, reverse=False):
+    def get_many(cls, ids):
+        identity_map = cls.env.current_context().identity_map
+        found = {}
+        missing = []
+        for id in ids:
+            inst = identity_map.get(id)
+            if inst is None:
+                missing.append(id)
+            else:
+                inst.load_deferred()
+                found[id] = inst
+        if missing:
+            for id, data in cls.table.get_many(missing).items():
+                found[id] = cls.load(data)
+        return dict((id, inst) for id, inst in found.items() if isinstance(inst, cls))
+        
+        
+    def aget(cls, id):
+        assert cls.env.aio is not None, "The environment must be opened with handbag.aio"
+        return cls.env.aio.call(cls.get, id)
+        
+        
+    def acursor(cls, reverse=False, readonly=False, batch_size=None):
+        assert cls.env.aio is not None, "The environment must be opened with handbag.aio"
+        return cls.env.aio.cursor(cls.cursor, reverse=reverse, readonly=readonly, batch_size=batch_size)
+        
+        
+    def get_row(cls, id):
+        data = cls.table.get(id)
+        if data and issubclass(cls.get_model_for(data), cls):
+            return cls.load_row(data)
+        
+        
+    def cursor(cls, reverse=False, readonly=False):
         if cls.primary_index:
-            return cls.primary_index.cursor(reverse=reverse)
+            cursor = cls.primary_index.cursor(reverse=reverse)
         else:
-            return ModelCursorAdaptor(cls, cls.table.cursor(reverse=reverse))
+            cursor = ModelCursorAdaptor(cls, cls.table.cursor(reverse=reverse))
+        if readonly:
+            cursor.as_rows()
+        return cursor
+        
+        
+    def rows(cls, reverse=False):
+        return cls.cursor(reverse=reverse, readonly=True)
         
         
     def count(cls):
@@ -102,53 +253,124 @@ class ModelMeta(type):
             return cls.table.count()
             
             
-    def load(cls, data):
+    def changes(cls, since=0, limit=None):
+        """Return the changes to the model's table after the sequence number
+        ``since``, see :meth:`~handbag.changelog.ChangeLog.changes`. Models
+        that share a table through inheritance see each other's changes."""
+        changelog = cls.env.db.changelog
+        assert changelog is not None, "The environment must be opened with changelog=True"
+        assert cls.env.in_context(), "An active transaction is required"
+        return list(changelog.changes(since, [cls.table.name], limit))
+        
+        
+    def remove_expired(cls, limit=1000, now=None):
+        """Remove up to ``limit`` expired instances from the model's table,
+        found through the expiry index, and return how many were removed."""
+        assert cls.expiry_index is not None, "%s has no ttl or expires_field" % cls.__name__
+        end = now if now is not None else time.time()
+        ids = list(itertools.islice(cls.expiry_index.range_ids(end=end), limit))
+        if ids:
+            cls.remove_many(ids)
+        return len(ids)
+        
+        
+    def validate_many(cls, docs):
+        return cls.validation_plan.validate_many(docs)
+        
+        
+    def remove_many(cls, ids):
+        cls.env.current_context().flush()
+        CascadeDelete(cls.env).remove(cls, ids)
+            
+            
+    def get_model_for(cls, data):
+        if '_type' in data:
+            parts = data['_type'].split(':')
+            return cls.env.models[parts[-1]]
+        else:
+            return cls
+            
+            
+    def load(cls, data, partial=False):
         if data:
-            if '_type' in data:
-                parts = data['_type'].split(':')
-                model = cls.env.models[parts[-1]]
-            else:
-                model = cls
+            if cls.hide_expired and is_expired(data):
+                return None
+            identity_map = cls.env.current_context().identity_map
+            inst = identity_map.get(data['id'])
+            if inst is not None:
+                if not partial:
+                    inst.load_deferred()
+                return inst
+            model = cls.get_model_for(data)
             data['_dirty'] = False
+            if partial:
+                data['_partial'] = True
             return model(**data)
+            
+            
+    def load_row(cls, data):
+        if data and not (cls.hide_expired and is_expired(data)):
+            return cls.get_model_for(data).get_row_class()(data)
+            
+            
+    def get_row_class(cls):
+        if '_row_class' not in cls.__dict__:
+            cls._row_class = make_row_class(cls)
+        return cls._row_class
 
 
 class BaseModel(object):
+    """Models with a ``ttl`` (in seconds) expire that long after they were
+    last saved. Models with an ``expires_field`` expire at the time in that
+    field, a datetime or seconds since the epoch. Expired instances are
+    removed by :meth:`remove_expired` or a :class:`~handbag.expiry.Sweeper`.
+    Until then they are still returned, unless ``hide_expired`` is set, in
+    which case ``get``, ``get_many`` and cursors skip them (counts don't).
+    """
     
     __metaclass__ = ModelMeta
+    __slots__ = ('id', '_dirty', '_changed', '_reference_fields', '_prefetched', '_deferred', '__weakref__')
+    
+    fields = []
+    validators = []
+    relationships = []
+    ttl = None
+    expires_field = None
+    hide_expired = False
+    expiry_index = None
         
     
     def __init__(self, **kwargs):
-        sup = super(BaseModel, self)
-        sup.__setattr__('_dirty', kwargs.pop('_dirty', True))
-        sup.__setattr__('_reference_fields', {})
-        
-        for k,v in self.validators:
-            field_value = kwargs.get(k, v.default())
-            sup.__setattr__(k, field_value)
+        self._dirty = kwargs.pop('_dirty', True)
+        self._changed = None if self._dirty else ()
+        self._reference_fields = None
+        self._prefetched = None
+        self._deferred = ()
+        
+        if kwargs.pop('_partial', False):
+            for k,field in self.fields:
+                if k in kwargs:
+                    field.init(self, kwargs[k])
+                else:
+                    self._deferred += (k,)
+        else:
+            for k,field in self.fields:
+                field.init(self, kwargs.get(k, field.validator.default()))
         for k,v in self.relationships:
             if k in kwargs:
+                if self._reference_fields is None:
+                    self._reference_fields = {}
                 self._reference_fields[k] = kwargs[k]
         
         if 'id' in kwargs:
-            sup.__setattr__('id', kwargs['id'])
+            self.id = kwargs['id']
         else:
-            sup.__setattr__('id', self.env.generate_id())
+            self.id = self.env.generate_id()
         
         self.env.instances.add(self)
-        self.env.current_context().enqueue(self)
-        
-        
-    def __setattr__(self, name, value):
-        if hasattr(self.__class__, name) and isinstance(getattr(self.__class__, name), Validator):
-            assert self.env.current_context().writable, "Transaction is read-only."
-            oldvalue = getattr(self, name)
-            if oldvalue != value:
-                self._dirty = True
-                super(BaseModel, self).__setattr__(name, value)
-                self.env.current_context().enqueue(self)
-        else:
-            super(BaseModel, self).__setattr__(name, value)
+        context = self.env.current_context()
+        context.enqueue(self)
+        context.identity_map.add(self)
         
     
     def __str__(self):
@@ -162,56 +384,129 @@ class BaseModel(object):
     
     
     def set_reference_field(self, name, value):
-        if value != self._reference_fields.get(name):
-            oldvalue = self._reference_fields.get(name)
+        if value != self.get_reference_field(name):
+            if self._reference_fields is None:
+                self._reference_fields = {}
             self._reference_fields[name] = value
+            self.clear_prefetched(name)
             self._dirty = True
             self.env.current_context().enqueue(self)
             
             
     def get_reference_field(self, name):
+        if self._reference_fields is None:
+            return None
         return self._reference_fields.get(name)
     
         
     def remove_reference_field(self, name):
-        if name in self._reference_fields:
+        if self._reference_fields and name in self._reference_fields:
             self._reference_fields.pop(name)
+            self.clear_prefetched(name)
             self._dirty = True
             self.env.current_context().enqueue(self)
         
         
+    def set_prefetched(self, name, value):
+        if self._prefetched is None:
+            self._prefetched = {}
+        self._prefetched[name] = value
+        
+        
+    def get_prefetched(self, name):
+        return self._prefetched[name]
+        
+        
+    def has_prefetched(self, name):
+        return self._prefetched is not None and name in self._prefetched
+        
+        
+    def clear_prefetched(self, name):
+        if self._prefetched is not None:
+            self._prefetched.pop(name, None)
+        
+        
     def is_dirty(self):
         return self._dirty
         
         
+    def estimate_size(self):
+        values = {}
+        for k,field in self.fields:
+            if k not in self._deferred:
+                values[k] = field.__get__(self, None)
+        if self._reference_fields:
+            values.update(self._reference_fields)
+        return dson.estimate_size(values)
+        
+        
+    def is_deferred(self, name):
+        return name in self._deferred
+        
+        
+    def load_deferred(self):
+        """Load the fields left out of a projected query."""
+        if not self._deferred:
+            return
+        data = self.table.get(self.id) or {}
+        fields = dict(self.fields)
+        for k in self._deferred:
+            field = fields[k]
+            field.init(self, data.get(k, field.validator.default()))
+        self._deferred = ()
+        
+        
     def remove(self):
-        for k,v in self.relationships:
-            v.on_owner_remove(self)
-        self.table.remove(self.id)
+        self.__class__.remove_many([self.id])
+        self.mark_removed()
+        
+        
+    def mark_removed(self):
         self._dirty = False
         
         
+    def touch(self):
+        """Save the instance at the end of the transaction even if it hasn't
+        changed, restarting its ``ttl``."""
+        self._dirty = True
+        self.env.current_context().enqueue(self)
+        
+        
+    def get_expiry(self):
+        """Return the time in seconds since the epoch when the instance
+        expires, or None if it doesn't."""
+        if self.expires_field is not None:
+            return to_timestamp(getattr(self, self.expires_field))
+        if self.ttl is not None:
+            return time.time() + self.ttl
+        
+        
     def save(self):
         if self.is_dirty():
             doc = self.validate()
             doc = self.table.save(doc)
-            super(BaseModel, self).__setattr__('id', doc['id'])
+            self.id = doc['id']
+            self._changed = ()
         
         
     def validate(self):
-        validators = {}
+        assert not self._deferred, \
+            "Can't save %s without its deferred fields: %s" % (self, ', '.join(self._deferred))
         values = {}
-        for k,v in self.validators:
-            validators[k] = v
-            values[k] = getattr(self, k)
-        group_validator = GroupValidator(**validators)
-        validated = group_validator.validate(values)
+        for k,field in self.fields:
+            values[k] = field.__get__(self, None)
+        validated = self.validation_plan.validate(values, changed=self._changed)
         validated['id'] = self.id
-        validated.update(self._reference_fields)
+        if self._reference_fields:
+            validated.update(self._reference_fields)
         
         if self._type:
             validated['_type'] = self._type
         
+        expires = self.get_expiry()
+        if expires is not None:
+            validated[EXPIRES] = expires
+        
         return validated
         
         
@@ -220,11 +515,80 @@ class BaseModel(object):
         for k,v in self.validators:
             values[k] = getattr(self, k)
         values['id'] = self.id
-        values.update(self._reference_fields)
+        if self._reference_fields:
+            values.update(self._reference_fields)
         return values
         
         
-from functools import wraps
+class Row(tuple):
+    """An immutable, read-only record of a stored model instance. Rows are
+    what read-only cursors yield. They skip the instance registry, the
+    identity map and dirty tracking, so they are much cheaper to build than
+    model instances. Fields are read as attributes and relationships 
+    return rows (or tuples of rows for to-many relationships)."""
+    
+    __slots__ = ()
+    model = None
+    columns = ()
+    references = {}
+    
+    
+    def __new__(cls, data):
+        return tuple.__new__(cls, [data.get(k) for k in cls.columns])
+        
+        
+    def get_reference_field(self, name):
+        i = self.references.get(name)
+        if i is not None:
+            return self[i]
+            
+            
+    def has_prefetched(self, name):
+        return False
+        
+        
+    def to_dict(self):
+        values = dict(zip(self.columns, self))
+        for k in self.references:
+            if values[k] is None:
+                values.pop(k)
+        return values
+        
+        
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.id)
+        
+        
+class RowRelationship(object):
+    
+    def __init__(self, rel):
+        self.rel = rel
+        
+        
+    def __get__(self, row, cls):
+        if row is None:
+            return self.rel
+        return self.rel.get_rows(row)
+        
+        
+def make_row_class(model):
+    field_names = ['id'] + [k for k, field in model.fields]
+    relationships = inspect.getmembers(model, lambda x: isinstance(x, Relationship))
+    reference_names = [k for k, rel in relationships if isinstance(rel, One)]
+    attrs = {
+        '__slots__': (),
+        'model': model,
+        'columns': tuple(field_names + reference_names),
+        'references': dict([(k, len(field_names) + i) for i, k in enumerate(reference_names)])
+    }
+    for i, k in enumerate(field_names):
+        attrs[k] = property(itemgetter(i))
+    for k, rel in relationships:
+        attrs[k] = RowRelationship(rel)
+    return type('%sRow' % model.__name__, (Row,), attrs)
+    
+    
+from functools import wraps, partial
 
 
 class ModelAdaptor(object):
@@ -236,6 +600,9 @@ class ModelAdaptor(object):
     def __init__(self, model, adapted):
         self.model = model
         self.adapted = adapted
+        self.load = model.load
+        self.prefetch_names = ()
+        self.projected = False
         
         for k in self.functions:
             setattr(self, k, self.adapt_function(getattr(self.adapted, k)))
@@ -252,16 +619,61 @@ class ModelAdaptor(object):
         @wraps(fn)
         def wrapper(*args, **kwargs):
             data = fn(*args, **kwargs)
-            return self.model.load(data)
+            inst = self.load(data)
+            if inst and self.prefetch_names:
+                prefetch([inst], self.prefetch_names)
+            return inst
         return wrapper
         
         
     def adapt_iterator(self, fn):
         @wraps(fn)
         def wrapper(*args, **kwargs):
-            for data in fn(*args, **kwargs):
-                yield self.model.load(data)
+            return self.load_all(fn(*args, **kwargs))
         return wrapper
+        
+        
+    def load_all(self, iterator):
+        instances = (self.load(data) for data in iterator)
+        if self.model.hide_expired:
+            instances = (inst for inst in instances if inst is not None)
+        if self.prefetch_names:
+            return prefetch_iter(instances, self.prefetch_names)
+        return instances
+        
+        
+    def prefetch(self, *names):
+        assert self.load != self.model.load_row, "Rows can't prefetch relationships"
+        self.prefetch_names = self.prefetch_names + names
+        return self
+        
+        
+    def as_rows(self):
+        assert not self.prefetch_names, "Rows can't prefetch relationships"
+        assert not self.projected, "Rows can't be projected"
+        self.load = self.model.load_row
+        return self
+        
+        
+    def only(self, *names):
+        """Only decode the named fields (plus the id, type and references).
+        The other fields are loaded from the table when they're first read."""
+        include = set(names) | set(['id', '_type']) | set(k for k, rel in self.model.relationships)
+        return self.project(include=include)
+        
+        
+    def defer(self, *names):
+        """Skip decoding the named fields. They are loaded from the table
+        when they're first read."""
+        return self.project(exclude=set(names))
+        
+        
+    def project(self, include=None, exclude=None):
+        assert self.load != self.model.load_row, "Rows can't be projected"
+        self.adapted.project(include=include, exclude=exclude)
+        self.projected = True
+        self.load = partial(self.model.load, partial=True)
+        return self
     
     
 class ModelCursorAdaptor(ModelAdaptor):
@@ -269,8 +681,7 @@ class ModelCursorAdaptor(ModelAdaptor):
     iterators = ['range', 'prefix', 'key']
     
     def __iter__(self):
-        for data in self.adapted:
-            yield self.model.load(data)
+        return self.load_all(self.adapted)
     
     
 class ModelIndexAdaptor(ModelAdaptor):
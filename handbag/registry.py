@@ -1,6 +1,7 @@
 import weakref
 import threading
 from functools import partial
+from collections import OrderedDict
 
 
 class ModelInstanceRegistry(object):
@@ -83,4 +84,41 @@ class BackreferenceRegistry(object):
         if model_name not in self._backrefs:
             self._backrefs[model_name] = {}
         self._backrefs[model_name][rel_name] = rel
-        
\ No newline at end of file
+            
+    
+    
+class IdentityMap(object):
+    
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self._instances = OrderedDict()
+        
+        
+    def get(self, id):
+        inst = self._instances.pop(id, None)
+        if inst is not None:
+            self._instances[id] = inst
+        return inst
+        
+        
+    def add(self, inst):
+        self._instances.pop(inst.id, None)
+        self._instances[inst.id] = inst
+        while len(self._instances) > self.max_size:
+            self._instances.popitem(last=False)
+            
+            
+    def discard(self, id):
+        self._instances.pop(id, None)
+        
+        
+    def clear(self):
+        self._instances.clear()
+        
+        
+    def __contains__(self, id):
+        return id in self._instances
+        
+        
+    def __len__(self):
+        return len(self._instances)
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 from index import BaseKeyIndexCollectionProxy
+import dson
 
 __all__ = [
     'One',
@@ -99,11 +101,20 @@ class Relationship(object):
         raise NotImplementedError
         
         
-    def on_owner_remove(self, owner):
+    def on_owner_remove(self, owner_id, doc, deletion):
         if self._cascade:
-            self.cascade(owner)
+            self.cascade(owner_id, doc, deletion)
             
             
+    def clear_prefetched(self, *owner_ids):
+        """Drop what was prefetched for this relationship on the loaded 
+        instances of ``owner_ids``."""
+        for id in owner_ids:
+            if id:
+                for inst in self.env.instances[id]:
+                    inst.clear_prefetched(self.name)
+                    
+                    
     def on_inverse_set(self):
         pass
         
@@ -154,11 +165,56 @@ class Relationship(object):
         raise NotImplementedError
         
         
-    def cascade(self, owner):
+    def cascade(self, owner_id, doc, deletion):
+        raise NotImplementedError
+        
+        
+    def prefetch(self, owners):
+        raise NotImplementedError
+        
+        
+    def get_rows(self, owner):
         raise NotImplementedError
 
 
 
+def prefetch(instances, names):
+    """Load the relationships called ``names`` for all of ``instances`` in bulk
+    and attach the results to the instances so that reading the relationships
+    afterwards doesn't touch the database."""
+    for name in names:
+        groups = OrderedDict()
+        for inst in instances:
+            if inst is None:
+                continue
+            rel = getattr(inst.__class__, name, None)
+            assert isinstance(rel, Relationship), \
+                "%s has no relationship called '%s'" % (inst.__class__.__name__, name)
+            groups.setdefault(rel, []).append(inst)
+        for rel, owners in groups.items():
+            rel.prefetch(owners)
+            
+            
+def prefetch_iter(iterator, names, batch_size=100):
+    batch = []
+    for inst in iterator:
+        batch.append(inst)
+        if len(batch) >= batch_size:
+            prefetch(batch, names)
+            for inst in batch:
+                yield inst
+            batch = []
+    if batch:
+        prefetch(batch, names)
+        for inst in batch:
+            yield inst
+            
+            
+def sorted_by_id(instances):
+    return sorted(instances, key=lambda inst: dson.dumpone(inst.id))
+
+
+
 class One(Relationship):
     
     def __init__(self, target_model, inverse=None):
@@ -168,20 +224,38 @@ class One(Relationship):
         
         
     def get(self, owner):
+        if owner.has_prefetched(self.name):
+            return owner.get_prefetched(self.name)
         id = owner.get_reference_field(self.name)
         if id:
             return self.get_target_model().get(id)
+            
+            
+    def get_rows(self, owner):
+        id = owner.get_reference_field(self.name)
+        if id:
+            return self.get_target_model().get_row(id)
+            
+            
+    def prefetch(self, owners):
+        ids = [owner.get_reference_field(self.name) for owner in owners]
+        targets = self.get_target_model().get_many([id for id in ids if id])
+        for owner, id in zip(owners, ids):
+            owner.set_prefetched(self.name, targets.get(id) if id else None)
         
         
     def set(self, owner, target, update_inverse=True):
+        previous_id = owner.get_reference_field(self.name)
         for obj in self.env.instances[owner.id]:
             obj.set_reference_field(self.name, target.id)
+        if self._inverse and previous_id != target.id:
+            self._inverse.clear_prefetched(previous_id, target.id)
         
         
-    def cascade(self, owner):
-        target = self.get(owner)
-        if target:
-            target.remove()
+    def cascade(self, owner_id, doc, deletion):
+        target_id = doc.get(self.name)
+        if target_id:
+            deletion.enqueue(self.get_target_model(), [target_id])
 
         
 class OneToOne(One):
@@ -237,12 +311,18 @@ class Many(Relationship):
         raise NotImplementedError
         
         
+    def iter_ids(self, owner_id):
+        raise NotImplementedError
+        
+        
     def get(self, owner):
         return ManyProxy(self, owner)
         
         
-    def cascade(self, owner):
-        self.remove(owner)
+    def get_rows(self, owner):
+        target_model = self.get_target_model()
+        rows = [target_model.get_row(id) for id in self.iter_ids(owner.id)]
+        return tuple([row for row in rows if row is not None])
         
         
     def add(self, owner, target):
@@ -270,6 +350,7 @@ class ManyProxy(object):
     def __init__(self, rel, owner):
         self._rel = rel
         self._owner = owner
+        self._prefetch_names = ()
         self.indexes = BaseKeyIndexCollectionProxy(
             self._rel.get_target_model().indexes,
             self._rel.base_index_key(owner)
@@ -280,7 +361,18 @@ class ManyProxy(object):
         
         
     def __iter__(self):
-        return self._rel.iter(self._owner)
+        if self._owner.has_prefetched(self._rel.name):
+            iterator = iter(self._owner.get_prefetched(self._rel.name))
+        else:
+            iterator = self._rel.iter(self._owner)
+        if self._prefetch_names:
+            return prefetch_iter(iterator, self._prefetch_names)
+        return iterator
+        
+        
+    def prefetch(self, *names):
+        self._prefetch_names = self._prefetch_names + names
+        return self
         
         
     def __contains__(self, obj):
@@ -325,21 +417,39 @@ class OneToMany(Many):
         return ManyToOne(self.model)
         
         
+    def prefetch(self, owners):
+        for owner in sorted_by_id(owners):
+            owner.set_prefetched(self.name, list(self.iter(owner)))
+        
+        
     def add(self, owner, target):
+        previous_id = target.get_reference_field(self._inverse_name)
         target.set_reference_field(self._inverse_name, owner.id)
+        owner.clear_prefetched(self.name)
+        self.clear_prefetched(previous_id, owner.id)
         
         
     def remove(self, owner, target):
+        previous_id = target.get_reference_field(self._inverse_name)
         target.remove_reference_field(self._inverse_name)
+        owner.clear_prefetched(self.name)
+        self.clear_prefetched(previous_id, owner.id)
         
         
     def count(self, owner):
         return self.get_target_model().indexes[self._inverse_name].cursor().count_key(owner.id)
         
         
-    def cascade(self, owner):
-        for target in list(self.iter(owner)):
-            target.remove()
+    def cascade(self, owner_id, doc, deletion):
+        deletion.enqueue_scan(self, owner_id)
+        
+        
+    def iter_ids(self, owner_id):
+        return self.get_target_model().indexes[self._inverse_name].ids(owner_id)
+        
+        
+    def forget_cascade_ids(self, owner_id, ids):
+        self.get_target_model().indexes[self._inverse_name].remove_ids(owner_id, ids)
             
             
     def contains(self, owner, obj):
@@ -358,13 +468,9 @@ class ManyToMany(Many):
     def setup_indexes(self):
         self.full_name = "%s.%s" % (self.model.__name__, self.name)
         self.full_inverse_name = "%s.%s" % (self.get_target_model_name(), self._inverse_name)
-        join_table_name = ','.join(sorted([self.full_name, self.full_inverse_name]))
-        self.join_table = self.model.env.db[join_table_name]
-        self.model_names = tuple(sorted([self.model.__name__, self.get_target_model_name()]))
-        if self.model_names not in self.join_table.indexes:
-            self.join_table.indexes.add(*self.model_names)
-            self.join_table.indexes.add(self.model_names[0])
-            self.join_table.indexes.add(self.model_names[1])
+        edge_store_name = ','.join(sorted([self.full_name, self.full_inverse_name]))
+        self.edges = self.model.env.db.get_edge_store(edge_store_name, 
+            (self.full_name, self.full_inverse_name))
         
         target_model = self.get_target_model()
         for fields in self.indexes:
@@ -372,23 +478,63 @@ class ManyToMany(Many):
                 fields = (fields,)
             fields = ( (self.full_name, self.get_owner_ids), ) + fields
             target_model.indexes.add(*fields)
+        self._virtual_indexes = None
             
     
     def get_owner_ids(self, doc):
-        owner_ids = []
-        for pair in self.join_table.indexes[self.get_target_model_name()].all(doc['id']):
-            owner_ids.append(pair[self.model.__name__])
-        return owner_ids
+        return list(self.edges.targets(self.full_inverse_name, doc['id']))
+        
+        
+    def iter_ids(self, owner_id):
+        return self.edges.targets(self.full_name, owner_id)
+        
+        
+    def get_virtual_indexes(self):
+        if self._virtual_indexes is None:
+            table_indexes = self.get_target_model().table.indexes
+            self._virtual_indexes = table_indexes.get_virtual(self.full_name)
+        return self._virtual_indexes
+        
+        
+    def update_virtual_indexes(self, owner_id, target_id, add=True):
+        indexes = self.get_virtual_indexes()
+        if not indexes:
+            return
+        doc = self.get_target_model().table.get(target_id)
+        if doc:
+            for index in indexes:
+                index.update_virtual(self.full_name, owner_id, doc, add=add)
+                
+                
+    def on_edge_change(self, owner_id, target_id, add=True):
+        self.update_virtual_indexes(owner_id, target_id, add=add)
+        self._inverse.update_virtual_indexes(target_id, owner_id, add=add)
         
         
     def iter(self, owner):
         target_model = self.get_target_model()
-        for doc in self.join_table.indexes[self.model.__name__].all(owner.id):
-            inst = target_model.get(doc[target_model.__name__])
+        dangling = []
+        for id in self.edges.targets(self.full_name, owner.id):
+            inst = target_model.get(id)
             if inst:
                 yield inst
             else:
-                self.join_table.remove(doc['id'])
+                dangling.append(id)
+        if dangling and self.env.db.dbm.is_transaction_writable():
+            for id in dangling:
+                if self.edges.remove(self.full_name, owner.id, id):
+                    self.on_edge_change(owner.id, id, add=False)
+        
+        
+    def prefetch(self, owners):
+        target_ids = {}
+        for owner in sorted_by_id(owners):
+            target_ids[owner.id] = list(self.edges.targets(self.full_name, owner.id))
+        targets = self.get_target_model().get_many(
+            [id for ids in target_ids.values() for id in ids])
+        for owner in owners:
+            owner.set_prefetched(self.name,
+                [targets[id] for id in target_ids[owner.id] if id in targets])
         
     
     def create_inverse(self):
@@ -401,43 +547,48 @@ class ManyToMany(Many):
         
         
     def add(self, owner, target):
-        if not self.contains(owner, target):
-            self.join_table.save(self.make_join_doc(owner, target))
+        if self.edges.add(self.full_name, owner.id, target.id):
+            self.on_edge_change(owner.id, target.id, add=True)
+        owner.clear_prefetched(self.name)
+        target.clear_prefetched(self._inverse_name)
         
         
     def remove(self, owner, target):
-        key = self.make_join_doc(owner, target)
-        existing = self.join_table.indexes[self.model_names].get(key)
-        if existing:
-            self.join_table.remove(existing['id'])
+        if self.edges.remove(self.full_name, owner.id, target.id):
+            self.on_edge_change(owner.id, target.id, add=False)
+        owner.clear_prefetched(self.name)
+        target.clear_prefetched(self._inverse_name)
+        
         
+    def on_owner_remove(self, owner_id, doc, deletion):
+        super(ManyToMany, self).on_owner_remove(owner_id, doc, deletion)
+        if not self._cascade:
+            for target_id in self.edges.remove_all(self.full_name, owner_id):
+                self.on_edge_change(owner_id, target_id, add=False)
         
-    def cascade(self, owner):
-        for target in self.iter(owner):
-            target.remove()
-        for doc in self.join_table.indexes[self.model.__name__].all(owner.id):
-            self.join_table.remove(doc['id'])
+        
+    def cascade(self, owner_id, doc, deletion):
+        # The edges are left for the scan to read a batch at a time. Removing
+        # the targets removes their edges, forget_cascade_ids the dangling ones.
+        deletion.enqueue_scan(self, owner_id)
+        
+        
+    def forget_cascade_ids(self, owner_id, ids):
+        for target_id in ids:
+            if self.edges.remove(self.full_name, owner_id, target_id):
+                self.on_edge_change(owner_id, target_id, add=False)
         
         
     def count(self, owner):
-        return self.join_table.indexes[self.model.__name__].cursor().count_key(owner.id)
+        return self.edges.count(self.full_name, owner.id)
         
         
     def contains(self, owner, obj):
         if isinstance(obj, self.get_target_model()):
-            key = self.make_join_doc(owner, obj)
-            return self.join_table.indexes[self.model_names].cursor().count_key(key)
+            return self.edges.contains(self.full_name, owner.id, obj.id)
         else:
             return False
         
         
     def base_index_key(self, owner):
         return [(self.full_name, owner.id)]
-        
-        
-    def make_join_doc(self, owner, target):
-        return {
-            self.model.__name__: owner.id,
-            self.get_target_model_name(): target.id
-        }
-        
\ No newline at end of file
@@ -6,9 +6,10 @@ import index
 
 class Table(object):
     
-    def __init__(self, dbm, name):
+    def __init__(self, dbm, name, changelog=None):
         self.dbm = dbm
         self.name = name
+        self.changelog = changelog
         self.dbm.add_namespace(name)
         self.indexes = index.IndexCollection(self.dbm, self.name)
         
@@ -24,6 +25,8 @@ class Table(object):
         value = dson.dumps(doc)
         self.dbm.put(self.name, key, value)
         self.indexes.update(old_doc, doc)
+        if self.changelog:
+            self.changelog.append('save', table=self.name, id=doc['id'], value=value)
         return doc
         
         
@@ -33,23 +36,46 @@ class Table(object):
         self.indexes.remove(doc)
         key = dson.dumpone(id)
         self.dbm.delete(self.name, key)
+        if self.changelog:
+            self.changelog.append('remove', table=self.name, id=id)
+        
+        
+    def remove_many(self, docs):
+        assert self.dbm.is_transaction_writable(), "Transaction is read-only"
+        self.indexes.remove_many(docs)
+        for key in sorted(self.dump_key(doc['id']) for doc in docs):
+            self.dbm.delete(self.name, key)
+        if self.changelog:
+            self.changelog.append('remove_many', table=self.name, ids=[doc['id'] for doc in docs])
         
         
     def remove_all(self):
         assert self.dbm.is_transaction_writable(), "Transaction is read-only"
         self.indexes.remove_all()
         self.dbm.delete_all(self.name)
+        if self.changelog:
+            self.changelog.append('remove_all', table=self.name)
         
         
     def get(self, id):
         key = dson.dumpone(id)
-        value = self.dbm.get(self.name, key)
-        if value is None:
-            return None
-        else:
-            return dson.loads(value)
+        return self.dbm.get_decoded(self.name, key, dson.loads)
             
             
+    def get_many(self, ids):
+        keys = sorted((self.dump_key(id), id) for id in set(ids))
+        docs = {}
+        for key, id in keys:
+            doc = self.dbm.get_decoded(self.name, key, dson.loads)
+            if doc is not None:
+                docs[id] = doc
+        return docs
+        
+        
+    def dump_key(self, id):
+        return dson.dumpone(id)
+        
+        
     def count(self):
         return self.dbm.count(self.name)
         
@@ -70,6 +70,7 @@ __all__ = [
     'InvalidGroupError',
     'Validator',
     'GroupValidator',
+    'ValidationPlan',
     'Text',
     'Email',
     'DateTime',
@@ -181,26 +182,68 @@ class GroupValidator(Validator):
     def validate(self, value):
         if not isinstance(value, dict):
             raise InvalidError(self.NOT_A_DICT)
+        return ValidationPlan(self.validators.items()).validate(value)
+
+
+class ValidationPlan(object):
+    """
+    A compiled form of :class:`GroupValidator` for validating many dicts with
+    the same validators. The validators are flattened once into an ordered 
+    tuple of ``(name, validator, optional, default)`` steps::
+    
+        plan = ValidationPlan([('foo', Text()), ('bar', TypeOf(int, optional=True, default=8))])
+        plan.validate({'foo':'ice cream'}) # -> {'foo':'ice cream', 'bar': 8}
+        
+        # only validate the fields that changed, pass the rest through
+        plan.validate({'foo':'pie', 'bar':9}, changed=('foo',))
         
+        # validate a batch, errors are keyed by position
+        plan.validate_many([{'foo':'a'}, {'foo':23}]) # InvalidGroupError({1: ...})
+    """
+    
+    def __init__(self, validators):
+        self.steps = tuple([(k, v, v._optional, v._default) for k,v in sorted(validators)])
+        
+        
+    def validate(self, value, changed=None):
         validated = {}
         errors = {}
         
-        for k,v in self.validators.items():
+        for k, v, optional, default in self.steps:
             if k in value and value[k] != "" and value[k] is not None:
+                if changed is not None and k not in changed:
+                    validated[k] = value[k]
+                    continue
                 try:
                     validated[k] = v.validate(value[k])
                 except InvalidError, e:
                     errors[k] = e
             else:
-                if not v._optional:
-                    errors[k] = self.MISSING_REQUIRED
+                if not optional:
+                    errors[k] = GroupValidator.MISSING_REQUIRED
                     continue
-                validated[k] = v._default
+                validated[k] = default
         
         if errors:
             raise InvalidGroupError(errors)
         
         return validated
+        
+        
+    def validate_many(self, values):
+        validated = []
+        errors = {}
+        
+        for i, value in enumerate(values):
+            try:
+                validated.append(self.validate(value))
+            except InvalidGroupError, e:
+                errors[i] = e
+                
+        if errors:
+            raise InvalidGroupError(errors)
+        
+        return validated
 
 
 class Text(Validator):
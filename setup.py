@@ -4,7 +4,7 @@ execfile('handbag/version.py')
 setup(
     name = 'handbag',
     version = __version__,
-    packages = find_packages(),
+    packages = find_packages(exclude=['benchmarks', 'benchmarks.*']),
     description = 'An embedded database and data modeling library for python.',
     author = 'Elisha Fitch-Cook',
     author_email = 'elisha@elishacook.com',
@@ -13,5 +13,8 @@ setup(
     install_requires=[
         'lmdb>=0.78',
         'pytz'
-    ]
+    ],
+    extras_require={
+        'aio': ['trollius']
+    }
 )
@@ -0,0 +1,181 @@
+import unittest
+import os.path
+import shutil
+import threading
+from handbag.validators import *
+
+try:
+    from handbag import aio
+    asyncio = aio.asyncio
+except ImportError:
+    aio = None
+
+TEST_PATH = "/tmp/handbag-test.db"
+TEST_URL = os.environ.get("HANDBAG_TEST_URL", "lmdb://%s" % TEST_PATH)
+
+
+@unittest.skipIf(aio is None, "asyncio or trollius is required")
+class TestAsyncEnvironment(unittest.TestCase):
+    
+    def setUp(self):
+        if os.path.exists(TEST_PATH):
+            shutil.rmtree(TEST_PATH)
+        self.env = aio.open(TEST_URL, max_workers=2, batch_size=3)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        
+        
+    def tearDown(self):
+        self.env.close()
+        self.loop.close()
+        
+        
+    def run_task(self, coro):
+        return self.loop.run_until_complete(coro)
+        
+        
+    def test_run_read_write(self):
+        class Foo(self.env.Model):
+            name = Text()
+            
+        foo_id = self.run_task(self.env.run_write(lambda: Foo(name="Bob").id))
+        name = self.run_task(self.env.run_read(lambda: Foo.get(foo_id).name))
+        self.assertEqual(name, "Bob")
+        
+        with self.assertRaises(InvalidGroupError):
+            self.run_task(self.env.run_write(lambda: Foo(name=5).id))
+            
+            
+    def test_contexts(self):
+        env = self.env
+        
+        class Foo(env.Model):
+            name = Text()
+            
+        @asyncio.coroutine
+        def scenario():
+            ctx = env.awrite()
+            yield asyncio.From(ctx.enter())
+            ids = yield asyncio.From(env.call(lambda: [Foo(name="Foo %d" % i).id for i in range(10)]))
+            yield asyncio.From(ctx.exit())
+            
+            ctx = env.aread()
+            yield asyncio.From(ctx.enter())
+            foo = yield asyncio.From(Foo.aget(ids[3]))
+            
+            nested = env.aread()
+            yield asyncio.From(nested.enter())
+            self.assertIs(nested.worker, ctx.worker)
+            yield asyncio.From(nested.exit())
+            
+            cursor = Foo.acursor()
+            names = []
+            while True:
+                batch = yield asyncio.From(cursor.next_batch())
+                if not batch:
+                    break
+                self.assertTrue(len(batch) <= 3)
+                names.extend(f.name for f in batch)
+                
+            rows = []
+            cursor = Foo.acursor(readonly=True)
+            while True:
+                try:
+                    row = yield asyncio.From(cursor.__anext__())
+                except aio.StopAsyncIteration:
+                    break
+                rows.append(row)
+            yield asyncio.From(ctx.exit())
+            raise asyncio.Return((foo.name, names, len(rows)))
+            
+        name, names, num_rows = self.run_task(scenario())
+        self.assertEqual(name, "Foo 3")
+        self.assertEqual(sorted(names), sorted("Foo %d" % i for i in range(10)))
+        self.assertEqual(num_rows, 10)
+        
+        
+    def test_backpressure(self):
+        env = self.env
+        
+        class Foo(env.Model):
+            name = Text()
+            
+        active = []
+        most_active = []
+        
+        @asyncio.coroutine
+        def reader():
+            ctx = env.aread()
+            yield asyncio.From(ctx.enter())
+            active.append(ctx)
+            most_active.append(len(active))
+            count = yield asyncio.From(env.call(Foo.count))
+            active.remove(ctx)
+            yield asyncio.From(ctx.exit())
+            raise asyncio.Return(count)
+            
+        counts = self.run_task(asyncio.gather(*[reader() for i in range(6)], loop=self.loop))
+        self.assertEqual(counts, [0] * 6)
+        self.assertTrue(max(most_active) <= 2)
+        self.assertEqual(len(env.pool.workers), 2)
+        
+        
+    def test_cancel(self):
+        env = self.env
+        
+        class Foo(env.Model):
+            name = Text()
+            
+        def interrupt():
+            raise KeyboardInterrupt
+            
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_task(env.run_read(interrupt))
+        self.assertEqual(self.run_task(env.run_read(Foo.count)), 0)
+        
+        held = asyncio.Event(loop=self.loop)
+        
+        @asyncio.coroutine
+        def hold():
+            ctx = env.aread()
+            yield asyncio.From(ctx.enter())
+            yield asyncio.From(held.wait())
+            yield asyncio.From(ctx.exit())
+            
+        @asyncio.coroutine
+        def write():
+            ctx = env.awrite()
+            yield asyncio.From(ctx.enter())
+            foo_id = yield asyncio.From(env.call(lambda: Foo(name="Foo").id))
+            yield asyncio.From(ctx.exit())
+            raise asyncio.Return(foo_id)
+            
+        @asyncio.coroutine
+        def scenario():
+            holders = [asyncio.Task(hold(), loop=self.loop) for i in range(2)]
+            waiting = asyncio.Task(write(), loop=self.loop)
+            yield asyncio.From(asyncio.sleep(0.01, loop=self.loop))
+            waiting.cancel()
+            held.set()
+            yield asyncio.From(asyncio.wait(holders, loop=self.loop))
+            
+            ctx = env.awrite()
+            started = threading.Event()
+            def enter_context():
+                started.wait()
+                aio.AsyncContext.enter_context(ctx)
+            ctx.enter_context = enter_context
+            entering = ctx.enter()
+            while ctx.worker is None:
+                yield asyncio.From(asyncio.sleep(0, loop=self.loop))
+            entering.cancel()
+            started.set()
+            
+            foo_id = yield asyncio.From(asyncio.wait_for(write(), 5, loop=self.loop))
+            raise asyncio.Return((waiting.cancelled(), entering.cancelled(), foo_id))
+            
+        waiting_cancelled, entering_cancelled, foo_id = self.run_task(scenario())
+        self.assertTrue(waiting_cancelled and entering_cancelled)
+        self.assertEqual(self.run_task(env.run_read(Foo.count)), 1)
+        self.assertEqual(len(env.pool.idle), len(env.pool.workers))
+        self.assertEqual(env.contexts, {})
@@ -5,7 +5,7 @@ from datetime import datetime, timedelta
 from handbag import database
 
 TEST_PATH = "/tmp/handbag-test.db"
-TEST_URL = "lmdb://%s" % TEST_PATH
+TEST_URL = os.environ.get("HANDBAG_TEST_URL", "lmdb://%s" % TEST_PATH)
 
 
 class TestCursor(unittest.TestCase):
@@ -48,6 +48,18 @@ class TestCursor(unittest.TestCase):
             self.assertEqual(records, self.records)
             
             
+    def test_batches(self):
+        with self.db.read():
+            batches = list(self.table.cursor().batches(size=8))
+            self.assertEqual([len(b) for b in batches], [8, 8, 4])
+            self.assertEqual(sum(batches, []), self.records)
+            
+            batches = list(self.table.cursor(reverse=True).batches(size=8))
+            self.assertEqual(sum(batches, []), list(reversed(self.records)))
+            
+            self.assertEqual(list(self.empty_table.cursor().batches()), [])
+            
+            
     def test_range(self):
         with self.db.read():
             records = list(self.table.cursor().range('03','07'))
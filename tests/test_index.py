@@ -5,7 +5,8 @@ import string
 from handbag import database
 
 TEST_PATH = "/tmp/handbag-test.db"
-TEST_URL = "lmdb://%s" % TEST_PATH
+TEST_URL = os.environ.get("HANDBAG_TEST_URL", "lmdb://%s" % TEST_PATH)
+LMDB = TEST_URL.startswith("lmdb:")
 
 
 class TestIndex(unittest.TestCase):
@@ -134,6 +135,7 @@ class TestIndex(unittest.TestCase):
             self.assertEqual(foos.indexes['skidoo'].count(), 20)
             
             
+    @unittest.skipUnless(LMDB, "Needs a persistent backend")
     def test_sync(self):
         foos = self.db.foos
         foos.indexes.add('skidoo')
@@ -1,11 +1,23 @@
 import unittest
 import os.path
 import shutil
+import time
+import datetime
+import logging
+import threading
+import pytz
+from StringIO import StringIO
 from handbag import environment
 from handbag.validators import *
+from handbag.relationships import ManyToMany
+from handbag.changelog import ReplicaBehind
 
 TEST_PATH = "/tmp/handbag-test.db"
-TEST_URL = "lmdb://%s" % TEST_PATH
+TEST_URL = os.environ.get("HANDBAG_TEST_URL", "lmdb://%s" % TEST_PATH)
+LMDB = TEST_URL.startswith("lmdb:")
+BACKUP_PATH = "/tmp/handbag-backup.db"
+REPLICA_PATH = "/tmp/handbag-replica.db"
+REPLICA_URL = "lmdb://%s" % REPLICA_PATH if LMDB else "memory://"
 
 
 class TestModel(unittest.TestCase):
@@ -308,4 +320,577 @@ class TestModel(unittest.TestCase):
             self.assertEquals(x.__class__.__name__, 'Bar')
             x = Foo.indexes['skidoo'].get(23)
             self.assertEquals(x.__class__.__name__, 'Baz')
-            
\ No newline at end of file
+                        
+            
+    def test_identity_map(self):
+        class Foo(self.env.Model):
+            name = Text()
+            
+        with self.env.write():
+            foo = Foo(name="Sleepy")
+            foo_id = foo.id
+            self.assertTrue(Foo.get(foo_id) is foo)
+            
+        with self.env.read():
+            foo1 = Foo.get(foo_id)
+            self.assertTrue(foo1 is not foo)
+            self.assertTrue(Foo.get(foo_id) is foo1)
+            self.assertTrue(Foo.cursor().first() is foo1)
+            
+        with self.env.read():
+            self.assertTrue(Foo.get(foo_id) is not foo1)
+            
+            
+    def test_identity_map_eviction(self):
+        env = environment.open(TEST_URL, identity_map_size=3)
+        
+        class Foo(env.Model):
+            pass
+        
+        with env.write():
+            ids = [Foo().id for i in range(0,5)]
+            
+        with env.read():
+            foos = [Foo.get(id) for id in ids]
+            self.assertEquals(len(env.current_context().identity_map), 3)
+            self.assertTrue(Foo.get(ids[4]) is foos[4])
+            self.assertTrue(Foo.get(ids[0]) is not foos[0])
+            
+            
+    def test_identity_map_remove(self):
+        class Foo(self.env.Model):
+            pass
+            
+        with self.env.write():
+            foo = Foo()
+            foo_id = foo.id
+            
+        with self.env.write():
+            foo = Foo.get(foo_id)
+            foo.remove()
+            self.assertEquals(Foo.get(foo_id), None)
+            
+            
+    def test_slots(self):
+        class Foo(self.env.Model):
+            name = Text()
+            
+        class Bar(Foo):
+            flavor = Enum('spicy', 'red')
+            
+        self.assertIsInstance(Bar.name, Text)
+        self.assertEquals(Bar.flavor.values, ('spicy', 'red'))
+        
+        with self.env.write():
+            bar = Bar(name="Baz", flavor='red')
+            self.assertFalse(hasattr(bar, '__dict__'))
+            with self.assertRaises(AttributeError):
+                bar.not_a_field = 5
+            bar_id = bar.id
+            
+        with self.env.write():
+            bar = Bar.get(bar_id)
+            self.assertFalse(bar.is_dirty())
+            bar.flavor = 'spicy'
+            self.assertTrue(bar.is_dirty())
+            
+        with self.env.read():
+            bar = Bar.get(bar_id)
+            self.assertEquals((bar.name, bar.flavor), ("Baz", 'spicy'))
+            
+            
+    def test_validate_changed_fields_only(self):
+        validated = []
+        
+        class Counted(Text):
+            def validate(self, value):
+                validated.append(value)
+                return super(Counted, self).validate(value)
+        
+        class Foo(self.env.Model):
+            name = Counted()
+            flavor = Counted()
+            
+        with self.env.write():
+            foo = Foo(name="Bob", flavor="spicy")
+            
+        self.assertEquals(sorted(validated), ["Bob", "spicy"])
+        del validated[:]
+        
+        with self.env.write():
+            foo = Foo.get(foo.id)
+            foo.flavor = "red"
+            
+        self.assertEquals(validated, ["red"])
+        
+        with self.env.read():
+            self.assertEquals(Foo.validate_many([{'name': "a", 'flavor': "b"}]), [{'name': "a", 'flavor': "b"}])
+            
+            
+    def test_projection(self):
+        class Foo(self.env.Model):
+            name = Text()
+            flavor = Text()
+            body = Anything()
+            indexes = ['flavor']
+            
+        with self.env.write():
+            foo = Foo(name="Bob", flavor="spicy", body={ 'tags': [u"a", u"b"] })
+            foo_id = foo.id
+            
+        with self.env.read():
+            foo = Foo.cursor().only('name').first()
+            self.assertEquals(foo.name, "Bob")
+            self.assertTrue(foo.is_deferred('flavor'))
+            self.assertTrue(foo.is_deferred('body'))
+            self.assertEquals(foo.body, { 'tags': [u"a", u"b"] })
+            self.assertFalse(foo.is_deferred('flavor'))
+            self.assertEquals(foo.flavor, "spicy")
+            
+        with self.env.read():
+            foo = Foo.indexes['flavor'].cursor().defer('body').first()
+            self.assertEquals((foo.name, foo.flavor), ("Bob", "spicy"))
+            self.assertTrue(foo.is_deferred('body'))
+            
+        with self.env.write():
+            foo = Foo.cursor().defer('body').first()
+            foo.body = { 'tags': [] }
+            foo.name = "Bill"
+            
+        with self.env.read():
+            self.assertEquals((Foo.get(foo_id).name, Foo.get(foo_id).body), ("Bill", { 'tags': [] }))
+            
+        with self.assertRaises(AssertionError):
+            with self.env.write():
+                foo = Foo.cursor().only('name').first()
+                foo.name = "Ben"
+                
+        with self.env.read():
+            self.assertEquals(Foo.get(foo_id).name, "Bill")
+
+            
+            
+    def test_projection_identity_map(self):
+        class Foo(self.env.Model):
+            name = Text()
+            flavor = Text()
+            
+        with self.env.write():
+            foo_id = Foo(name="Bob", flavor="spicy").id
+            
+        with self.env.write():
+            partial = list(Foo.cursor().only('name'))
+            foo = Foo.get(foo_id)
+            self.assertFalse(foo.is_deferred('flavor'))
+            foo.name = "Bill"
+            
+        with self.env.write():
+            partial = list(Foo.cursor().only('name'))
+            self.assertFalse(Foo.get_many([foo_id])[foo_id].is_deferred('flavor'))
+            partial = list(Foo.cursor().defer('flavor'))
+            foo = Foo.cursor().first()
+            self.assertFalse(foo.is_deferred('flavor'))
+            foo.flavor = "mild"
+            
+        with self.env.read():
+            foo = Foo.get(foo_id)
+            self.assertEquals((foo.name, foo.flavor), ("Bill", "mild"))
+            
+            
+    def test_nested_contexts(self):
+        class Foo(self.env.Model):
+            name = Text()
+            
+        with self.assertRaises(AssertionError):
+            self.env.current_context()
+            
+        with self.env.write():
+            outer = self.env.current_context()
+            foo = Foo(name="Bob")
+            with self.env.write():
+                inner = self.env.current_context()
+                self.assertNotEqual(inner, outer)
+                Foo(name="Bill")
+            self.assertIs(self.env.current_context(), outer)
+            
+        with self.env.write():
+            foo = Foo.get(foo.id)
+            foo.name = "Ben"
+            with self.env.write():
+                self.assertIs(Foo.get(foo.id), foo)
+                foo.name = "Bert"
+            self.assertIs(Foo.get(foo.id), foo)
+            
+        self.assertFalse(self.env.in_context())
+        
+        with self.env.read():
+            self.assertEquals(sorted(f.name for f in Foo.cursor()), ["Bert", "Bill"])
+            
+            
+    def test_concurrent_contexts(self):
+        class Foo(self.env.Model):
+            name = Text()
+            n = TypeOf(int)
+            
+        errors = []
+        writes_per_thread = 20
+        
+        def writer(n):
+            try:
+                for i in range(writes_per_thread):
+                    with self.env.write():
+                        context = self.env.current_context()
+                        foo = Foo(name="%s-%s" % (n, i), n=i)
+                        foo_id = foo.id
+                        assert self.env.current_context() is context
+                    with self.env.read():
+                        foo = Foo.get(foo_id)
+                        assert foo.name == "%s-%s" % (n, i), foo.name
+            except Exception, e:
+                errors.append(e)
+                
+        def reader():
+            try:
+                last = 0
+                for i in range(writes_per_thread):
+                    with self.env.read():
+                        context = self.env.current_context()
+                        count = Foo.count()
+                        assert count >= last
+                        last = count
+                        for foo in Foo.cursor():
+                            assert foo.name.endswith("-%s" % foo.n)
+                        assert self.env.current_context() is context
+            except Exception, e:
+                errors.append(e)
+                
+        threads = [threading.Thread(target=writer, args=(n,)) for n in range(8)]
+        threads += [threading.Thread(target=reader) for n in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+            
+        self.assertEquals(errors, [])
+        with self.env.read():
+            self.assertEquals(Foo.count(), 8 * writes_per_thread)
+            
+            
+    def test_transaction(self):
+        env = environment.open(TEST_URL + "?group_commit=1")
+        
+        class Foo(env.Model):
+            name = Text()
+            
+        def create(name):
+            return Foo(name=name).id
+            
+        ids = []
+        threads = [threading.Thread(target=lambda n=n: ids.append(env.transaction(create, "foo %s" % n))) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+            
+        with self.assertRaises(InvalidGroupError):
+            env.transaction(create, 5)
+            
+        with env.read():
+            self.assertEquals(sorted(Foo.get(id).name for id in ids), ["foo %s" % n for n in range(4)])
+            self.assertEquals(Foo.count(), 4)
+        env.db.close()
+            
+            
+    def test_flush_policy(self):
+        def check(expected_flushed, **kwargs):
+            if os.path.exists(TEST_PATH):
+                shutil.rmtree(TEST_PATH)
+            env = environment.open(TEST_URL, **kwargs)
+            
+            class Foo(env.Model):
+                name = Text()
+                
+            with env.write():
+                for i in range(50):
+                    Foo(name="x" * 100)
+                self.assertEquals(Foo.table.count(), expected_flushed)
+                self.assertEquals(len(env.current_context().queue), 50 - expected_flushed)
+                
+            with env.read():
+                self.assertEquals(Foo.count(), 50)
+                
+            env.db.close()
+            
+        check(48, max_queue_size=5)
+        check(45, flush_policy='bytes', max_queue_bytes=500)
+        check(0, flush_policy='commit')
+        
+        with self.assertRaises(AssertionError):
+            environment.open(TEST_URL, flush_policy='sometimes')
+            
+            
+    @unittest.skipUnless(LMDB, "LMDB only")
+    def test_backup(self):
+        class Foo(self.env.Model):
+            name = Text()
+            
+        with self.env.write():
+            foos = [Foo(name=u"foo %d" % i) for i in range(500)]
+            for foo in foos:
+                foo.save()
+        with self.env.write():
+            for foo in foos[10:]:
+                foo.remove()
+                
+        if os.path.exists(BACKUP_PATH):
+            shutil.rmtree(BACKUP_PATH)
+        stats = self.env.backup(BACKUP_PATH)
+        self.assertEqual(stats['bytes'], os.path.getsize(os.path.join(BACKUP_PATH, 'data.mdb')))
+        self.assertTrue(stats['bytes'] < os.path.getsize(os.path.join(TEST_PATH, 'data.mdb')))
+        self.assertTrue(stats['seconds'] >= 0)
+        
+        stream = StringIO()
+        streamed = self.env.backup_to(stream)
+        self.assertEqual(streamed['bytes'], len(stream.getvalue()))
+        self.assertEqual(stream.getvalue(), open(os.path.join(BACKUP_PATH, 'data.mdb'), 'rb').read())
+        
+        env = environment.open("lmdb://%s" % BACKUP_PATH)
+        
+        class Foo(env.Model):
+            name = Text()
+            
+        with env.read():
+            self.assertEqual(sorted(foo.name for foo in Foo.cursor()), sorted(u"foo %d" % i for i in range(10)))
+        env.db.close()
+        shutil.rmtree(BACKUP_PATH)
+        
+        
+    def test_replication(self):
+        self.env.db.close()
+        for path in (TEST_PATH, REPLICA_PATH):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        self.env = environment.open(TEST_URL, changelog=True)
+        replica = environment.open(REPLICA_URL)
+        
+        def define(env):
+            class Foo(env.Model):
+                name = Text()
+                bars = ManyToMany("Bar", inverse="foos")
+                indexes = ['name']
+                
+            class Bar(env.Model):
+                foos = ManyToMany(Foo, inverse="bars")
+                
+            return Foo, Bar
+            
+        Foo, Bar = define(self.env)
+        ReplicaFoo, ReplicaBar = define(replica)
+        replicator = self.env.replicate_to(replica, batch_size=10, truncate=True)
+        
+        with self.env.write():
+            foos = [Foo(name=u"foo %d" % i) for i in range(25)]
+            bar = Bar()
+            for foo in foos[:5]:
+                foo.bars.add(bar)
+        with self.env.write():
+            foos[0].bars.remove(bar)
+            foos[1].remove()
+            foos[2].name = u"renamed"
+            
+        lag = replicator.lag()
+        with self.env.read():
+            self.assertEqual(lag['entries'], self.env.db.changelog.last_seq())
+        self.assertTrue(lag['seconds'] > 0)
+        self.assertEqual(replicator.catch_up(), lag['entries'])
+        self.assertEqual(replicator.lag(), {'entries': 0, 'seconds': 0.0})
+        
+        with replica.read():
+            self.assertEqual(ReplicaFoo.count(), 24)
+            self.assertEqual(ReplicaFoo.indexes['name'].get(u"renamed").id, foos[2].id)
+            self.assertEqual(sorted(foo.id for foo in ReplicaBar.get(bar.id).foos), sorted(foo.id for foo in foos[2:5]))
+        with self.env.read():
+            self.assertEqual(self.env.db.changelog.first_seq(), lag['entries'])
+            
+        replicator.start()
+        with self.env.write():
+            Foo(name=u"late")
+        for i in range(100):
+            if replicator.lag()['entries'] == 0:
+                break
+            time.sleep(0.01)
+        replicator.stop()
+        self.assertEqual(replicator.error, None)
+        with replica.read():
+            self.assertEqual(ReplicaFoo.indexes['name'].get(u"late").name, u"late")
+        replica.db.close()
+        
+        if LMDB:
+            # A new replica seeded from a backup starts after the copied log
+            if os.path.exists(BACKUP_PATH):
+                shutil.rmtree(BACKUP_PATH)
+            with self.env.write():
+                Foo(name=u"before backup")
+            self.env.backup(BACKUP_PATH)
+            with self.env.write():
+                Foo(name=u"after backup")
+            seeded = environment.open("lmdb://%s" % BACKUP_PATH)
+            SeededFoo, SeededBar = define(seeded)
+            replicator = self.env.replicate_to(seeded)
+            self.assertEqual(replicator.catch_up(), 1)
+            with seeded.read():
+                self.assertEqual(SeededFoo.count(), 27)
+            seeded.db.close()
+            shutil.rmtree(BACKUP_PATH)
+            
+            # A replica that is behind a truncated log can't catch up
+            stale = self.env.replicate_to(environment.open("memory://"))
+            with self.assertRaises(ReplicaBehind):
+                stale.poll()
+                
+                
+    def test_changes(self):
+        self.env.db.close()
+        if os.path.exists(TEST_PATH):
+            shutil.rmtree(TEST_PATH)
+        self.env = environment.open(TEST_URL, changelog=True)
+        
+        class Foo(self.env.Model):
+            name = Text()
+            
+        class Bar(self.env.Model):
+            pass
+            
+        failed = []
+        def fail(changes):
+            failed.append(changes)
+            raise RuntimeError
+        logged = []
+        handler = logging.Handler()
+        handler.emit = logged.append
+        log = logging.getLogger('handbag.changelog')
+        log.addHandler(handler)
+        log.propagate = False
+        
+        notified = []
+        foo_notified = []
+        self.env.subscribe(fail)
+        self.env.subscribe(notified.append)
+        self.env.subscribe(foo_notified.append, [Foo])
+        
+        with self.env.write():
+            foos = [Foo(name=u"foo %d" % i) for i in range(3)]
+            Bar()
+        with self.env.write():
+            foos[0].remove()
+            foos[1].name = u"renamed"
+        with self.assertRaises(ValueError):
+            with self.env.write():
+                Foo(name=u"aborted")
+                raise ValueError
+        self.env.transaction(lambda: Foo(name=u"in transaction").id)
+        
+        self.assertEqual([len(changes) for changes in notified], [4, 2, 1])
+        self.assertEqual([len(changes) for changes in foo_notified], [3, 2, 1])
+        self.assertEqual([c['op'] for c in foo_notified[1]], ['remove', 'save'])
+        self.assertEqual([c['id'] for c in foo_notified[1]], [foos[0].id, foos[1].id])
+        
+        with self.env.read():
+            changes = Foo.changes()
+            self.assertEqual(changes, [c for batch in foo_notified for c in batch])
+            self.assertEqual([c['seq'] for c in Foo.changes(since=changes[2]['seq'])], [c['seq'] for c in changes[3:]])
+            self.assertEqual(len(Bar.changes()), 1)
+            
+        with self.env.write():
+            Foo.remove_many([foos[1].id, foos[2].id])
+        self.assertEqual(sorted(c['id'] for c in foo_notified[-1]), sorted([foos[1].id, foos[2].id]))
+        self.assertEqual(set(c['op'] for c in foo_notified[-1]), set(['remove']))
+        
+        changelog = self.env.db.changelog
+        with self.env.write():
+            self.assertEqual(changelog.retain(max_entries=3), 5)
+        with self.env.read():
+            self.assertEqual(changelog.first_seq(), changelog.last_seq() - 2)
+        with self.env.write():
+            self.assertEqual(changelog.retain(max_age=0), 2)
+            self.assertEqual(changelog.retain(max_age=0), 0)
+            
+        self.env.unsubscribe(notified.append)
+        with self.env.write():
+            Foo(name=u"late")
+        self.assertEqual(len(notified), 4)
+        self.assertEqual(len(foo_notified), 5)
+        self.assertEqual(len(failed), 5)
+        self.assertEqual(len(logged), 5)
+        self.assertEqual(logged[0].exc_info[0], RuntimeError)
+        log.removeHandler(handler)
+        log.propagate = True
+        
+        
+    def test_expiry(self):
+        class Session(self.env.Model):
+            user = Text()
+            ttl = 60
+            indexes = ['user']
+            
+        class Limit(self.env.Model):
+            key = Text()
+            expires_at = DateTime(optional=True)
+            expires_field = 'expires_at'
+            hide_expired = True
+            
+        now = time.time()
+        with self.env.write():
+            sessions = [Session(user=u"user %d" % i) for i in range(10)]
+            old = datetime.datetime.fromtimestamp(now - 10, pytz.utc)
+            later = datetime.datetime.fromtimestamp(now + 3600, pytz.utc)
+            expired = Limit(key=u"expired", expires_at=old)
+            current = Limit(key=u"current", expires_at=later)
+            forever = Limit(key=u"forever")
+            
+        with self.env.read():
+            self.assertEqual(Session.expiry_index.count(), 10)
+            self.assertEqual(Limit.expiry_index.count(), 2)
+            self.assertEqual(Limit.get(expired.id), None)
+            self.assertEqual(Limit.get(current.id).key, u"current")
+            self.assertEqual(sorted(Limit.get_many([expired.id, current.id])), [current.id])
+            self.assertEqual(sorted(l.key for l in Limit.cursor()), [u"current", u"forever"])
+            self.assertEqual(sorted(l.key for l in Limit.rows()), [u"current", u"forever"])
+            self.assertEqual(Limit.count(), 3)
+            
+        self.assertEqual(self.env.sweep_expired(), 1)
+        with self.env.read():
+            self.assertEqual(Limit.count(), 2)
+            self.assertEqual(Session.count(), 10)
+            
+        with self.env.write():
+            self.assertEqual(Session.remove_expired(limit=4, now=now + 61), 4)
+        time.sleep(0.01)
+        with self.env.write():
+            sessions[9].touch()
+        with self.env.read():
+            self.assertEqual(Session.count(), 6)
+            self.assertEqual(Session.indexes['user'].get(u"user 0"), None)
+            self.assertEqual(Session.expiry_index.count(), 6)
+            expiries = [Session.table.get(s.id)['_expires'] for s in sessions[4:]]
+            self.assertTrue(expiries[-1] > max(expiries[:-1]) + 0.005)
+            
+        with self.env.write():
+            self.assertEqual(Session.remove_expired(now=max(expiries[:-1]) + 0.001), 5)
+        with self.env.read():
+            self.assertEqual([s.id for s in Session.cursor()], [sessions[9].id])
+            
+        sweeper = self.env.sweeper(batch_size=2, interval=0.01)
+        with self.env.write():
+            Limit.get(current.id).expires_at = old
+        sweeper.start()
+        for i in range(100):
+            with self.env.read():
+                if Limit.count() == 1:
+                    break
+            time.sleep(0.01)
+        sweeper.stop()
+        self.assertEqual(sweeper.error, None)
+        with self.env.read():
+            self.assertEqual([l.key for l in Limit.cursor()], [u"forever"])
+            self.assertEqual(Limit.expiry_index.count(), 0)
@@ -1,12 +1,15 @@
 import unittest
 import os.path
 import shutil
-from handbag import environment
+from handbag import environment, database
 from handbag.validators import *
 from handbag.relationships import *
+from handbag.relationships import prefetch
+from handbag.cascade import CascadeDelete
 
 TEST_PATH = "/tmp/handbag-test.db"
-TEST_URL = "lmdb://%s" % TEST_PATH
+TEST_URL = os.environ.get("HANDBAG_TEST_URL", "lmdb://%s" % TEST_PATH)
+LMDB = TEST_URL.startswith("lmdb:")
 
 
 class TestRelationships(unittest.TestCase):
@@ -368,6 +371,267 @@ class TestRelationships(unittest.TestCase):
             for foo in foos[1:]:
                 self.assertEquals(foo.bars.count(), 10)
 
+    def test_rows(self):
+        class Foo(self.env.Model):
+            name = Text()
+            bars = OneToMany("Bar", inverse="foo")
+            
+        class Bar(self.env.Model):
+            name = Text()
+            tags = ManyToMany("Tag", inverse="bars")
+            
+        class Tag(self.env.Model):
+            name = Text()
+            
+        with self.env.write():
+            foo = Foo(name="foo")
+            tag = Tag(name="tofu")
+            for i in range(0,3):
+                bar = Bar(name="bar%d" % i)
+                foo.bars.add(bar)
+                bar.tags.add(tag)
+                
+        with self.env.read():
+            rows = list(Bar.rows())
+            self.assertEquals(sorted(r.name for r in rows), ["bar0", "bar1", "bar2"])
+            row = rows[0]
+            self.assertEquals(row.foo.name, "foo")
+            self.assertEquals([t.name for t in row.tags], ["tofu"])
+            self.assertEquals(sorted(b.name for b in row.foo.bars), ["bar0", "bar1", "bar2"])
+            self.assertEquals(row.to_dict(), Bar.get(row.id).to_dict())
+            with self.assertRaises(AttributeError):
+                row.name = "baz"
+            self.assertEquals(len(list(Foo.cursor(readonly=True))), 1)
+            
+            
+    def test_batched_cascade(self):
+        class Foo(self.env.Model):
+            bars = OneToMany("Bar", inverse="foo", cascade=True)
+            
+        class Bar(self.env.Model):
+            name = Text()
+            bazzes = OneToMany("Baz", inverse="bar", cascade=True)
+            tags = ManyToMany("Tag", inverse="bars", cascade=True)
+            indexes = ['name']
+            
+        class Baz(self.env.Model):
+            pass
+            
+        class Tag(self.env.Model):
+            pass
+            
+        with self.env.write():
+            foo = Foo()
+            other_bar = Bar(name="other")
+            for i in range(0,10):
+                bar = Bar(name="bar%d" % i)
+                foo.bars.add(bar)
+                bar.tags.add(Tag())
+                for j in range(0,4):
+                    bar.bazzes.add(Baz())
+            other_bar.bazzes.add(Baz())
+            
+        with self.env.write():
+            CascadeDelete(self.env, batch_size=3).remove(Foo, [foo.id])
+            
+        with self.env.read():
+            self.assertEquals(Foo.count(), 0)
+            self.assertEquals(Bar.count(), 1)
+            self.assertEquals(Baz.count(), 1)
+            self.assertEquals(Tag.count(), 0)
+            self.assertEquals(Bar.indexes['name'].count(), 1)
+            self.assertEquals(foo.bars.count(), 0)
+            self.assertEquals(Baz.indexes['bar'].count(), 1)
+            
+            
+    def test_batched_many_to_many_cascade(self):
+        class Foo(self.env.Model):
+            bars = ManyToMany("Bar", inverse="foos", cascade=True)
+            
+        class Bar(self.env.Model):
+            pass
+            
+        with self.env.write():
+            foo = Foo()
+            other_foo = Foo()
+            for i in range(0,10):
+                bar = Bar()
+                foo.bars.add(bar)
+                other_foo.bars.add(bar)
+            
+        batches = []
+        
+        class Deletion(CascadeDelete):
+            def remove_batch(self, model, ids):
+                batches.append((model, len(ids)))
+                return CascadeDelete.remove_batch(self, model, ids)
+        
+        with self.env.write():
+            Deletion(self.env, batch_size=3).remove(Foo, [foo.id])
+            
+        self.assertEquals(batches[0], (Foo, 1))
+        self.assertEquals([n for m, n in batches if m is Bar], [3, 3, 3, 1])
+        
+        with self.env.read():
+            self.assertEquals(Foo.count(), 1)
+            self.assertEquals(Bar.count(), 0)
+            self.assertEquals(other_foo.bars.count(), 0)
+            self.assertEquals(len(list(Foo.bars.edges.targets(Foo.bars.full_name, foo.id))), 0)
+            
+            
+    def test_prefetch(self):
+        class Foo(self.env.Model):
+            name = Text()
+            bars = OneToMany("Bar", inverse="foo")
+            
+        class Bar(self.env.Model):
+            tags = ManyToMany("Tag", inverse="bars")
+            
+        class Tag(self.env.Model):
+            name = Text()
+            
+        with self.env.write():
+            tags = [Tag(name="tag%d" % i) for i in range(0,3)]
+            foos = [Foo(name="foo%d" % i) for i in range(0,3)]
+            for i in range(0,9):
+                bar = Bar()
+                foos[i % 3].bars.add(bar)
+                bar.tags.add(tags[i % 3])
+                bar.tags.add(tags[(i + 1) % 3])
+                
+        dbm = self.env.db.dbm
+        dbm_get = dbm.get
+        calls = []
+        def counting_get(*args):
+            calls.append(args)
+            return dbm_get(*args)
+        
+        with self.env.read():
+            bars = list(Bar.cursor().prefetch('foo', 'tags'))
+            dbm.get = counting_get
+            try:
+                for bar in bars:
+                    self.assertIn(bar.foo.name, ["foo0", "foo1", "foo2"])
+                    self.assertEquals(len(list(bar.tags)), 2)
+            finally:
+                del dbm.get
+            self.assertEquals(calls, [])
+            
+        with self.env.read():
+            foo = Foo.get(foos[0].id)
+            bars = list(foo.bars.prefetch('tags'))
+            self.assertEquals(len(bars), 3)
+            for bar in bars:
+                self.assertTrue(bar.has_prefetched('tags'))
+                self.assertTrue(bar.foo is foo)
+            
+            
+    def test_prefetch_reassign(self):
+        class Foo(self.env.Model):
+            bars = OneToMany("Bar", inverse="foo")
+            
+        class Bar(self.env.Model):
+            pass
+            
+        with self.env.write():
+            foos = [Foo() for i in range(0,3)]
+            bars = [Bar() for i in range(0,2)]
+            foos[0].bars.add(bars[0])
+            foos[1].bars.add(bars[1])
+            
+        with self.env.write():
+            foos = [Foo.get(f.id) for f in foos]
+            prefetch(foos, ['bars'])
+            bar0, bar1 = [Bar.get(b.id) for b in bars]
+            
+            bar0.foo = foos[1]
+            self.env.current_context().flush()
+            self.assertEquals(len(list(foos[0].bars)), 0)
+            self.assertEquals(len(list(foos[1].bars)), 2)
+            
+            prefetch(foos, ['bars'])
+            foos[2].bars.add(bar1)
+            self.env.current_context().flush()
+            self.assertEquals(len(list(foos[1].bars)), 1)
+            self.assertEquals(len(list(foos[2].bars)), 1)
+            
+            prefetch(foos, ['bars'])
+            foos[2].bars.remove(bar1)
+            self.env.current_context().flush()
+            self.assertEquals(len(list(foos[2].bars)), 0)
+            
+            
+    def test_many_to_many_index_maintenance(self):
+        class Document(self.env.Model):
+            content = Text()
+            tags = ManyToMany("Tag", inverse="documents", indexes=['name'])
+            
+        class Tag(self.env.Model):
+            name = Text()
+            
+        with self.env.write():
+            doc = Document(content="foo")
+            tofu = Tag(name="tofu")
+            seitan = Tag(name="seitan")
+            
+        with self.env.write():
+            doc = Document.get(doc.id)
+            doc.tags.add(Tag.get(tofu.id))
+            doc.tags.add(Tag.get(seitan.id))
+            
+        with self.env.read():
+            doc = Document.get(doc.id)
+            self.assertEquals([t.name for t in doc.tags.indexes['name'].cursor()], ['seitan', 'tofu'])
+            
+        with self.env.write():
+            doc.tags.remove(Tag.get(tofu.id))
+            
+        with self.env.read():
+            doc = Document.get(doc.id)
+            self.assertEquals([t.name for t in doc.tags.indexes['name'].cursor()], ['seitan'])
+            
+        with self.env.write():
+            Tag.get(seitan.id).remove()
+            
+        with self.env.read():
+            doc = Document.get(doc.id)
+            self.assertEquals(list(doc.tags.indexes['name'].cursor()), [])
+            self.assertEquals(doc.tags.count(), 0)
+            
+            
+    @unittest.skipUnless(LMDB, "Needs a persistent backend")
+    def test_many_to_many_join_table_migration(self):
+        db = database.open(TEST_URL)
+        join_table = db['Bar.foos,Foo.bars']
+        join_table.indexes.add('Bar', 'Foo')
+        join_table.indexes.add('Bar')
+        join_table.indexes.add('Foo')
+        foos = db.Foo
+        bars = db.Bar
+        
+        with db.write():
+            foos.save({'id': 'foo1'})
+            bars.save({'id': 'bar1'})
+            bars.save({'id': 'bar2'})
+            join_table.save({'Foo': 'foo1', 'Bar': 'bar1'})
+            join_table.save({'Foo': 'foo1', 'Bar': 'bar2'})
+        db.close()
+        
+        env = environment.open(TEST_URL)
+        
+        class Foo(env.Model):
+            bars = ManyToMany("Bar", inverse="foos")
+            
+        class Bar(env.Model):
+            pass
+            
+        with env.read():
+            foo = Foo.get('foo1')
+            self.assertEquals(sorted(b.id for b in foo.bars), ['bar1', 'bar2'])
+            self.assertEquals([f.id for f in Bar.get('bar2').foos], ['foo1'])
+            self.assertEquals(env.db.dbm.count('Bar.foos,Foo.bars'), 0)
+            
+            
     def test_redefine_backreference_fails(self):
         class Foo(self.env.Model):
             pass
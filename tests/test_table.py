@@ -2,10 +2,12 @@ import unittest
 import os.path
 import shutil
 import threading
+import lmdb
 from handbag import database
 
 TEST_PATH = "/tmp/handbag-test.db"
-TEST_URL = "lmdb://%s" % TEST_PATH
+TEST_URL = os.environ.get("HANDBAG_TEST_URL", "lmdb://%s" % TEST_PATH)
+LMDB = TEST_URL.startswith("lmdb:")
 
 
 class TestTable(unittest.TestCase):
@@ -96,4 +98,416 @@ class TestTable(unittest.TestCase):
         t2.join()
         
         with self.db.read():
-            self.assertEqual(foos.count(), 2)
\ No newline at end of file
+            self.assertEqual(foos.count(), 2)        
+        
+    def test_group_commit(self):
+        db = database.open(TEST_URL + "?group_commit=1")
+        foos = db.foos
+        errors = []
+        
+        def add_one(n):
+            foo = foos.save({'n': n})
+            if n % 10 == 0:
+                raise ValueError, n
+            return foo['id']
+            
+        def writer(start):
+            for n in range(start, start + 20):
+                try:
+                    id = db.transaction(add_one, n)
+                    assert id is not None
+                except ValueError, e:
+                    errors.append(e.args[0])
+                    
+        threads = [threading.Thread(target=writer, args=(i * 20,)) for i in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+            
+        self.assertEqual(sorted(errors), range(0, 160, 10))
+        with db.read():
+            self.assertEqual(foos.count(), 160 - 16)
+            self.assertEqual(sorted(f['n'] for f in foos.cursor()), [n for n in range(160) if n % 10])
+        db.close()
+        
+        
+    @unittest.skipUnless(LMDB, "LMDB only")
+    def test_group_commit_failure(self):
+        db = database.open(TEST_URL + "?group_commit=1")
+        foos = db.foos
+        dbm = db.dbm
+        commit = dbm.transaction_commit
+        failures = []
+        
+        def failing_commit():
+            if failures and dbm.transaction_depth() == 2:
+                failures.pop()
+                raise IOError, "nested commit failed"
+            commit()
+            
+        dbm.transaction_commit = failing_commit
+        failures.append(True)
+        with self.assertRaises(IOError):
+            db.transaction(foos.save, {'n': 1})
+        db.transaction(foos.save, {'n': 2})
+        
+        committer = dbm._group_committer
+        commit_batch = committer.commit_batch
+        def failing_batch(batch):
+            committer.commit_batch = commit_batch
+            raise RuntimeError, "writer failed"
+        committer.commit_batch = failing_batch
+        thread = committer.thread
+        with self.assertRaises(RuntimeError):
+            db.transaction(foos.save, {'n': 3})
+        thread.join()
+        db.transaction(foos.save, {'n': 4})
+        self.assertTrue(committer.thread.is_alive() and committer.thread is not thread)
+        
+        with db.read():
+            self.assertEqual(sorted(f['n'] for f in foos.cursor()), [2, 4])
+        db.close()
+        
+        
+    @unittest.skipUnless(LMDB, "LMDB only")
+    def test_map_growth(self):
+        db = database.open(TEST_URL + "?map_size=256K")
+        foos = db.foos
+        foos.indexes.add('n')
+        value = 'x' * 1000
+        
+        def add_many(start):
+            with db.write():
+                for n in range(start, start + 500):
+                    foos.save({'n': n, 'value': value})
+                    
+        add_many(0)
+        threads = [threading.Thread(target=add_many, args=(n * 500,)) for n in range(1, 5)]
+        for t in threads:
+            t.start()
+        with db.read():
+            self.assertTrue(foos.count() >= 500)
+        for t in threads:
+            t.join()
+            
+        with db.read():
+            self.assertEqual(foos.count(), 2500)
+            self.assertEqual(foos.indexes['n'].count(), 2500)
+            self.assertEqual(foos.indexes['n'].get(1234)['n'], 1234)
+        self.assertTrue(db.dbm._env.info()['map_size'] > 2500 * 1000)
+        db.close()
+        
+        shutil.rmtree(TEST_PATH)
+        db = database.open(TEST_URL + "?map_size=256K&map_growth=0")
+        foos = db.foos
+        with self.assertRaises(lmdb.MapFullError):
+            with db.write():
+                for n in range(500):
+                    foos.save({'value': value})
+        db.close()
+        
+        
+    @unittest.skipUnless(LMDB, "LMDB only")
+    def test_map_growth_keeps_cursors(self):
+        db = database.open(TEST_URL + "?map_size=512K")
+        foos = db.foos
+        with db.write():
+            for n in range(300):
+                foos.save({'n': n})
+        with db.write():
+            seen = []
+            for foo in foos.cursor():
+                seen.append(foo['n'])
+                foo['value'] = 'x' * 3000
+                foo['tags'] = range(foo['n'], foo['n'] + 30)
+                foos.save(foo)
+            self.assertEqual(sorted(seen), range(300))
+            self.assertEqual([foo['n'] for foo in foos.cursor(reverse=True)], sorted(seen, reverse=True))
+        db.close()
+        
+        # Building a new index fills the map while the table is scanned
+        db = database.open(TEST_URL + "?map_size=64K&map_headroom=0")
+        foos = db.foos
+        foos.indexes.add('tags')
+        bars = db.bars
+        with db.write():
+            bars.save({'n': 1})
+        with db.read():
+            self.assertEqual(foos.indexes['tags'].count(), 300 * 31)
+            self.assertEqual([foo['n'] for foo in foos.indexes['tags'].all(29)], range(30))
+            self.assertEqual(bars.count(), 1)
+        db.close()
+        
+        shutil.rmtree(TEST_PATH)
+        db = database.open(TEST_URL + "?map_size=256K&map_headroom=0&max_replay_size=64K")
+        foos = db.foos
+        with self.assertRaises(lmdb.MapFullError):
+            with db.write():
+                for n in range(500):
+                    foos.save({'value': 'x' * 1000})
+        with db.write():
+            for n in range(50):
+                foos.save({'value': 'x' * 1000})
+        db.close()
+        
+        
+    @unittest.skipUnless(LMDB, "LMDB only")
+    def test_url_options(self):
+        db = database.open(TEST_URL + "?sync=0&metasync=false&writemap=1&map_async=1&readahead=0&max_readers=7&max_spare_txns=2")
+        foos = db.foos
+        with db.write():
+            foos.save({'foo': 'bar'})
+        db.sync()
+        
+        flags = db.dbm._env.flags()
+        self.assertEqual(
+            (flags['sync'], flags['metasync'], flags['writemap'], flags['map_async'], flags['readahead'], flags['lock']),
+            (False, False, True, True, False, True))
+        self.assertEqual(db.dbm._env.max_readers(), 7)
+        db.close()
+        
+        
+    @unittest.skipUnless(LMDB, "LMDB only")
+    def test_reader_options(self):
+        db = database.open(TEST_URL + "?max_readers=5&max_spare_txns=3")
+        foos = db.foos
+        with db.write():
+            foos.save({'foo': 'bar'})
+        for i in range(5):
+            with db.read():
+                self.assertEqual(foos.count(), 1)
+        self.assertEqual(db.dbm._env.info()['max_readers'], 5)
+        self.assertEqual(db.dbm._max_spare_txns, 3)
+        db.close()
+        
+        db = database.open(TEST_URL + "?max_readers=5&max_spare_txns=9")
+        foos = db.foos
+        with db.read():
+            self.assertEqual(foos.count(), 1)
+        self.assertEqual(db.dbm._env.info()['max_readers'], 5)
+        self.assertEqual(db.dbm._max_spare_txns, 5)
+        db.close()
+        
+        
+    def test_cache(self):
+        db = database.open(TEST_URL + "?cache=3&cache_docs=1&group_commit=1")
+        foos = db.foos
+        with db.write():
+            ids = [foos.save({'n': n, 'tags': [n]})['id'] for n in range(5)]
+            
+        with db.read():
+            for i in range(2):
+                self.assertEqual(foos.get(ids[4])['n'], 4)
+            self.assertEqual(foos.get('missing'), None)
+            self.assertEqual(foos.get('missing'), None)
+            foos.get(ids[4])['n'] = 'changed'
+            foos.get(ids[4])['tags'].append('changed')
+            self.assertEqual(foos.get(ids[4])['tags'], [4])
+        stats = db.dbm.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (5, 2))
+        
+        with self.assertRaises(ValueError):
+            with db.write():
+                foo = foos.get(ids[4])
+                foo['n'] = 40
+                foos.save(foo)
+                self.assertEqual(foos.get(ids[4])['n'], 40)
+                raise ValueError
+        with db.read():
+            self.assertEqual(foos.get(ids[4])['n'], 4)
+            
+        def update(id, n):
+            foos.save({'id': id, 'n': n})
+        db.transaction(update, ids[4], 41)
+        with db.read():
+            self.assertEqual(foos.get(ids[4])['n'], 41)
+            for id in ids:
+                foos.get(id)
+        stats = db.dbm.stats()
+        self.assertEqual(stats['entries'], 3)
+        self.assertTrue(stats['evictions'] > 0)
+        self.assertTrue(0 < db.dbm.hit_rate() < 1)
+        
+        with db.write():
+            foos.remove_all()
+        with db.read():
+            self.assertEqual(foos.get(ids[0]), None)
+        db.close()
+        
+        
+    def test_sharded(self):
+        from handbag.dbm.shardeddbm import ShardedDBM
+        for route in ('namespace', 'key'):
+            db = database.open("sharded://?backend=memory&shards=3&route=%s" % route)
+            self.assertTrue(isinstance(db.dbm, ShardedDBM))
+            foos = db.foos
+            foos.indexes.add('n')
+            with db.write():
+                for n in range(30):
+                    foos.save({'id': u'%02d' % n, 'n': n % 5})
+            with db.read():
+                self.assertEqual(foos.count(), 30)
+                self.assertEqual([f['id'] for f in foos.cursor()], [u'%02d' % n for n in range(30)])
+                self.assertEqual([f['id'] for f in foos.cursor(reverse=True)], [u'%02d' % n for n in reversed(range(30))])
+                self.assertEqual([f['id'] for f in foos.indexes['n'].all({'n': 3})], [u'03', u'08', u'13', u'18', u'23', u'28'])
+            db.close()
+            
+        db = database.open("sharded://?backend=memory&shards=4&route=key")
+        dbm = db.dbm
+        dbm.add_namespace('edges', duplicate_keys=True)
+        pairs = sorted([('k', '%04d' % n) for n in range(200)] + [('%c' % c, 'v') for c in 'abcxyz'])
+        with db.write():
+            for key, value in pairs:
+                dbm.put('edges', key, value)
+        with db.read():
+            cur = dbm.cursor('edges')
+            self.assertEqual(list(cur.iternext()), pairs)
+            self.assertTrue(cur.last())
+            self.assertEqual(list(cur.iterprev()), pairs[::-1])
+            self.assertTrue(cur.jump_dup('k', '0100'))
+            self.assertTrue(cur.next())
+            self.assertEqual((cur.key(), cur.value()), ('k', '0101'))
+            self.assertTrue(cur.prev() and cur.prev())
+            self.assertEqual((cur.key(), cur.value()), ('k', '0099'))
+            self.assertTrue(cur.jump('k') and cur.prev())
+            self.assertEqual((cur.key(), cur.value()), ('c', 'v'))
+            
+        dbm.add_namespace('foos')
+        keys = ['a', 'b', 'c', 'd', 'e']
+        k1 = keys[0]
+        k2 = [k for k in keys if dbm._key_shard('foos', k) != dbm._key_shard('foos', k1)][0]
+        events = [threading.Event(), threading.Event()]
+        calls = []
+        
+        def write(first, second, mine, other):
+            calls.append(first)
+            dbm.put('foos', first, first)
+            events[mine].set()
+            events[other].wait()
+            dbm.put('foos', second, first)
+            
+        threads = [
+            threading.Thread(target=dbm.run_write, args=(write, k1, k2, 0, 1)),
+            threading.Thread(target=dbm.run_write, args=(write, k2, k1, 1, 0))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 3)
+        with db.read():
+            self.assertEqual(dbm.get('foos', k1), dbm.get('foos', k2))
+        db.close()
+        
+        
+    def test_metrics(self):
+        db = database.open("memory://?metrics=1&metrics_interval=0")
+        reports = []
+        db.dbm.callback = reports.append
+        foos = db.foos
+        with db.write():
+            for n in range(3):
+                foos.save({'id': u'%d' % n, 'n': n})
+        with self.assertRaises(ValueError):
+            with db.write():
+                foos.remove(u'0')
+                raise ValueError
+        with db.read():
+            foos.get(u'1')
+            self.assertEqual(len(list(foos.cursor())), 3)
+            
+        metrics = db.dbm.dump()
+        ops = metrics['namespaces']['foos']
+        self.assertEqual(ops['put']['count'], 3)
+        self.assertEqual(ops['delete']['count'], 1)
+        self.assertEqual(ops['get']['count'], 5)
+        self.assertEqual(ops['step']['count'], 4)
+        self.assertTrue(ops['put']['bytes'] > 0 and ops['step']['bytes'] > 0)
+        self.assertEqual(sum(ops['put']['histogram'].values()), 3)
+        transactions = metrics['transactions']
+        self.assertEqual(transactions['write']['commit']['count'], 1)
+        self.assertEqual(transactions['write']['abort']['count'], 1)
+        self.assertTrue(transactions['read']['commit']['count'] >= 1)
+        self.assertEqual(len(reports), sum(t['count'] for kind in transactions.values() for t in kind.values()))
+        
+        db.dbm.reset()
+        self.assertEqual(db.dbm.dump(), {'namespaces': {}, 'transactions': {}})
+        
+        def save(n):
+            with db.write():
+                foos.save({'id': u'%d' % n, 'n': n})
+        
+        for n in range(5):
+            thread = threading.Thread(target=save, args=(n,))
+            thread.start()
+            thread.join()
+        with db.read():
+            self.assertEqual(len(list(foos.cursor())), 5)
+            cursor = db.dbm.cursor('foos')
+            metrics = db.dbm.dump()
+            self.assertEqual(metrics['namespaces']['foos']['put']['count'], 5)
+            self.assertEqual(metrics['transactions']['write']['commit']['count'], 5)
+            self.assertEqual(len(db.dbm._threads), 1)
+            
+            db.dbm.reset()
+            cursor.first()
+            ops = db.dbm.dump()['namespaces']['foos']
+            self.assertEqual((ops.keys(), ops['step']['count']), (['step'], 1))
+        db.close()
+        
+        
+    def test_memory_backend(self):
+        from handbag.dbm import memorydbm
+        dbm = memorydbm.MemoryDBM(None)
+        dbm.add_namespace('foos')
+        dbm.add_namespace('dups', duplicate_keys=True)
+        keys = ['%05d' % i for i in range(2000)]
+        
+        dbm.transaction_start(writable=True)
+        for key in reversed(keys):
+            dbm.put('foos', key, 'v' + key)
+            dbm.put('dups', key[:3], key)
+        dbm.transaction_commit()
+        
+        dbm.transaction_start()
+        self.assertEqual(dbm.count('foos'), 2000)
+        self.assertEqual(dbm.count('dups'), 2000)
+        self.assertEqual([k for k, v in dbm.cursor('foos').iternext()], keys)
+        self.assertEqual([k for k, v in dbm.cursor('foos').iterprev()], list(reversed(keys)))
+        cursor = dbm.cursor('dups')
+        self.assertTrue(cursor.jump('005'))
+        self.assertEqual(cursor.value(), '00500')
+        self.assertTrue(cursor.jump_dup('005', '00507'))
+        self.assertTrue(cursor.next())
+        self.assertEqual(cursor.value(), '00508')
+        self.assertFalse(cursor.jump('999'))
+        self.assertEqual(cursor.key(), '')
+        self.assertTrue(cursor.prev())
+        self.assertEqual(cursor.value(), '01999')
+        snapshot = dbm.cursor('foos')
+        
+        def write():
+            dbm.transaction_start(writable=True)
+            dbm.delete('foos', '00001')
+            dbm.transaction_start(writable=True)
+            dbm.delete('dups', '000')
+            dbm.put('foos', '00001', 'x')
+            dbm.transaction_abort()
+            dbm.transaction_start(writable=True)
+            dbm.delete('dups', '001', '00105')
+            dbm.transaction_commit()
+            dbm.transaction_commit()
+            
+        t = threading.Thread(target=write)
+        t.start()
+        t.join()
+        self.assertEqual(len(list(snapshot.iternext())), 2000)
+        dbm.transaction_commit()
+        
+        dbm.transaction_start()
+        self.assertEqual(dbm.get('foos', '00001'), None)
+        self.assertEqual(dbm.count('foos'), 1999)
+        self.assertEqual(dbm.count('dups'), 1999)
+        self.assertEqual(dbm.get('dups', '000'), '00000')
+        self.assertFalse(dbm.cursor('dups').jump_dup('001', '00105'))
+        dbm.transaction_commit()
@@ -630,6 +630,41 @@ class TestGroup(unittest.TestCase):
             self.fail("Raised invalid error on an empty string for an optional validator")
         
         
+class TestValidationPlan(unittest.TestCase):
+    
+    def test_pass(self):
+        """
+        Should validate like the equivalent GroupValidator
+        """
+        plan = ValidationPlan([('foo', Text()), ('baz', TypeOf(int, float, optional=True, default=5.5))])
+        self.assertEqual(plan.validate({'foo':'a', 'goo':'b'}), {'foo':'a', 'baz':5.5})
+        self.assertRaises(InvalidGroupError, plan.validate, {'baz':5})
+        
+        
+    def test_changed(self):
+        """
+        Should only validate the changed fields but still require required fields
+        """
+        plan = ValidationPlan([('foo', Text()), ('bar', TypeOf(int))])
+        self.assertEqual(plan.validate({'foo':23, 'bar':5}, changed=('bar',)), {'foo':23, 'bar':5})
+        self.assertRaises(InvalidGroupError, plan.validate, {'foo':23, 'bar':5}, changed=('foo',))
+        self.assertRaises(InvalidGroupError, plan.validate, {'bar':5}, changed=())
+        
+        
+    def test_validate_many(self):
+        """
+        Should validate a batch and report errors by position
+        """
+        plan = ValidationPlan([('foo', Text())])
+        self.assertEqual(plan.validate_many([{'foo':'a'}, {'foo':'b'}]), [{'foo':'a'}, {'foo':'b'}])
+        try:
+            plan.validate_many([{'foo':'a'}, {'foo':23}, {}])
+        except InvalidGroupError, e:
+            self.assertEqual(sorted(e.errors.keys()), [1, 2])
+        else:
+            self.fail("Passed an invalid batch")
+        
+        
 class TestAnything(unittest.TestCase):
     
     def test_pass(self):